@@ -0,0 +1,124 @@
+"""
+Cache em memória com limite de entradas (LRU) e expiração (TTL).
+
+Seguro para uso entre threads. Conta acertos, faltas, expirações e
+remoções por LRU para exportação em /metrics.
+
+Os métodos assíncronos (`obter`, `guardar`, `remover` e as reservas
+`reservar`/`liberar`/`consultar`) são a interface comum com o cache
+compartilhado entre processos (shared_cache.py); aqui eles só usam a
+memória local.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+_AUSENTE = object()
+
+
+class TTLCache:
+    def __init__(self, max_itens: int, ttl: float, relogio: Callable[[], float] = time.monotonic):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self._relogio = relogio
+        self._lock = threading.Lock()
+        self._itens: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.acertos = 0
+        self.faltas = 0
+        self.expirados = 0
+        self.removidos_lru = 0
+
+    def get(self, chave: Hashable, padrao: Any = None) -> Any:
+        agora = self._relogio()
+        with self._lock:
+            item = self._itens.get(chave, _AUSENTE)
+            if item is _AUSENTE:
+                self.faltas += 1
+                return padrao
+            valor, expira_em = item
+            if expira_em <= agora:
+                del self._itens[chave]
+                self.expirados += 1
+                self.faltas += 1
+                return padrao
+            self._itens.move_to_end(chave)
+            self.acertos += 1
+            return valor
+
+    def peek(self, chave: Hashable, padrao: Any = None) -> Any:
+        """Como `get`, mas sem alterar a ordem LRU nem as estatísticas."""
+        with self._lock:
+            item = self._itens.get(chave, _AUSENTE)
+        if item is _AUSENTE or item[1] <= self._relogio():
+            return padrao
+        return item[0]
+
+    def set(self, chave: Hashable, valor: Any, ttl: Optional[float] = None):
+        expira_em = self._relogio() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._itens[chave] = (valor, expira_em)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+                self.removidos_lru += 1
+
+    def pop(self, chave: Hashable, padrao: Any = None) -> Any:
+        with self._lock:
+            item = self._itens.pop(chave, _AUSENTE)
+        return padrao if item is _AUSENTE else item[0]
+
+    async def obter(self, chave: Hashable, padrao: Any = None) -> Any:
+        return self.get(chave, padrao)
+
+    async def guardar(self, chave: Hashable, valor: Any, ttl: Optional[float] = None):
+        self.set(chave, valor, ttl)
+
+    async def remover(self, chave: Hashable, padrao: Any = None) -> Any:
+        return self.pop(chave, padrao)
+
+    async def reservar(self, chave: Hashable, valor: Any, ttl: Optional[float] = None) -> bool:
+        """Guarda `valor` só se a chave estiver livre; retorna se conseguiu."""
+        agora = self._relogio()
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is not None and item[1] > agora:
+                return False
+            self._itens[chave] = (valor, agora + (self.ttl if ttl is None else ttl))
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+                self.removidos_lru += 1
+            return True
+
+    async def liberar(self, chave: Hashable, valor: Any):
+        """Desfaz `reservar`, se a chave ainda guarda `valor`."""
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is not None and item[0] == valor:
+                del self._itens[chave]
+
+    async def consultar(self, chave: Hashable, padrao: Any = None) -> Any:
+        """Lê sem usar a cópia local (no cache compartilhado); aqui é o `peek`."""
+        return self.peek(chave, padrao)
+
+    def clear(self):
+        with self._lock:
+            self._itens.clear()
+
+    def __len__(self) -> int:
+        return len(self._itens)
+
+    def stats(self) -> dict:
+        with self._lock:
+            consultas = self.acertos + self.faltas
+            return {
+                "itens": len(self._itens),
+                "max_itens": self.max_itens,
+                "acertos": self.acertos,
+                "faltas": self.faltas,
+                "expirados": self.expirados,
+                "removidos_lru": self.removidos_lru,
+                "taxa_acerto": round(self.acertos / consultas, 4) if consultas else None,
+            }
@@ -0,0 +1,547 @@
+"""
+Motor de chat compartilhado pela API (main.py) e pelo bot do Telegram.
+
+Reúne o pipeline de um turno: resolver o chat ativo, carregar histórico,
+resumo, perfil, base de conhecimento e intenção, montar o prompt, chamar a
+OpenAI e salvar a conversa. Os caches, os clientes e as métricas ficam em
+uma única instância, então a API e o bot (em modo webhook, no mesmo
+processo) compartilham a base carregada, o pool de conexões e os contadores.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+from chat_sessions import ChatSessionCache
+from faq_cache import FaqCache, FAQ_CACHE_ENABLED, versao_prompt
+from history import HistoryCache, consulta_historico, ordenar_pagina
+from intent_classifier import (
+    IntentClassifier, NgramIntentModel, INTENT_NGRAM_MODEL_PATH, INTENT_CACHE_MAX_ITEMS, INTENT_CACHE_TTL_SECONDS,
+)
+from knowledge_base import KnowledgeBaseCache
+from metrics import metrics
+from persistence import MessageWriter, montar_linhas
+from profiles import UserProfileCache
+from prompts import IntentPrompts, KB_INTENT_SCOPED_PROMPTS, montar_mensagens, montar_prompt_sistema, registrar_uso
+from retrieval import Retriever, KB_RETRIEVAL_MODE
+from shared_cache import SharedCaches, criar_backend
+from summaries import ChatSummaries, HistoricoCompactado, compactar
+
+logger = logging.getLogger(__name__)
+
+CHAT_MODEL = "gpt-4o-mini"
+CHAT_TEMPERATURE = 0.7
+CHAT_MAX_TOKENS = 1000
+# Mensagens recentes consideradas em cada turno (antes da compactação)
+CHAT_HISTORY_LIMIT = 30
+
+
+class BaseIndisponivel(RuntimeError):
+    """A base de conhecimento não pôde ser carregada."""
+
+
+def chave_chat(user_id: Optional[int], session_id: Optional[str]):
+    """Chave do cache de chats; None quando não há usuário nem sessão."""
+    if user_id:
+        return ("user", user_id)
+    if session_id:
+        return ("session", session_id)
+    return None
+
+
+def violacao_de_unicidade(erro: Exception) -> bool:
+    """Erro do PostgREST/Postgres por chave única duplicada (23505)."""
+    return getattr(erro, "code", None) == "23505"
+
+
+@dataclass
+class ChatPreparado:
+    """Tudo o que um turno precisa antes de chamar a OpenAI."""
+    chat_id: int
+    pergunta: str
+    historico: List[dict]
+    compactado: HistoricoCompactado
+    user_name: Optional[str]
+    user_pronoun: Optional[str]
+    intent: Optional[str]
+    modo_contexto: str
+    tokens_contexto: int
+    trechos_contexto: int
+    messages: List[dict]
+    versao_base: Optional[str] = None
+
+
+class ChatEngine:
+    def __init__(self, supabase, bucket: str, client, client_async, nome_metrica_persistencia: str = "persistencia"):
+        # Cliente síncrono: usado pelo cache da base de conhecimento (threads próprias)
+        self.supabase = supabase
+        self.client = client
+        self.client_async = client_async
+        self.nome_metrica_persistencia = nome_metrica_persistencia
+        # Criados em `iniciar`, que roda dentro do event loop
+        self.supabase_async = None
+        self.message_writer: Optional[MessageWriter] = None
+        self.summaries: Optional[ChatSummaries] = None
+
+        # Caches em memória, compartilhados entre processos se CACHE_BACKEND=redis
+        self.caches = SharedCaches(criar_backend())
+
+        # Cache da base de conhecimento (arquivos .md do bucket)
+        self.kb_cache = KnowledgeBaseCache(lambda: supabase.storage.from_(bucket))
+
+        # Seleção dos trechos da base enviados ao modelo (KB_RETRIEVAL_MODE)
+        if KB_RETRIEVAL_MODE == "semantic":
+            from semantic_index import criar_embedder
+            self.retriever = Retriever(embedder=criar_embedder(client=client))
+        else:
+            self.retriever = Retriever()
+
+        # Classificador de intenção: regras, modelo local e cache antes do LLM
+        self.intent_cache = self.caches.criar("intencoes", INTENT_CACHE_MAX_ITEMS, INTENT_CACHE_TTL_SECONDS)
+        self.intent_classifier = IntentClassifier(
+            modelo=NgramIntentModel.carregar(INTENT_NGRAM_MODEL_PATH), cache=self.intent_cache,
+            async_client=client_async,
+        )
+        # Prompts de sistema pré-compilados por intenção (um conjunto por versão da base)
+        self.intent_prompts = IntentPrompts()
+
+        # Chat ativo de cada usuário/sessão, para não consultar o banco a cada mensagem
+        self.chat_sessions = ChatSessionCache(caches=self.caches)
+        # Perfis da tabela users (inclusive ids inexistentes)
+        self.user_profiles = UserProfileCache(caches=self.caches)
+        # Últimas mensagens de cada chat, atualizadas a cada turno salvo. Cada
+        # processo tem as suas janelas; as dos outros são descartadas quando
+        # mensagens novas do chat são gravadas
+        self.history_cache = HistoryCache()
+        self.caches.ao_invalidar("historico", self.history_cache.invalidar)
+        # Respostas de perguntas frequentes no primeiro turno (sem histórico nem perfil)
+        self.faq_cache = FaqCache(caches=self.caches) if FAQ_CACHE_ENABLED else None
+
+        metrics.gauge("intent_cache", self.intent_cache.stats)
+        metrics.gauge("chat_sessions_cache", self.chat_sessions.stats)
+        metrics.gauge("user_profiles_cache", self.user_profiles.stats)
+        metrics.gauge("history_cache", self.history_cache.stats)
+        metrics.gauge("caches_compartilhados", self.caches.stats)
+        if self.faq_cache:
+            metrics.gauge("faq_cache", self.faq_cache.stats)
+
+        # Tarefas disparadas sem await (ex.: salvar uma resposta interrompida);
+        # a referência evita que sejam coletadas antes de terminar
+        self._tarefas_em_segundo_plano = set()
+
+    async def iniciar(self, supabase_async):
+        """Liga o cliente assíncrono do Supabase e inicia a gravação em lote."""
+        self.supabase_async = supabase_async
+        await self.caches.iniciar()
+        self.message_writer = MessageWriter(
+            supabase_async,
+            nome_metrica=self.nome_metrica_persistencia,
+            ao_gravar=self._historico_gravado,
+            ao_descartar=self._historico_descartado,
+        )
+        await self.message_writer.iniciar()
+        self.summaries = ChatSummaries(supabase_async, self.client_async, caches=self.caches)
+        metrics.gauge("resumos_historico", self.summaries.stats)
+
+    async def parar(self):
+        """Espera as tarefas em segundo plano e grava o que ainda está na fila."""
+        if self._tarefas_em_segundo_plano:
+            await asyncio.gather(*self._tarefas_em_segundo_plano, return_exceptions=True)
+        if self.message_writer:
+            await self.message_writer.parar()
+        await self.caches.parar()
+
+    def disparar_em_segundo_plano(self, coro):
+        tarefa = asyncio.create_task(coro)
+        self._tarefas_em_segundo_plano.add(tarefa)
+        tarefa.add_done_callback(self._tarefas_em_segundo_plano.discard)
+
+    # Chats
+
+    async def get_or_create_chat(self, user_id: Optional[int], session_id: Optional[str], titulo: str = "Nova conversa"):
+        """
+        Busca ou cria um chat ativo para o usuário ou sessão.
+        Retorna o ID do chat.
+        """
+        try:
+            # Se não tiver nem user_id nem session_id, cria um temporário
+            if not user_id and not session_id:
+                session_id = f"temp_{datetime.now().timestamp()}"
+
+            # Busca um chat ativo existente
+            if user_id:
+                # Verifica se o usuário existe na tabela users (perfil em cache)
+                perfil = await self.buscar_perfil(user_id)
+
+                # Se o usuário não existir, usa session_id ao invés
+                if not perfil:
+                    logger.warning(f"User ID {user_id} não encontrado, usando session_id")
+                    session_id = f"user_{user_id}_temp"
+                    user_id = None
+
+            async def buscar_ativo():
+                consulta = self.supabase_async.table('chats').select('id')
+                if user_id:
+                    consulta = consulta.eq('user_id', user_id)
+                else:
+                    consulta = consulta.eq('session_id', session_id)
+                return await consulta.eq('is_active', True).order('created_at', desc=True).limit(1).execute()
+
+            result = await buscar_ativo()
+
+            # Se encontrou um chat ativo, retorna o ID
+            if result and result.data:
+                return result.data[0]['id']
+
+            # Caso contrário, cria um novo chat
+            new_chat = {
+                'user_id': user_id,  # Pode ser None
+                'session_id': session_id,
+                'title': titulo,
+                'is_active': True,
+                'created_at': datetime.now().isoformat(),
+                'updated_at': datetime.now().isoformat()
+            }
+
+            try:
+                result = await self.supabase_async.table('chats').insert(new_chat).execute()
+                return result.data[0]['id']
+            except Exception as e:
+                if not violacao_de_unicidade(e):
+                    raise
+                # Outro processo criou o chat ativo ao mesmo tempo (índices
+                # únicos parciais de `chats`, ver README): usa o dele
+                result = await buscar_ativo()
+                if not result.data:
+                    raise
+                return result.data[0]['id']
+
+        except Exception as e:
+            logger.error(f"Erro ao buscar/criar chat: {e}")
+            raise
+
+    async def resolver_chat(self, user_id: Optional[int], session_id: Optional[str], titulo: str = "Nova conversa") -> int:
+        """`get_or_create_chat` com o cache de chats ativos na frente."""
+        return await self.chat_sessions.resolver(
+            chave_chat(user_id, session_id), lambda: self.get_or_create_chat(user_id, session_id, titulo)
+        )
+
+    async def novo_chat(
+        self, user_id: Optional[int], session_id: Optional[str], criar: bool = True, titulo: str = "Nova conversa"
+    ) -> Optional[int]:
+        """
+        Desativa o chat ativo do usuário/sessão e, com `criar`, já cria o novo
+        (sem `criar`, ele é criado na próxima mensagem). A troca acontece sob o
+        mesmo lock usado para resolver o chat, para que uma mensagem simultânea
+        não volte a guardar o chat desativado.
+        """
+        chave = chave_chat(user_id, session_id)
+
+        async def desativar():
+            chats = self.supabase_async.table('chats').update({'is_active': False})
+            if user_id:
+                await chats.eq('user_id', user_id).eq('is_active', True).execute()
+            elif session_id:
+                await chats.eq('session_id', session_id).eq('is_active', True).execute()
+
+        if not criar:
+            async with self.chat_sessions.bloqueio(chave):
+                await desativar()
+                await self.chat_sessions.invalidar(chave)
+            return None
+
+        async def desativar_e_criar():
+            await desativar()
+            return await self.get_or_create_chat(user_id, session_id, titulo)
+
+        return await self.chat_sessions.substituir(chave, desativar_e_criar)
+
+    async def desativar_chat(self, chat_id: int):
+        """Desativa um chat (soft delete) e o remove dos caches."""
+        await self.supabase_async.table('chats').update({'is_active': False}).eq('id', chat_id).execute()
+        await self.chat_sessions.invalidar_chat(chat_id)
+        self.history_cache.invalidar(chat_id)
+        await self.caches.invalidar("historico", chat_id)
+        await self.summaries.invalidar(chat_id)
+
+    async def _historico_gravado(self, chat_ids: List[int]):
+        """Mensagens gravadas: os outros processos descartam as janelas desses chats."""
+        for chat_id in chat_ids:
+            await self.caches.invalidar("historico", chat_id)
+
+    async def _historico_descartado(self, chat_ids: List[int]):
+        """
+        Mensagens descartadas após as tentativas de gravação: a janela em
+        memória já as tem (`save_messages`), então é descartada para o próximo
+        turno ler do banco o mesmo histórico que os outros processos veem.
+        """
+        for chat_id in chat_ids:
+            self.history_cache.invalidar(chat_id)
+
+    # Histórico
+
+    async def buscar_pagina_historico(
+        self, chat_id: int, limit: int, before: Optional[str] = None, after: Optional[str] = None
+    ):
+        """
+        Página do histórico por cursor, em ordem cronológica, com id e created_at.
+        Sem cursor, retorna as `limit` mensagens mais recentes.
+        """
+        result = await consulta_historico(self.supabase_async, chat_id, limit, antes=before, depois=after).execute()
+        return ordenar_pagina(result.data or [], depois=after)
+
+    async def get_chat_history(self, chat_id: int, limit: int = CHAT_HISTORY_LIMIT):
+        """
+        Busca as últimas mensagens de um chat.
+        Retorna lista de mensagens no formato [{"role": "user/assistant", "content": "...", "created_at": "..."}]
+        """
+        try:
+            pagina = await self.buscar_pagina_historico(chat_id, limit)
+
+            # created_at marca até onde o resumo do histórico vai (ver summaries.py)
+            return [{"role": msg['role'], "content": msg['content'], "created_at": msg['created_at']} for msg in pagina]
+
+        except Exception as e:
+            logger.error(f"Erro ao buscar histórico: {e}")
+            return []
+
+    async def save_messages(self, chat_id: int, mensagens: List[tuple]):
+        """
+        Agenda a gravação das mensagens (role, content) do turno.
+        A gravação acontece em lote, em segundo plano (ver persistence.py).
+        """
+        try:
+            linhas = montar_linhas(chat_id, mensagens)
+            self.history_cache.acrescentar(chat_id, linhas)
+            await self.message_writer.enfileirar_linhas(linhas)
+        except Exception as e:
+            # Não lança exceção para não quebrar o fluxo
+            logger.error(f"Erro ao salvar mensagens: {e}")
+
+    async def buscar_chat_e_historico(
+        self, user_id: Optional[int], session_id: Optional[str], titulo: str = "Nova conversa",
+        limit: int = CHAT_HISTORY_LIMIT,
+    ):
+        """Resolve o chat ativo e, em seguida, carrega o histórico e o resumo dele."""
+        chat_id = await self.resolver_chat(user_id, session_id, titulo)
+
+        async def carregar():
+            # Garante que o turno anterior (gravado em segundo plano) entre no histórico
+            await self.message_writer.aguardar(chat_id)
+            return await self.get_chat_history(chat_id, limit=limit)
+
+        historico, resumo = await asyncio.gather(
+            self.history_cache.obter(chat_id, carregar, limit=limit),
+            self.summaries.obter(chat_id),
+        )
+        return chat_id, historico, compactar(historico, resumo)
+
+    # Usuários
+
+    async def _consultar_perfil(self, user_id: int) -> Optional[dict]:
+        result = await self.supabase_async.table('users').select('name, social_name, pronoun').eq('id', user_id).limit(1).execute()
+        if not result.data:
+            return None
+        return {
+            'name': result.data[0].get('name'),
+            'social_name': result.data[0].get('social_name'),
+            'pronoun': result.data[0].get('pronoun')
+        }
+
+    async def buscar_perfil(self, user_id: int) -> Optional[dict]:
+        """
+        Perfil do usuário (cache com TTL; ids inexistentes também ficam em cache).
+        Retorna None se o usuário não existir; erros do banco são propagados.
+        """
+        return await self.user_profiles.obter(user_id, self._consultar_perfil)
+
+    async def get_preferred_name_and_pronoun(self, user_id: Optional[int]) -> Optional[dict]:
+        """
+        Retorna o nome preferido e pronome do usuário.
+        Prioriza nome social sobre nome.
+        Retorna: {'name': str, 'pronoun': str} ou None
+        """
+        if not user_id:
+            return None
+
+        try:
+            user_info = await self.buscar_perfil(user_id)
+        except Exception as e:
+            logger.error(f"Erro ao buscar informações do usuário: {e}")
+            return None
+        if not user_info:
+            return None
+
+        # Prioriza o nome social, se disponível
+        preferred_name = user_info.get('social_name') or user_info.get('name')
+        pronoun = user_info.get('pronoun')
+
+        if not preferred_name:
+            return None
+
+        return {
+            'name': preferred_name,
+            'pronoun': pronoun if pronoun else None
+        }
+
+    async def invalidar_perfil(self, user_id: int):
+        await self.user_profiles.invalidar(user_id)
+        # Um id antes inexistente pode estar associado a um chat de sessão temporária
+        await self.chat_sessions.invalidar(chave_chat(user_id, None))
+
+    # Turno
+
+    async def classificar_intencao(self, texto: str) -> Optional[str]:
+        """
+        Classifica a mensagem para escolher o contexto do chat.
+        Em caso de falha retorna None, e o chat usa o prompt completo.
+        """
+        try:
+            resultado = await self.intent_classifier.classificar_async(texto)
+            metrics.incr(f"intent_etapa.{resultado.etapa}")
+            return resultado.intent
+        except Exception as e:
+            logger.error(f"Erro ao classificar intenção no chat: {e}")
+            return None
+
+    async def preparar(
+        self,
+        pergunta: str,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        intent: Optional[str] = None,
+        instrucoes_canal: Sequence[str] = (),
+        titulo_chat: str = "Nova conversa",
+    ) -> ChatPreparado:
+        """
+        Resolve o chat, busca histórico, usuário, base e intenção, e monta as
+        mensagens enviadas à OpenAI. Lança BaseIndisponivel se a base de
+        conhecimento não puder ser carregada.
+        """
+        async def obter_intencao():
+            return intent or await self.classificar_intencao(pergunta)
+
+        # 1-4. Etapas independentes em paralelo: chat + histórico (últimas 30,
+        # compactadas no orçamento de tokens), nome e pronome do usuário, contexto
+        # dos artigos e intenção da mensagem.
+        # A base de conhecimento usa o cliente síncrono, então roda em uma thread.
+        (chat_id, historico, compactado), user_info, snapshot, intent = await asyncio.gather(
+            self.buscar_chat_e_historico(user_id, session_id, titulo_chat),
+            self.get_preferred_name_and_pronoun(user_id),
+            asyncio.to_thread(self.kb_cache.get_snapshot),
+            obter_intencao(),
+        )
+        user_name = user_info.get('name') if user_info else None
+        user_pronoun = user_info.get('pronoun') if user_info else None
+
+        if not snapshot or not snapshot.contexto:
+            raise BaseIndisponivel("Não foi possível carregar o contexto dos artigos")
+
+        # 5. Monta o prompt do sistema: usa o prompt pré-compilado da intenção
+        # e, para OUTROS/NAO_ENTENDIDO, os trechos relevantes da base completa
+        prompt_intencao = self.intent_prompts.obter(snapshot, intent) if KB_INTENT_SCOPED_PROMPTS else None
+
+        if prompt_intencao:
+            prompt_base = prompt_intencao.prompt
+            modo_contexto = "intent"
+            tokens_contexto = prompt_intencao.tokens
+            trechos_contexto = len(prompt_intencao.arquivos)
+        else:
+            # O modo semantic pode chamar a API de embeddings (cliente síncrono)
+            selecao = await asyncio.to_thread(self.retriever.selecionar, snapshot, pergunta, historico)
+            prompt_base = montar_prompt_sistema(selecao.contexto)
+            modo_contexto = selecao.modo
+            tokens_contexto = selecao.tokens
+            trechos_contexto = len(selecao.chunks)
+
+        # 6-7. Monta a lista de mensagens: parte estática primeiro (prefixo
+        # compartilhado, aproveitado pelo cache de prompt da OpenAI), depois
+        # nome/pronome e canal, histórico compactado e a pergunta atual
+        messages = montar_mensagens(
+            prompt_base,
+            pergunta,
+            historico=compactado.recentes,
+            resumo=compactado.resumo.texto if compactado.resumo else None,
+            user_name=user_name,
+            user_pronoun=user_pronoun,
+            instrucoes_canal=instrucoes_canal,
+        )
+
+        return ChatPreparado(
+            chat_id=chat_id,
+            pergunta=pergunta,
+            historico=historico,
+            compactado=compactado,
+            user_name=user_name,
+            user_pronoun=user_pronoun,
+            intent=intent,
+            modo_contexto=modo_contexto,
+            tokens_contexto=tokens_contexto,
+            trechos_contexto=trechos_contexto,
+            messages=messages,
+            versao_base=snapshot.versao,
+        )
+
+    def _versao_faq(self, preparo: ChatPreparado) -> Optional[tuple]:
+        """Versão da base e do prompt para o cache de FAQ, ou None se o turno não pode usá-lo."""
+        if self.faq_cache is None or preparo.historico or preparo.user_name:
+            return None
+        # Tudo o que vai ao modelo além da pergunta: prompt base, canal e parâmetros
+        partes = [m["content"] for m in preparo.messages[:-1]]
+        return preparo.versao_base, versao_prompt(CHAT_MODEL, CHAT_TEMPERATURE, CHAT_MAX_TOKENS, *partes)
+
+    async def resposta_frequente(self, preparo: ChatPreparado) -> Optional[str]:
+        """Resposta já gerada para a mesma pergunta (ou uma parecida) no primeiro turno, ou None."""
+        versao = self._versao_faq(preparo)
+        if versao is None:
+            return None
+        try:
+            return await self.faq_cache.buscar(versao, preparo.pergunta)
+        except Exception as e:
+            logger.error(f"Erro ao consultar o cache de FAQ: {e}")
+            return None
+
+    async def guardar_resposta_frequente(self, preparo: ChatPreparado, resposta: str, usage):
+        """Guarda a resposta completa de um primeiro turno, com os tokens que ela custou."""
+        versao = self._versao_faq(preparo)
+        if versao is None:
+            return
+        try:
+            await self.faq_cache.guardar(versao, preparo.pergunta, resposta, usage.total_tokens if usage else 0)
+        except Exception as e:
+            logger.error(f"Erro ao guardar no cache de FAQ: {e}")
+
+    async def completar(self, preparo: ChatPreparado):
+        """Chama a OpenAI e retorna a resposta completa."""
+        return await self.client_async.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=preparo.messages,
+            temperature=CHAT_TEMPERATURE,
+            max_tokens=CHAT_MAX_TOKENS
+        )
+
+    async def completar_stream(self, preparo: ChatPreparado):
+        """Chama a OpenAI em modo stream; o último chunk traz o `usage`."""
+        return await self.client_async.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=preparo.messages,
+            temperature=CHAT_TEMPERATURE,
+            max_tokens=CHAT_MAX_TOKENS,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+    def registrar_metricas(self, preparo: ChatPreparado, usage, canal: str = "chat"):
+        """Métricas de tokens por requisição."""
+        metrics.incr(f"{canal}_contexto_modo.{preparo.modo_contexto}")
+        metrics.observe(f"{canal}_contexto_tokens", preparo.tokens_contexto)
+        metrics.observe(f"{canal}_historico_tokens", preparo.compactado.tokens)
+        registrar_uso(usage, canal)
+
+    async def salvar_turno(self, preparo: ChatPreparado, resposta: str):
+        """Salva pergunta e resposta e, se preciso, regera o resumo em segundo plano."""
+        await self.save_messages(preparo.chat_id, [("user", preparo.pergunta), ("assistant", resposta)])
+        if preparo.compactado.desatualizado:
+            self.disparar_em_segundo_plano(self.summaries.atualizar(preparo.chat_id, preparo.compactado))
@@ -0,0 +1,118 @@
+"""
+Cache de resolução usuário/sessão → chat ativo.
+
+Evita as consultas de `get_or_create_chat` a cada mensagem de uma conversa
+em andamento. Requisições simultâneas para a mesma chave esperam a primeira
+resolver (single-flight), então um chat não é criado duas vezes pelo mesmo
+processo. Com um backend compartilhado (shared_cache.py), o chat resolvido
+por um processo serve aos outros, e as trocas de chat invalidam todos.
+"""
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from shared_cache import SharedCaches, como_chave
+
+CHAT_SESSION_TTL_SECONDS = float(os.getenv("CHAT_SESSION_TTL_SECONDS", "600"))
+CHAT_SESSION_MAX_ITEMS = int(os.getenv("CHAT_SESSION_MAX_ITEMS", "10000"))
+
+
+class BloqueiosPorChave:
+    """
+    Um asyncio.Lock por chave, criado sob demanda e descartado quando
+    ninguém mais o usa. Quem espera é atendido na ordem de chegada.
+    """
+
+    def __init__(self):
+        # chave → [lock, número de corrotinas usando o lock]
+        self._locks: Dict[Hashable, list] = {}
+
+    @asynccontextmanager
+    async def bloqueio(self, chave: Hashable):
+        entrada = self._locks.get(chave)
+        if entrada is None:
+            entrada = self._locks[chave] = [asyncio.Lock(), 0]
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                yield
+        finally:
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                del self._locks[chave]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class ChatSessionCache:
+    def __init__(
+        self,
+        ttl: float = CHAT_SESSION_TTL_SECONDS,
+        max_itens: int = CHAT_SESSION_MAX_ITEMS,
+        caches: Optional[SharedCaches] = None,
+    ):
+        caches = caches or SharedCaches()
+        self._cache = caches.criar("chat_sessions", max_itens, ttl)
+        # chat_id → chave, para invalidar a partir do id do chat
+        self._chaves_por_chat = caches.criar("chat_sessions_chaves", 2 * max_itens, ttl, de_json=como_chave)
+        self._bloqueios = BloqueiosPorChave()
+
+    def bloqueio(self, chave: Hashable):
+        """
+        Serializa resolução, criação e troca de chat de uma mesma chave neste
+        processo. Entre processos, os índices únicos de `chats` (README) impedem
+        o segundo chat ativo.
+        """
+        return self._bloqueios.bloqueio(chave)
+
+    async def _guardar(self, chave: Hashable, chat_id: int):
+        await self._cache.guardar(chave, chat_id)
+        await self._chaves_por_chat.guardar(chat_id, chave)
+
+    async def resolver(self, chave: Optional[Hashable], buscar_ou_criar: Callable[[], Awaitable[int]]) -> int:
+        """
+        Retorna o chat da chave, chamando `buscar_ou_criar` só na falta.
+        Sem chave (requisição anônima sem sessão), não usa o cache.
+        """
+        if chave is None:
+            return await buscar_ou_criar()
+
+        chat_id = await self._cache.obter(chave)
+        if chat_id is not None:
+            return chat_id
+
+        async with self.bloqueio(chave):
+            chat_id = await self._cache.obter(chave)
+            if chat_id is None:
+                chat_id = await buscar_ou_criar()
+                await self._guardar(chave, chat_id)
+            return chat_id
+
+    async def substituir(self, chave: Optional[Hashable], criar: Callable[[], Awaitable[int]]) -> int:
+        """Troca o chat da chave (ex.: nova conversa) sem corrida com `resolver`."""
+        if chave is None:
+            return await criar()
+        async with self.bloqueio(chave):
+            await self.invalidar(chave)
+            chat_id = await criar()
+            await self._guardar(chave, chat_id)
+            return chat_id
+
+    async def invalidar(self, chave: Hashable):
+        chat_id = await self._cache.remover(chave)
+        if chat_id is not None:
+            await self._chaves_por_chat.remover(chat_id)
+
+    async def invalidar_chat(self, chat_id: int):
+        chave = await self._chaves_por_chat.obter(chat_id)
+        if chave is None:
+            return
+        await self._chaves_por_chat.remover(chat_id)
+        if await self._cache.obter(chave) == chat_id:
+            await self._cache.remover(chave)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
@@ -0,0 +1,163 @@
+"""
+Cache de respostas para perguntas frequentes de início de conversa.
+
+A maioria das primeiras mensagens (sem histórico e sem nome/pronome no
+prompt) são as mesmas poucas dezenas de perguntas. Nesses turnos o prompt
+só depende da pergunta, então a resposta gerada pode ser reaproveitada:
+fica guardada pela pergunta normalizada, pela versão da base e pela versão
+do prompt (instruções, canal e parâmetros do modelo). Uma nova versão da
+base ou do prompt deixa as respostas antigas sem uso, e elas saem por TTL
+ou LRU.
+
+Com FAQ_CACHE_SIMILARITY > 0, uma pergunta que não bate exatamente é
+comparada às já respondidas na mesma versão (semelhança de Jaccard entre os
+radicais das palavras); a mais parecida, se atingir o limiar, é usada. O
+índice dessa comparação é de cada processo; com CACHE_BACKEND=redis as
+respostas são compartilhadas, mas só a busca exata vê as dos outros workers.
+"""
+
+import hashlib
+import logging
+import os
+import re
+from functools import lru_cache
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from cache import TTLCache
+from intent_classifier import chave_cache
+from metrics import metrics
+from shared_cache import SharedCaches
+from textnorm import normalizar, termos
+
+logger = logging.getLogger(__name__)
+
+# Desligado por padrão: respostas reaproveitadas não passam de novo pelo modelo
+FAQ_CACHE_ENABLED = os.getenv("FAQ_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+FAQ_CACHE_TTL_SECONDS = float(os.getenv("FAQ_CACHE_TTL_SECONDS", "86400"))
+FAQ_CACHE_MAX_ITEMS = int(os.getenv("FAQ_CACHE_MAX_ITEMS", "1000"))
+# Semelhança mínima (0 a 1) para usar a resposta de uma pergunta parecida; 0 desliga
+FAQ_CACHE_SIMILARITY = float(os.getenv("FAQ_CACHE_SIMILARITY", "0"))
+
+# Versões (base × prompt) com perguntas no índice de semelhança
+_VERSOES_MAX_ITEMS = 256
+# Stopwords que mudam o sentido da pergunta e entram na comparação
+_NEGACOES = frozenset({"nao", "nem", "sem"})
+
+Versao = Tuple[str, str]
+
+
+# Poucas entradas: cada uma segura o texto do prompt
+@lru_cache(maxsize=32)
+def versao_prompt(*partes) -> str:
+    """
+    Hash das partes do prompt que não são a pergunta. O lru_cache evita
+    recalcular para os prompts pré-compilados, que são sempre o mesmo objeto.
+    """
+    bruto = "\x00".join(str(parte) for parte in partes)
+    return hashlib.sha256(bruto.encode("utf-8")).hexdigest()[:16]
+
+
+def termos_pergunta(texto: str) -> FrozenSet[str]:
+    """Radicais das palavras relevantes, mais as negações (para "posso"/"não posso" não se confundirem)."""
+    return frozenset(termos(texto)) | (_NEGACOES & set(re.findall(r"[a-z0-9]+", normalizar(texto))))
+
+
+def semelhanca(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class FaqCache:
+    def __init__(
+        self,
+        ttl: float = FAQ_CACHE_TTL_SECONDS,
+        max_itens: int = FAQ_CACHE_MAX_ITEMS,
+        limiar: float = FAQ_CACHE_SIMILARITY,
+        caches: Optional[SharedCaches] = None,
+    ):
+        self.limiar = limiar
+        self.max_itens = max_itens
+        # (versão da base, versão do prompt, pergunta normalizada) → resposta e tokens gastos
+        self._respostas = (caches or SharedCaches()).criar("faq", max_itens, ttl)
+        # Índice local para a busca por semelhança: versão → {pergunta normalizada: termos}
+        self._perguntas = TTLCache(_VERSOES_MAX_ITEMS, ttl)
+        self.acertos = 0
+        self.acertos_similares = 0
+        self.faltas = 0
+        self.tokens_economizados = 0
+
+    async def buscar(self, versao: Versao, pergunta: str) -> Optional[str]:
+        """Resposta guardada para a pergunta (ou uma parecida), ou None."""
+        chave = chave_cache(pergunta)
+        if not chave:
+            return None
+
+        guardada = await self._respostas.obter((*versao, chave))
+        similar = False
+        if guardada is None and self.limiar > 0:
+            parecida = self._mais_parecida(versao, pergunta)
+            if parecida is not None:
+                guardada = await self._respostas.obter((*versao, parecida))
+                if guardada is None:
+                    # Saiu do cache de respostas (TTL/LRU); tira do índice também
+                    self._perguntas.peek(versao, {}).pop(parecida, None)
+                similar = guardada is not None
+
+        if guardada is None:
+            self.faltas += 1
+            metrics.incr("faq_cache_faltas")
+            return None
+
+        self.acertos += 1
+        self.tokens_economizados += guardada["tokens"]
+        metrics.incr("faq_cache_acertos")
+        metrics.incr("faq_cache_tokens_economizados", guardada["tokens"])
+        if similar:
+            self.acertos_similares += 1
+            metrics.incr("faq_cache_acertos_similares")
+        return guardada["resposta"]
+
+    async def guardar(self, versao: Versao, pergunta: str, resposta: str, tokens: int):
+        chave = chave_cache(pergunta)
+        if not chave or not resposta.strip():
+            return
+        await self._respostas.guardar((*versao, chave), {"resposta": resposta, "tokens": tokens})
+        if self.limiar > 0:
+            self._indexar(versao, chave, termos_pergunta(pergunta))
+
+    def _indexar(self, versao: Versao, chave: str, termos_chave: FrozenSet[str]):
+        perguntas: Dict[str, FrozenSet[str]] = self._perguntas.get(versao)
+        if perguntas is None:
+            perguntas = {}
+            self._perguntas.set(versao, perguntas)
+        perguntas.pop(chave, None)
+        perguntas[chave] = termos_chave
+        while len(perguntas) > self.max_itens:
+            # Mais antiga primeiro (dict mantém a ordem de inserção)
+            del perguntas[next(iter(perguntas))]
+
+    def _mais_parecida(self, versao: Versao, pergunta: str) -> Optional[str]:
+        perguntas = self._perguntas.peek(versao)
+        if not perguntas:
+            return None
+        alvo = termos_pergunta(pergunta)
+        melhor, melhor_semelhanca = None, self.limiar
+        for chave, termos_chave in perguntas.items():
+            valor = semelhanca(alvo, termos_chave)
+            if valor >= melhor_semelhanca:
+                melhor, melhor_semelhanca = chave, valor
+        return melhor
+
+    def stats(self) -> dict:
+        consultas = self.acertos + self.faltas
+        stats = self._respostas.stats()
+        stats.update({
+            "acertos": self.acertos,
+            "acertos_similares": self.acertos_similares,
+            "faltas": self.faltas,
+            "taxa_acerto": round(self.acertos / consultas, 4) if consultas else None,
+            "tokens_economizados": self.tokens_economizados,
+            "limiar_semelhanca": self.limiar,
+        })
+        return stats
@@ -0,0 +1,199 @@
+"""
+Histórico dos chats: consulta paginada por cursor e janela recente em memória.
+
+A consulta usa paginação por chave (keyset) sobre (created_at, id): a
+página mais recente sai de `ORDER BY created_at DESC, id DESC LIMIT n`, e
+as anteriores de `(created_at, id) < cursor`, sem OFFSET. Com o índice
+(chat_id, created_at, id), o custo não cresce com o tamanho do chat.
+
+Cada chat tem uma janela (deque) com as últimas mensagens. A janela é
+carregada do Supabase na primeira vez que o chat aparece e, a partir daí,
+atualizada no lugar quando as mensagens do turno são salvas, sem nova
+consulta ao banco. Os chats menos usados são descartados (LRU) quando o
+total estimado de bytes ou de chats passa do limite.
+"""
+
+import base64
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+HISTORY_CACHE_WINDOW = int(os.getenv("HISTORY_CACHE_WINDOW", "30"))
+HISTORY_CACHE_MAX_CHATS = int(os.getenv("HISTORY_CACHE_MAX_CHATS", "5000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def codificar_cursor(mensagem: dict) -> str:
+    """Cursor opaco com o (created_at, id) de uma mensagem."""
+    bruto = json.dumps([mensagem['created_at'], mensagem['id']], separators=(",", ":"))
+    return base64.urlsafe_b64encode(bruto.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decodificar_cursor(cursor: str) -> Tuple[str, int]:
+    """Lança ValueError se o cursor for inválido."""
+    try:
+        bruto = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, id_ = json.loads(bruto)
+        return str(created_at), int(id_)
+    except Exception as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+
+
+def consulta_historico(
+    supabase, chat_id: int, limit: int, antes: Optional[str] = None, depois: Optional[str] = None
+):
+    """
+    Monta a consulta de uma página do histórico (cliente síncrono ou assíncrono).
+
+    Sem cursor: as `limit` mensagens mais recentes. `antes`: as anteriores ao
+    cursor (rolar para cima). `depois`: as seguintes ao cursor (novas mensagens).
+    Use `ordenar_pagina` no resultado para obter ordem cronológica.
+    """
+    query = supabase.table('chat_messages').select('id, role, content, created_at').eq('chat_id', chat_id)
+    if antes and depois:
+        raise ValueError("Use apenas um dos cursores: antes ou depois")
+    # (created_at, id) > cursor, escrito como `created_at >= c AND (created_at > c
+    # OR id > i)`: o primeiro termo limita a varredura do índice
+    if depois:
+        created_at, id_ = decodificar_cursor(depois)
+        query = query.gte('created_at', created_at).or_(f'created_at.gt."{created_at}",id.gt.{id_}')
+        return query.order('created_at').order('id').limit(limit)
+    if antes:
+        created_at, id_ = decodificar_cursor(antes)
+        query = query.lte('created_at', created_at).or_(f'created_at.lt."{created_at}",id.lt.{id_}')
+    return query.order('created_at', desc=True).order('id', desc=True).limit(limit)
+
+
+def ordenar_pagina(linhas: List[dict], depois: Optional[str] = None) -> List[dict]:
+    """Resultado de `consulta_historico` em ordem cronológica."""
+    return list(linhas) if depois else list(reversed(linhas))
+
+
+# Estimativa do custo fixo de cada mensagem guardada (dict + chaves + role)
+_BYTES_POR_MENSAGEM = 250
+
+
+def _tamanho(mensagem: dict) -> int:
+    return _BYTES_POR_MENSAGEM + sys.getsizeof(mensagem['content'])
+
+
+def _entrada(mensagem: dict) -> dict:
+    return {"role": mensagem['role'], "content": mensagem['content'], "created_at": mensagem.get('created_at')}
+
+
+class _Janela:
+    __slots__ = ("mensagens", "bytes")
+
+    def __init__(self, maximo: int):
+        self.mensagens = deque(maxlen=maximo)
+        self.bytes = 0
+
+    def acrescentar(self, mensagem: dict):
+        if len(self.mensagens) == self.mensagens.maxlen:
+            self.bytes -= _tamanho(self.mensagens[0])
+        self.mensagens.append(mensagem)
+        self.bytes += _tamanho(mensagem)
+
+
+class HistoryCache:
+    def __init__(
+        self,
+        janela: int = HISTORY_CACHE_WINDOW,
+        max_chats: int = HISTORY_CACHE_MAX_CHATS,
+        max_bytes: int = HISTORY_CACHE_MAX_BYTES,
+    ):
+        self.janela = janela
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._chats: "OrderedDict[int, _Janela]" = OrderedDict()
+        self._bytes = 0
+        # Cargas em andamento; True se chegou mensagem nova durante a carga
+        self._carregando: Dict[int, bool] = {}
+        self.acertos = 0
+        self.faltas = 0
+        self.removidos_lru = 0
+
+    async def obter(self, chat_id: int, carregar: Callable[[], Awaitable[List[dict]]], limit: Optional[int] = None) -> List[dict]:
+        """
+        Últimas `limit` mensagens do chat (no máximo a janela), da mais antiga
+        para a mais recente. Na falta, usa `carregar` e guarda o resultado.
+        """
+        limit = self.janela if limit is None else limit
+        if limit > self.janela:
+            return await carregar()
+
+        with self._lock:
+            janela = self._chats.get(chat_id)
+            if janela is not None:
+                self._chats.move_to_end(chat_id)
+                self.acertos += 1
+                return list(janela.mensagens)[-limit:] if limit else []
+            self.faltas += 1
+            self._carregando.setdefault(chat_id, False)
+
+        try:
+            mensagens = await carregar()
+        except BaseException:
+            with self._lock:
+                self._carregando.pop(chat_id, None)
+            raise
+
+        with self._lock:
+            desatualizada = self._carregando.pop(chat_id, False)
+            # Se o chat recebeu mensagens durante a carga, o resultado pode não
+            # incluí-las; não guarda e deixa a próxima leitura carregar de novo
+            if not desatualizada and chat_id not in self._chats:
+                janela = _Janela(self.janela)
+                for mensagem in mensagens:
+                    janela.acrescentar(_entrada(mensagem))
+                self._chats[chat_id] = janela
+                self._bytes += janela.bytes
+                self._remover_excesso()
+        return mensagens[-limit:] if limit else []
+
+    def acrescentar(self, chat_id: int, mensagens: Iterable[dict]):
+        """Atualiza a janela de um chat já carregado com as mensagens salvas."""
+        with self._lock:
+            if chat_id in self._carregando:
+                self._carregando[chat_id] = True
+            janela = self._chats.get(chat_id)
+            if janela is None:
+                return
+            antes = janela.bytes
+            for mensagem in mensagens:
+                janela.acrescentar(_entrada(mensagem))
+            self._bytes += janela.bytes - antes
+            self._chats.move_to_end(chat_id)
+            self._remover_excesso()
+
+    def invalidar(self, chat_id: int):
+        with self._lock:
+            janela = self._chats.pop(chat_id, None)
+            if janela is not None:
+                self._bytes -= janela.bytes
+            if chat_id in self._carregando:
+                self._carregando[chat_id] = True
+
+    def _remover_excesso(self):
+        while self._chats and (len(self._chats) > self.max_chats or self._bytes > self.max_bytes):
+            _, janela = self._chats.popitem(last=False)
+            self._bytes -= janela.bytes
+            self.removidos_lru += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            consultas = self.acertos + self.faltas
+            return {
+                "chats": len(self._chats),
+                "mensagens": sum(len(j.mensagens) for j in self._chats.values()),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "acertos": self.acertos,
+                "faltas": self.faltas,
+                "removidos_lru": self.removidos_lru,
+                "taxa_acerto": round(self.acertos / consultas, 4) if consultas else None,
+            }
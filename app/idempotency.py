@@ -0,0 +1,148 @@
+"""
+Requisições idempotentes do /chat (header `Idempotency-Key`).
+
+Quando o frontend repete uma requisição (por exemplo, após um timeout do
+lado do cliente) com a mesma chave, a resposta já calculada é devolvida
+sem nova chamada à OpenAI e sem gravar o turno de novo. Repetições que
+chegam enquanto a primeira ainda está em andamento esperam o mesmo
+cálculo. O cálculo roda em uma tarefa própria, então continua mesmo que o
+cliente que o iniciou desista da conexão.
+
+Entre processos (cache compartilhado, ver shared_cache.py), quem calcula
+primeiro reserva a chave no backend (SET NX, com a impressão da
+requisição); os outros workers consultam a resposta a cada
+IDEMPOTENCY_POLL_MS até ela aparecer. A reserva é liberada se o cálculo
+falhar e expira sozinha após IDEMPOTENCY_LOCK_SECONDS (processo que caiu).
+
+As respostas concluídas ficam guardadas por IDEMPOTENCY_TTL_SECONDS.
+Falhas não ficam guardadas: a próxima repetição calcula de novo. A chave
+vale por usuário/sessão, e reutilizá-la com outra mensagem é um erro.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import uuid
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from metrics import metrics
+from shared_cache import SharedCaches
+
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+IDEMPOTENCY_MAX_ITEMS = int(os.getenv("IDEMPOTENCY_MAX_ITEMS", "10000"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# Reserva entre processos: duração máxima de um cálculo e intervalo de consulta de quem espera
+IDEMPOTENCY_LOCK_SECONDS = float(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "120"))
+IDEMPOTENCY_POLL_MS = float(os.getenv("IDEMPOTENCY_POLL_MS", "200"))
+
+
+class ChaveReutilizada(ValueError):
+    """A mesma chave de idempotência foi usada com outra requisição."""
+
+
+def impressao(dados: dict) -> str:
+    """Hash do corpo da requisição, para detectar chave reutilizada com outro conteúdo."""
+    bruto = json.dumps(dados, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(bruto.encode("utf-8")).hexdigest()
+
+
+class IdempotencyCache:
+    def __init__(
+        self,
+        ttl: float = IDEMPOTENCY_TTL_SECONDS,
+        max_itens: int = IDEMPOTENCY_MAX_ITEMS,
+        caches: Optional[SharedCaches] = None,
+        duracao_reserva: float = IDEMPOTENCY_LOCK_SECONDS,
+        intervalo_ms: float = IDEMPOTENCY_POLL_MS,
+    ):
+        self.ttl = ttl
+        self.duracao_reserva = duracao_reserva
+        self.intervalo = intervalo_ms / 1000
+        caches = caches or SharedCaches()
+        self._respostas = caches.criar("idempotencia", max_itens, ttl)
+        # Chaves em cálculo em algum processo: {"impressao", "dono"}
+        self._reservas = caches.criar("idempotencia_reservas", max_itens, duracao_reserva)
+        # Cálculos em andamento neste processo: chave → (impressão, tarefa)
+        self._em_andamento: Dict[Hashable, Tuple[str, asyncio.Task]] = {}
+
+    async def executar(
+        self, chave: Hashable, impressao_requisicao: str, calcular: Callable[[], Awaitable[dict]]
+    ) -> Tuple[dict, bool]:
+        """
+        Retorna (resposta, repetida). `repetida` indica que a resposta veio de
+        uma requisição anterior com a mesma chave (guardada ou em andamento).
+        Lança ChaveReutilizada se a chave já foi usada com outro conteúdo.
+        """
+        em_andamento = self._em_andamento.get(chave)
+        if em_andamento is None:
+            guardada = await self._respostas.obter(chave)
+            if guardada is not None:
+                self._conferir(guardada["impressao"], impressao_requisicao)
+                metrics.incr("idempotencia_repeticoes")
+                return guardada["resposta"], True
+            # Outra requisição pode ter começado durante o await
+            em_andamento = self._em_andamento.get(chave)
+
+        if em_andamento is not None:
+            self._conferir(em_andamento[0], impressao_requisicao)
+            metrics.incr("idempotencia_em_andamento")
+            resposta, _ = await asyncio.shield(em_andamento[1])
+            return resposta, True
+
+        tarefa = asyncio.create_task(self._calcular(chave, impressao_requisicao, calcular))
+        # Evita "exception was never retrieved" se quem iniciou desistir antes do fim
+        tarefa.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._em_andamento[chave] = (impressao_requisicao, tarefa)
+        return await asyncio.shield(tarefa)
+
+    async def _calcular(
+        self, chave: Hashable, impressao_requisicao: str, calcular: Callable[[], Awaitable[dict]]
+    ) -> Tuple[dict, bool]:
+        reserva = {"impressao": impressao_requisicao, "dono": uuid.uuid4().hex}
+        try:
+            while not await self._reservas.reservar(chave, reserva):
+                # Outro processo está calculando: espera a resposta dele
+                resposta = await self._esperar_outro_processo(chave, impressao_requisicao)
+                if resposta is not None:
+                    metrics.incr("idempotencia_outro_processo")
+                    return resposta, True
+                # A reserva sumiu sem resposta (falha ou expiração): tenta de novo
+
+            try:
+                # A resposta pode ter sido guardada entre a consulta e a reserva
+                guardada = await self._respostas.obter(chave)
+                if guardada is not None:
+                    self._conferir(guardada["impressao"], impressao_requisicao)
+                    metrics.incr("idempotencia_repeticoes")
+                    return guardada["resposta"], True
+                resposta = await calcular()
+                await self._respostas.guardar(chave, {"impressao": impressao_requisicao, "resposta": resposta})
+                return resposta, False
+            finally:
+                await self._reservas.liberar(chave, reserva)
+        finally:
+            self._em_andamento.pop(chave, None)
+
+    async def _esperar_outro_processo(self, chave: Hashable, impressao_requisicao: str) -> Optional[dict]:
+        """Resposta calculada por outro processo, ou None se a reserva dele sumir antes."""
+        while True:
+            guardada = await self._respostas.obter(chave)
+            if guardada is not None:
+                self._conferir(guardada["impressao"], impressao_requisicao)
+                return guardada["resposta"]
+            reserva = await self._reservas.consultar(chave)
+            if reserva is None:
+                return None
+            self._conferir(reserva["impressao"], impressao_requisicao)
+            await asyncio.sleep(self.intervalo)
+
+    @staticmethod
+    def _conferir(esperada: str, recebida: str):
+        if esperada != recebida:
+            raise ChaveReutilizada("Idempotency-Key já usada com outra requisição")
+
+    def stats(self) -> dict:
+        stats = self._respostas.stats()
+        stats["em_andamento"] = len(self._em_andamento)
+        return stats
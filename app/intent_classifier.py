@@ -0,0 +1,352 @@
+"""
+Classificação de intenção em etapas, com caminho rápido local.
+
+1. Regras: as listas de palavras-chave e expressões do
+   PROMPT_INTENT_CLASSIFICATION (saudação, despedida e termos de cada tema).
+2. Modelo local: Naive Bayes sobre n-gramas de caracteres, treinado com as
+   classificações registradas pelo próprio sistema (INTENT_LOG_PATH).
+3. LLM: só as mensagens em que as etapas locais não atingem
+   INTENT_FAST_PATH_THRESHOLD vão para o gpt-4o-mini. As respostas do LLM
+   ficam em cache (LRU + TTL), pelo texto normalizado e pela versão do prompt.
+
+Treino do modelo local a partir dos logs:
+    python intent_classifier.py treinar logs/intents.jsonl
+"""
+
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from cache import TTLCache
+from intents import ALLOWED_INTENTS, classificar_com_llm_async, versao_prompt_intencao
+from textnorm import normalizar
+
+logger = logging.getLogger(__name__)
+
+# Confiança mínima para a resposta local dispensar o LLM
+INTENT_FAST_PATH_THRESHOLD = float(os.getenv("INTENT_FAST_PATH_THRESHOLD", "0.85"))
+INTENT_NGRAM_MODEL_PATH = os.getenv("INTENT_NGRAM_MODEL_PATH", str(Path(__file__).parent / "intent_ngram_model.json"))
+# Arquivo .jsonl onde as decisões do LLM são registradas para treinar o modelo local
+INTENT_LOG_PATH = os.getenv("INTENT_LOG_PATH")
+INTENT_CACHE_MAX_ITEMS = int(os.getenv("INTENT_CACHE_MAX_ITEMS", "10000"))
+INTENT_CACHE_TTL_SECONDS = float(os.getenv("INTENT_CACHE_TTL_SECONDS", "86400"))
+# Classificação em lote: chamadas simultâneas ao LLM e tamanho máximo do lote
+INTENT_BATCH_CONCURRENCY = int(os.getenv("INTENT_BATCH_CONCURRENCY", "8"))
+INTENT_BATCH_MAX_ITEMS = int(os.getenv("INTENT_BATCH_MAX_ITEMS", "1000"))
+
+
+@dataclass(frozen=True)
+class ResultadoIntencao:
+    intent: str
+    etapa: str  # "regras", "modelo_local", "cache" ou "llm"
+    confianca: Optional[float] = None
+
+
+# ---------------------------------------------------------------------------
+# Etapa 1: regras
+# ---------------------------------------------------------------------------
+
+_SAUDACOES = r"(oi+e?|ola|oie|hey|hello|opa|eai|e ai|bom dia|boa tarde|boa noite|salve|tudo bem|tudo bom|como vai)"
+_DESPEDIDAS = (
+    r"(obrigad[oae]s?|brigad[oae]|muito obrigad[oae]|valeu|vlw|ate mais|ate logo|ate breve|tchau|tchauzinho|"
+    r"falou|flw|so isso|era so isso|e isso|ok obrigad[oae]|beleza|blz|tenha um bom dia)"
+)
+# Mensagem composta só de saudações/despedidas (com pontuação, emojis e "tudo bem?")
+_RE_SO_SAUDACAO = re.compile(rf"^(?:{_SAUDACOES}\W*)+$")
+_RE_SO_DESPEDIDA = re.compile(rf"^(?:{_DESPEDIDAS}\W*)+$")
+
+_PALAVRAS_CHAVE = {
+    "RETIFICACAO_NOME": [
+        r"retifica\w*", r"(troca|trocar|mudar|mudanca|alterar|alteracao)( d[eo])?( meu)? (nome|genero|sexo)",
+        r"nome social", r"certid\w+", r"\brg\b", r"\bcpf\b", r"registro civil", r"cartori\w+", r"defensoria",
+        r"documento\w*", r"prenome", r"marcador de genero",
+    ],
+    "HORMONIZACAO": [
+        r"hormoni\w*", r"hormon\w*", r"\bhrt\b", r"\bth\b", r"terapia hormonal", r"endocrin\w*",
+        r"ambulatorio trans", r"testosteron\w*", r"estradiol", r"estrogen\w*", r"progesteron\w*",
+        r"bloqueador\w*", r"ciproterona", r"espironolactona", r"\bdeposteron\w*",
+    ],
+    "PREVENCAO_IST": [
+        r"\bists?\b", r"\bdsts?\b", r"\bprep\b", r"\bpep\b", r"\bhiv\b", r"\baids\b", r"sifilis", r"hepatite\w*",
+        r"testagem", r"teste rapido", r"preservativ\w*", r"camisinha\w*", r"saude sexual", r"infecc\w+ sexual\w*",
+    ],
+}
+_RE_PALAVRAS_CHAVE = {
+    intent: [re.compile(padrao) for padrao in padroes] for intent, padroes in _PALAVRAS_CHAVE.items()
+}
+
+
+def _preparar(texto: str) -> str:
+    return re.sub(r"\s+", " ", normalizar(texto)).strip()
+
+
+def chave_cache(texto: str) -> str:
+    """Texto sem caixa, acentos, pontuação e espaços repetidos ("Olá!!" == "ola")."""
+    return " ".join(re.findall(r"\w+", normalizar(texto)))
+
+
+def classificar_por_regras(texto: str) -> Optional[ResultadoIntencao]:
+    """
+    Aplica as regras do prompt de classificação.
+    Retorna None quando nenhuma regra decide (ou quando temas diferentes empatam).
+    """
+    normalizado = _preparar(texto)
+    if not normalizado:
+        return ResultadoIntencao("NAO_ENTENDIDO", "regras", 0.9)
+
+    if _RE_SO_SAUDACAO.match(normalizado):
+        return ResultadoIntencao("BOAS_VINDAS", "regras", 0.99)
+    if _RE_SO_DESPEDIDA.match(normalizado):
+        return ResultadoIntencao("DESPEDIDA", "regras", 0.99)
+
+    # Saudação/despedida + pedido: vale o pedido (regra do prompt)
+    acertos = {
+        intent: sum(1 for regex in regexes if regex.search(normalizado))
+        for intent, regexes in _RE_PALAVRAS_CHAVE.items()
+    }
+    temas = [intent for intent, n in acertos.items() if n]
+    if len(temas) != 1:
+        return None
+
+    intent = temas[0]
+    return ResultadoIntencao(intent, "regras", 0.97 if acertos[intent] > 1 else 0.9)
+
+
+# ---------------------------------------------------------------------------
+# Etapa 2: modelo local de n-gramas de caracteres
+# ---------------------------------------------------------------------------
+
+def _ngramas(texto: str, tamanhos=(2, 3, 4)) -> List[str]:
+    marcado = f" {_preparar(texto)} "
+    return [marcado[i:i + n] for n in tamanhos for i in range(len(marcado) - n + 1)]
+
+
+class NgramIntentModel:
+    """
+    Naive Bayes multinomial sobre n-gramas de caracteres (2 a 4).
+
+    A verossimilhança é normalizada pelo número de n-gramas e multiplicada
+    por `escala`: sem isso, o Naive Bayes dá probabilidades próximas de 1
+    mesmo quando erra, e o limiar de confiança perde o sentido.
+    """
+
+    def __init__(
+        self,
+        contagens: Dict[str, Dict[str, int]],
+        documentos: Dict[str, int],
+        alpha: float = 0.5,
+        escala: float = 4.0,
+    ):
+        self.contagens = contagens
+        self.documentos = documentos
+        self.alpha = alpha
+        self.escala = escala
+        vocabulario = set()
+        for por_ngrama in contagens.values():
+            vocabulario.update(por_ngrama)
+        self._tamanho_vocabulario = max(1, len(vocabulario))
+        self._totais = {intent: sum(c.values()) for intent, c in contagens.items()}
+        total_docs = sum(documentos.values()) or 1
+        self._log_priori = {intent: math.log(n / total_docs) for intent, n in documentos.items() if n}
+
+    @classmethod
+    def treinar(cls, exemplos: Iterable[Tuple[str, str]], alpha: float = 0.5) -> "NgramIntentModel":
+        contagens: Dict[str, Counter] = defaultdict(Counter)
+        documentos: Counter = Counter()
+        for texto, intent in exemplos:
+            if intent not in ALLOWED_INTENTS:
+                continue
+            contagens[intent].update(_ngramas(texto))
+            documentos[intent] += 1
+        return cls({i: dict(c) for i, c in contagens.items()}, dict(documentos), alpha)
+
+    def prever(self, texto: str) -> Tuple[str, float]:
+        """Retorna a intenção mais provável e sua probabilidade a posteriori."""
+        ngramas = Counter(_ngramas(texto))
+        quantidade = sum(ngramas.values()) or 1
+        log_probs = {}
+        for intent, log_priori in self._log_priori.items():
+            por_ngrama = self.contagens.get(intent, {})
+            denominador = self._totais.get(intent, 0) + self.alpha * self._tamanho_vocabulario
+            verossimilhanca = sum(
+                n * math.log((por_ngrama.get(g, 0) + self.alpha) / denominador) for g, n in ngramas.items()
+            )
+            log_probs[intent] = log_priori + self.escala * verossimilhanca / quantidade
+
+        maximo = max(log_probs.values())
+        normalizador = sum(math.exp(v - maximo) for v in log_probs.values())
+        intent = max(log_probs, key=log_probs.get)
+        return intent, 1.0 / normalizador
+
+    def salvar(self, caminho: str):
+        Path(caminho).write_text(
+            json.dumps(
+                {"alpha": self.alpha, "escala": self.escala, "documentos": self.documentos, "contagens": self.contagens},
+                ensure_ascii=False,
+            ),
+            encoding="utf-8",
+        )
+
+    @classmethod
+    def carregar(cls, caminho: str) -> Optional["NgramIntentModel"]:
+        try:
+            dados = json.loads(Path(caminho).read_text(encoding="utf-8"))
+            return cls(dados["contagens"], dados["documentos"], dados.get("alpha", 0.5), dados.get("escala", 4.0))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Erro ao carregar modelo de intenção {caminho}: {e}")
+            return None
+
+
+# ---------------------------------------------------------------------------
+# Orquestração
+# ---------------------------------------------------------------------------
+
+class IntentClassifier:
+    """
+    Regras → modelo local → LLM, parando na primeira etapa confiante. O cache
+    das respostas do LLM é o compartilhado entre processos (shared_cache.py).
+    """
+
+    def __init__(
+        self,
+        limiar: float = INTENT_FAST_PATH_THRESHOLD,
+        modelo: Optional[NgramIntentModel] = None,
+        caminho_log: Optional[str] = INTENT_LOG_PATH,
+        cache: Optional[TTLCache] = None,
+        async_client=None,
+    ):
+        self.async_client = async_client
+        self.limiar = limiar
+        self.modelo = modelo
+        self.caminho_log = caminho_log
+        self.cache = cache
+        self._log_lock = threading.Lock()
+
+    def classificar_local(self, texto: str) -> Optional[ResultadoIntencao]:
+        """Etapas locais; None se nenhuma atingir o limiar de confiança."""
+        resultado = classificar_por_regras(texto)
+        if resultado and resultado.confianca >= self.limiar:
+            return resultado
+
+        if self.modelo is not None:
+            intent, confianca = self.modelo.prever(texto)
+            if confianca >= self.limiar:
+                return ResultadoIntencao(intent, "modelo_local", round(confianca, 4))
+
+        return None
+
+    def _chave(self, texto: str) -> Optional[tuple]:
+        chave = chave_cache(texto)
+        return (versao_prompt_intencao(), chave) if chave else None
+
+    async def buscar_cache_async(self, texto: str) -> Optional[ResultadoIntencao]:
+        chave = self._chave(texto) if self.cache is not None else None
+        if chave is None:
+            return None
+        intent = await self.cache.obter(chave)
+        return ResultadoIntencao(intent, "cache") if intent else None
+
+    async def classificar_async(self, texto: str) -> ResultadoIntencao:
+        resultado = self.classificar_local(texto) or await self.buscar_cache_async(texto)
+        if resultado:
+            return resultado
+        return await self._classificar_llm_async(texto)
+
+    async def classificar_lote_async(
+        self, textos: List[str], max_concorrencia: int = INTENT_BATCH_CONCURRENCY
+    ) -> List[Union[ResultadoIntencao, Exception]]:
+        """
+        Classifica vários textos, na ordem de entrada.
+
+        Textos com a mesma chave normalizada são classificados uma única vez;
+        os que não se resolvem localmente nem no cache vão ao LLM em paralelo
+        (no máximo `max_concorrencia` chamadas simultâneas). Uma falha do LLM
+        vira a exceção na posição do texto, sem derrubar o restante do lote.
+        """
+        grupos: Dict[str, List[int]] = defaultdict(list)
+        for i, texto in enumerate(textos):
+            grupos[chave_cache(texto) or texto].append(i)
+
+        semaforo = asyncio.Semaphore(max(1, max_concorrencia))
+
+        async def classificar_grupo(texto: str) -> Union[ResultadoIntencao, Exception]:
+            resultado = self.classificar_local(texto) or await self.buscar_cache_async(texto)
+            if resultado:
+                return resultado
+            try:
+                async with semaforo:
+                    return await self._classificar_llm_async(texto)
+            except Exception as e:
+                logger.error(f"Erro ao classificar intenção em lote: {e}")
+                return e
+
+        chaves = list(grupos)
+        por_chave = dict(zip(chaves, await asyncio.gather(
+            *(classificar_grupo(textos[grupos[chave][0]]) for chave in chaves)
+        )))
+
+        resultados: List[Union[ResultadoIntencao, Exception]] = [None] * len(textos)
+        for chave, indices in grupos.items():
+            for i in indices:
+                resultados[i] = por_chave[chave]
+        return resultados
+
+    async def _classificar_llm_async(self, texto: str) -> ResultadoIntencao:
+        intent = await classificar_com_llm_async(self.async_client, texto)
+        self._registrar(texto, intent)
+        chave = self._chave(texto) if self.cache is not None else None
+        if chave is not None:
+            await self.cache.guardar(chave, intent)
+        return ResultadoIntencao(intent, "llm")
+
+    def _registrar(self, texto: str, intent: str):
+        """Guarda a decisão do LLM como exemplo de treino para o modelo local."""
+        if not self.caminho_log:
+            return
+        try:
+            linha = json.dumps({"text": texto, "intent": intent}, ensure_ascii=False)
+            with self._log_lock, open(self.caminho_log, "a", encoding="utf-8") as arquivo:
+                arquivo.write(linha + "\n")
+        except Exception as e:
+            logger.error(f"Erro ao registrar intenção: {e}")
+
+
+def carregar_exemplos(caminho: str) -> List[Tuple[str, str]]:
+    """Lê exemplos rotulados de um .jsonl com campos `text` e `intent`."""
+    exemplos = []
+    with open(caminho, encoding="utf-8") as arquivo:
+        for linha in arquivo:
+            if linha.strip():
+                item = json.loads(linha)
+                exemplos.append((item["text"], item["intent"]))
+    return exemplos
+
+
+def _treinar_cli(argv: List[str]):
+    if len(argv) < 1:
+        print("Uso: python intent_classifier.py treinar <exemplos.jsonl> [saida.json]")
+        sys.exit(1)
+    exemplos = carregar_exemplos(argv[0])
+    saida = argv[1] if len(argv) > 1 else INTENT_NGRAM_MODEL_PATH
+    modelo = NgramIntentModel.treinar(exemplos)
+    modelo.salvar(saida)
+    print(f"Modelo treinado com {len(exemplos)} exemplos: {dict(Counter(i for _, i in exemplos))}")
+    print(f"Salvo em {saida}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "treinar":
+        _treinar_cli(sys.argv[2:])
+    else:
+        print(__doc__)
@@ -0,0 +1,159 @@
+"""
+Intenções reconhecidas pelo chatbot e classificação de mensagens.
+
+Também define quais artigos da base pertencem a cada intenção, pelo
+front-matter do markdown (`intents:` ou `tags:`) ou pelo nome do arquivo.
+"""
+
+import hashlib
+import json
+import re
+from typing import Set
+
+from textnorm import normalizar
+
+ALLOWED_INTENTS = {
+    "RETIFICACAO_NOME",
+    "HORMONIZACAO",
+    "PREVENCAO_IST",
+    "DESPEDIDA",
+    "BOAS_VINDAS",
+    "NAO_ENTENDIDO",
+    "OUTROS",
+}
+
+# Intenções com artigos próprios na base de conhecimento
+INTENCOES_COM_ARTIGOS = ("RETIFICACAO_NOME", "HORMONIZACAO", "PREVENCAO_IST")
+# Intenções que não precisam de artigos (saudação e despedida)
+INTENCOES_SEM_ARTIGOS = ("BOAS_VINDAS", "DESPEDIDA")
+
+PROMPT_INTENT_CLASSIFICATION = """
+Você é um classificador de intenção para um chatbot acolhedor voltado para pessoas trans, focado em orientar sobre retificação de nome, acesso à hormonização e prevenção a ISTs.
+
+Sua tarefa é analisar a mensagem do usuário e identificar qual intenção ela representa, escolhendo apenas UMA das categorias abaixo:
+
+INTENÇÕES DISPONÍVEIS:
+- RETIFICACAO_NOME
+- HORMONIZACAO
+- PREVENCAO_IST
+- DESPEDIDA
+- BOAS_VINDAS
+- OUTROS
+- NAO_ENTENDIDO  (use se a mensagem for vaga ou não se encaixar em nenhuma das categorias acima)
+
+Regras importantes:
+
+• RETIFICACAO_NOME: menções a retificação/troca de nome, certidão, RG, registro civil, cartório, Defensoria Pública, alteração de gênero em documentos.
+• HORMONIZACAO: menções a hormonização (HRT), hormônios, acompanhamento médico, ambulatório trans, endocrinologista, consultas relacionadas à hormonização.
+• PREVENCAO_IST: menções a prevenção a IST, testagem, PEP, PrEP, preservativos, saúde sexual, acompanhamento sexual seguro.
+• DESPEDIDA: apenas encerramento (“obrigado”, “valeu”, “até mais”, “tchau”, “só isso”). Se houver despedida + pedido, ignore a despedida e classifique pelo pedido.
+• BOAS_VINDAS: apenas saudação (“oi”, “olá”, “boa tarde”, “e aí”). Se houver saudação + pergunta, ignore a saudação e classifique pela pergunta.
+• NAO_ENTENDIDO: quando a intenção da mensagem não ficar claro.
+• OUTROS: quando a mensagem for sobre temas que tanganciem o escopo principal, como dúvidas sobre outros assuntos não abordados nessas intenções.
+
+FORMATO DE SAÍDA (OBRIGATÓRIO):
+Responda exatamente em JSON, sem crases e sem texto extra:
+{"intent":"<UMA_DAS_INTENCOES_EM_MAIUSCULAS>"}
+""".strip()
+
+# Prefixos de palavras do nome do arquivo que indicam a intenção do artigo
+_PREFIXOS_ARQUIVO = {
+    "RETIFICACAO_NOME": ("retific", "nome", "registro", "cartorio", "documento", "certidao"),
+    "HORMONIZACAO": ("hormon", "hrt", "endocrin", "ambulatorio"),
+    "PREVENCAO_IST": ("ist", "prep", "pep", "prevenc", "hiv", "testagem", "sexual"),
+}
+
+_RE_FRONT_MATTER = re.compile(r"\A---\s*\n(.*?)\n---\s*(\n|\Z)", re.DOTALL)
+_RE_CAMPO_INTENCOES = re.compile(r"^(intents|intencoes|tags)\s*:\s*(.*)$", re.IGNORECASE)
+
+
+def versao_prompt_intencao() -> str:
+    """
+    Identifica o prompt de classificação e o conjunto de intenções aceitas.
+    Resultados guardados em cache com outra versão deixam de valer.
+    """
+    base = PROMPT_INTENT_CLASSIFICATION + "\n" + ",".join(sorted(ALLOWED_INTENTS))
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()[:16]
+
+
+def _mensagens_classificacao(texto: str) -> list:
+    return [
+        {"role": "system", "content": PROMPT_INTENT_CLASSIFICATION},
+        {"role": "user", "content": f"Mensagem do usuário:{texto}"},
+    ]
+
+
+def _interpretar_classificacao(raw_text: str) -> str:
+    raw_text = raw_text.strip().strip("`").strip()
+    data = json.loads(raw_text)
+
+    intent = str(data.get("intent", "")).strip().upper()
+    if intent not in ALLOWED_INTENTS:
+        intent = "NAO_ENTENDIDO"
+    return intent
+
+
+def classificar_com_llm(client, texto: str) -> str:
+    """Classifica a mensagem com o gpt-4o-mini. Lança exceção se a chamada falhar."""
+    resp = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=_mensagens_classificacao(texto),
+        temperature=0.3
+    )
+    return _interpretar_classificacao(resp.choices[0].message.content)
+
+
+async def classificar_com_llm_async(client, texto: str) -> str:
+    """Versão de `classificar_com_llm` para o AsyncOpenAI."""
+    resp = await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=_mensagens_classificacao(texto),
+        temperature=0.3
+    )
+    return _interpretar_classificacao(resp.choices[0].message.content)
+
+
+def _normalizar_intencao(valor: str) -> str:
+    return re.sub(r"[^A-Z_]", "", normalizar(valor).upper().replace("-", "_").replace(" ", "_"))
+
+
+def _intencoes_front_matter(conteudo: str) -> Set[str]:
+    match = _RE_FRONT_MATTER.match(conteudo)
+    if not match:
+        return set()
+
+    valores = []
+    linhas = match.group(1).splitlines()
+    for i, linha in enumerate(linhas):
+        campo = _RE_CAMPO_INTENCOES.match(linha.strip())
+        if not campo:
+            continue
+        inline = campo.group(2).strip()
+        if inline:
+            # intents: [HORMONIZACAO, PREVENCAO_IST]  ou  intents: HORMONIZACAO
+            valores.extend(v.strip(" '\"") for v in inline.strip("[]").split(","))
+        else:
+            # intents:
+            #   - HORMONIZACAO
+            for item in linhas[i + 1:]:
+                if not item.strip().startswith("-"):
+                    break
+                valores.append(item.strip()[1:].strip(" '\""))
+
+    return {v for v in map(_normalizar_intencao, valores) if v in INTENCOES_COM_ARTIGOS}
+
+
+def intencoes_do_artigo(nome: str, conteudo: str) -> Set[str]:
+    """
+    Intenções às quais um artigo pertence.
+    O front-matter tem prioridade; sem ele, usa as palavras do nome do arquivo.
+    """
+    intencoes = _intencoes_front_matter(conteudo)
+    if intencoes:
+        return intencoes
+
+    palavras = re.findall(r"[a-z0-9]+", normalizar(nome.rsplit(".", 1)[0]))
+    return {
+        intent for intent, prefixos in _PREFIXOS_ARQUIVO.items()
+        if any(p.startswith(prefixo) for p in palavras for prefixo in prefixos)
+    }
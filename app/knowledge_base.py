@@ -0,0 +1,257 @@
+"""
+Cache em memória da base de conhecimento (arquivos .md do bucket Supabase).
+
+Mantém o último snapshot válido do contexto concatenado junto com uma versão
+calculada a partir da listagem do bucket (nome, tamanho e updated_at de cada
+arquivo). As requisições sempre recebem o snapshot em memória; quando o TTL
+expira, uma thread em segundo plano lista o bucket e só baixa os arquivos de
+novo se a versão tiver mudado.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Intervalo (em segundos) entre verificações de versão do bucket
+KB_CACHE_TTL_SECONDS = float(os.getenv("KB_CACHE_TTL_SECONDS", "300"))
+# Número máximo de downloads simultâneos ao (re)construir a base
+KB_DOWNLOAD_CONCURRENCY = int(os.getenv("KB_DOWNLOAD_CONCURRENCY", "8"))
+
+
+@dataclass(frozen=True)
+class ArquivoCarregado:
+    """Resultado do download de um arquivo do bucket."""
+    nome: str
+    conteudo: Optional[str]
+    duracao_ms: float
+    erro: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class RelatorioCarga:
+    """Resultado de uma carga completa, na mesma ordem da listagem."""
+    arquivos: Tuple[ArquivoCarregado, ...]
+    duracao_ms: float
+
+    @property
+    def artigos(self) -> Tuple[Tuple[str, str], ...]:
+        return tuple((a.nome, a.conteudo) for a in self.arquivos if a.erro is None)
+
+    @property
+    def erros(self) -> Dict[str, str]:
+        return {a.nome: a.erro for a in self.arquivos if a.erro is not None}
+
+    @property
+    def tempos_ms(self) -> Dict[str, float]:
+        return {a.nome: a.duracao_ms for a in self.arquivos}
+
+
+@dataclass(frozen=True)
+class KnowledgeBaseSnapshot:
+    """Conteúdo da base de conhecimento em um determinado momento."""
+    versao: str
+    contexto: str
+    artigos: Tuple[Tuple[str, str], ...]  # (nome do arquivo, conteúdo)
+    construido_em: datetime
+    erros: Dict[str, str] = field(default_factory=dict)
+    tempos_ms: Dict[str, float] = field(default_factory=dict)
+    duracao_carga_ms: float = 0.0
+
+    @property
+    def arquivos(self) -> List[str]:
+        return [nome for nome, _ in self.artigos]
+
+    @property
+    def completo(self) -> bool:
+        return not self.erros
+
+
+def formatar_artigo(file_name: str, conteudo: str) -> str:
+    """Formata um artigo com o cabeçalho usado no contexto concatenado."""
+    return (
+        f"\n\n{'='*50}\n"
+        f"CONTEÚDO DO ARQUIVO: {file_name}\n"
+        f"{'='*50}\n\n"
+        f"{conteudo}"
+    )
+
+
+def listar_artigos(files: List[dict]) -> List[dict]:
+    """Filtra a listagem do bucket mantendo apenas os arquivos .md."""
+    return [f for f in files if f.get('name', '').lower().endswith('.md')]
+
+
+def concatenar_artigos(artigos) -> str:
+    """Concatena os artigos (nome, conteúdo) no formato usado no prompt."""
+    return "".join(formatar_artigo(nome, conteudo) for nome, conteudo in artigos)
+
+
+def _baixar_arquivo(bucket, file_name: str) -> ArquivoCarregado:
+    inicio = time.perf_counter()
+    try:
+        conteudo = bucket.download(file_name).decode('utf-8')
+        return ArquivoCarregado(file_name, conteudo, (time.perf_counter() - inicio) * 1000)
+    except Exception as e:
+        logger.error(f"Erro ao processar arquivo {file_name}: {e}")
+        return ArquivoCarregado(file_name, None, (time.perf_counter() - inicio) * 1000, str(e))
+
+
+def baixar_artigos(bucket, file_names: List[str], max_workers: int = KB_DOWNLOAD_CONCURRENCY) -> RelatorioCarga:
+    """
+    Baixa os arquivos do bucket em paralelo, com no máximo `max_workers`
+    downloads simultâneos. O resultado mantém a ordem de `file_names`,
+    com o tempo de cada download e os erros por arquivo.
+    """
+    inicio = time.perf_counter()
+    if not file_names:
+        return RelatorioCarga((), 0.0)
+
+    workers = max(1, min(max_workers, len(file_names)))
+    if workers == 1:
+        arquivos = [_baixar_arquivo(bucket, nome) for nome in file_names]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kb-download") as executor:
+            arquivos = list(executor.map(lambda nome: _baixar_arquivo(bucket, nome), file_names))
+
+    return RelatorioCarga(tuple(arquivos), (time.perf_counter() - inicio) * 1000)
+
+
+def calcular_versao(files: List[dict]) -> str:
+    """
+    Calcula a versão da base a partir da listagem do bucket.
+    Usa nome, tamanho e updated_at de cada arquivo .md.
+    """
+    partes = []
+    for file in sorted(listar_artigos(files), key=lambda f: f.get('name', '')):
+        metadata = file.get('metadata') or {}
+        partes.append(f"{file.get('name')}|{metadata.get('size', '')}|{file.get('updated_at', '')}")
+    return hashlib.sha256("\n".join(partes).encode('utf-8')).hexdigest()[:16]
+
+
+class KnowledgeBaseCache:
+    """
+    Cache versionado da base de conhecimento.
+
+    `bucket_factory` deve retornar o objeto de storage do bucket
+    (ex.: `lambda: supabase.storage.from_(SUPABASE_BUCKET)`).
+    """
+
+    def __init__(
+        self,
+        bucket_factory: Callable,
+        ttl: float = KB_CACHE_TTL_SECONDS,
+        max_workers: int = KB_DOWNLOAD_CONCURRENCY,
+    ):
+        self._bucket_factory = bucket_factory
+        self._ttl = ttl
+        self._max_workers = max_workers
+        self._snapshot: Optional[KnowledgeBaseSnapshot] = None
+        self._verificado_em: Optional[datetime] = None
+        self._verificado_monotonic = 0.0
+        self._lock = threading.Lock()  # serializa as atualizações
+        self._flag_lock = threading.Lock()
+        self._refresh_em_andamento = False
+
+    @property
+    def verificado_em(self) -> Optional[datetime]:
+        """Momento da última verificação bem-sucedida da versão do bucket."""
+        return self._verificado_em
+
+    def get_snapshot(self) -> Optional[KnowledgeBaseSnapshot]:
+        """
+        Retorna o último snapshot válido.
+        No primeiro acesso carrega de forma síncrona; depois disso,
+        snapshots expirados são atualizados em segundo plano.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.refresh()
+
+        if time.monotonic() - self._verificado_monotonic >= self._ttl:
+            self._refresh_em_background()
+
+        return snapshot
+
+    def get_contexto(self) -> str:
+        snapshot = self.get_snapshot()
+        return snapshot.contexto if snapshot else ""
+
+    def refresh(self, force: bool = False) -> Optional[KnowledgeBaseSnapshot]:
+        """
+        Lista o bucket e reconstrói o snapshot se a versão mudou
+        (ou se o snapshot atual estiver incompleto ou `force=True`).
+        Em caso de erro, mantém o snapshot anterior.
+        """
+        with self._lock:
+            atual = self._snapshot
+            try:
+                bucket = self._bucket_factory()
+                files = bucket.list()
+                versao = calcular_versao(files)
+
+                if not force and atual is not None and atual.versao == versao and atual.completo:
+                    self._marcar_verificado()
+                    return atual
+
+                novo = self._construir(bucket, files, versao)
+                if not novo.contexto and atual is not None:
+                    logger.error("Base de conhecimento vazia após atualização; mantendo a versão %s", atual.versao)
+                    return atual
+
+                self._snapshot = novo
+                self._marcar_verificado()
+                logger.info(
+                    "Base de conhecimento atualizada: versão %s, %d artigos",
+                    novo.versao, len(novo.artigos)
+                )
+                return novo
+
+            except Exception as e:
+                logger.error(f"Erro ao atualizar a base de conhecimento: {e}")
+                return atual
+
+    def _construir(self, bucket, files: List[dict], versao: str) -> KnowledgeBaseSnapshot:
+        nomes = [file.get('name', '') for file in listar_artigos(files)]
+        relatorio = baixar_artigos(bucket, nomes, self._max_workers)
+
+        logger.info(
+            "Carga da base: %d arquivos em %.0f ms (%d erros)",
+            len(nomes), relatorio.duracao_ms, len(relatorio.erros)
+        )
+
+        return KnowledgeBaseSnapshot(
+            versao=versao,
+            contexto=concatenar_artigos(relatorio.artigos),
+            artigos=relatorio.artigos,
+            construido_em=datetime.now(),
+            erros=relatorio.erros,
+            tempos_ms=relatorio.tempos_ms,
+            duracao_carga_ms=relatorio.duracao_ms,
+        )
+
+    def _marcar_verificado(self):
+        self._verificado_em = datetime.now()
+        self._verificado_monotonic = time.monotonic()
+
+    def _refresh_em_background(self):
+        with self._flag_lock:
+            if self._refresh_em_andamento:
+                return
+            self._refresh_em_andamento = True
+
+        def _run():
+            try:
+                self.refresh()
+            finally:
+                with self._flag_lock:
+                    self._refresh_em_andamento = False
+
+        threading.Thread(target=_run, name="kb-refresh", daemon=True).start()
@@ -1,13 +1,16 @@
-from fastapi import FastAPI, HTTPException, Header
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from typing import Literal, Optional, List
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import json
 import os
+import time
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import create_client, acreate_client, AsyncClient, Client
 from pathlib import Path
-from datetime import datetime
+from telegram import Update
 
 # Carrega o .env do diretório raiz do projeto
 env_path = Path(__file__).parent.parent / '.env'
@@ -16,8 +19,54 @@ load_dotenv(dotenv_path=env_path, override=True)  # override=True força sobresc
 from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware  # 👈 importa aqui
 from pydantic import BaseModel
+# Módulos do projeto leem a configuração do ambiente ao serem importados,
+# então vêm depois do load_dotenv
+from metrics import metrics
+from intent_classifier import INTENT_BATCH_MAX_ITEMS
+from history import codificar_cursor
+from prompts import tokens_em_cache
+from chat_engine import BaseIndisponivel, ChatEngine, ChatPreparado
+from idempotency import IDEMPOTENCY_KEY_MAX_LENGTH, ChaveReutilizada, IdempotencyCache, impressao
+import telegram_bot
 
-app = FastAPI()
+# Supabase client
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
+# Cliente síncrono: usado pelo cache da base de conhecimento (threads próprias)
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Cliente assíncrono: usado pelas rotas de chat; criado no startup
+supabase_async: Optional[AsyncClient] = None
+
+# Bot do Telegram por webhook, no mesmo processo da API (opcional).
+# Sem TELEGRAM_WEBHOOK_URL, o bot pode rodar à parte com `python app/telegram_bot.py`.
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")  # ex.: https://api.exemplo.org/telegram/webhook
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+telegram_app = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global supabase_async, telegram_app
+    supabase_async = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    await engine.iniciar(supabase_async)
+    if TELEGRAM_BOT_TOKEN and TELEGRAM_WEBHOOK_URL:
+        telegram_app = telegram_bot.criar_aplicacao(engine, TELEGRAM_BOT_TOKEN, webhook=True)
+        await telegram_app.initialize()
+        await telegram_app.start()
+        await telegram_app.bot.set_webhook(
+            TELEGRAM_WEBHOOK_URL, secret_token=TELEGRAM_WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES
+        )
+        print(f"🤖 Bot do Telegram recebendo updates em {TELEGRAM_WEBHOOK_URL}")
+    yield
+    if telegram_app:
+        await telegram_app.stop()
+        await telegram_bot.parar_sessoes(telegram_app)
+        await telegram_app.shutdown()
+    await engine.parar()
+    await supabase_async.postgrest.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:5173",
@@ -34,80 +83,63 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Supabase client
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
 class Message(BaseModel):
     content: str
 
+IntentLiteral = Literal[
+    "RETIFICACAO_NOME",
+    "HORMONIZACAO",
+    "PREVENCAO_IST",
+    "DESPEDIDA",
+    "BOAS_VINDAS",
+    "NAO_ENTENDIDO",
+    "OUTROS",
+]
+
 class ChatRequest(BaseModel):
     message: str
     user_id: Optional[int] = None  # ID do usuário logado (opcional para compatibilidade)
     session_id: Optional[str] = None  # ID da sessão para usuários não logados
+    intent: Optional[IntentLiteral] = None  # Intenção já classificada pelo frontend (evita reclassificar)
+    idempotency_key: Optional[str] = None  # Alternativa ao header Idempotency-Key
 
 class ChatResponse(BaseModel):
     response: str
     contexto_utilizado: bool
     chat_id: Optional[int] = None  # ID do chat criado/usado
     historico_usado: bool = False  # Indica se usou histórico anterior
-
-IntentLiteral = Literal[
-    "RETIFICACAO_NOME",
-    "HORMONIZACAO",
-    "PREVENCAO_IST",
-    "DESPEDIDA",
-    "BOAS_VINDAS",
-    "NAO_ENTENDIDO",
-    "OUTROS",
-]
+    intent: Optional[IntentLiteral] = None  # Intenção usada para escolher o contexto
 
 class IntentResponse(BaseModel):
     intent: IntentLiteral
+    etapa: Literal["regras", "modelo_local", "cache", "llm"]  # Etapa que decidiu a intenção
+    confianca: Optional[float] = None  # Confiança da etapa local (ausente quando decidido pelo LLM)
 
-ALLOWED_INTENTS = {
-    "RETIFICACAO_NOME",
-    "HORMONIZACAO",
-    "PREVENCAO_IST",
-    "DESPEDIDA",
-    "BOAS_VINDAS",
-    "NAO_ENTENDIDO",
-    "OUTROS",
-}
+class BatchIntentRequest(BaseModel):
+    messages: List[str] = Field(..., max_length=INTENT_BATCH_MAX_ITEMS)
 
-PROMPT_INTENT_CLASSIFICATION = """
-Você é um classificador de intenção para um chatbot acolhedor voltado para pessoas trans, focado em orientar sobre retificação de nome, acesso à hormonização e prevenção a ISTs.
+class BatchIntentItem(BaseModel):
+    intent: Optional[IntentLiteral] = None
+    etapa: Optional[Literal["regras", "modelo_local", "cache", "llm"]] = None
+    confianca: Optional[float] = None
+    erro: Optional[str] = None  # Preenchido quando a classificação desta mensagem falhou
 
-Sua tarefa é analisar a mensagem do usuário e identificar qual intenção ela representa, escolhendo apenas UMA das categorias abaixo:
-
-INTENÇÕES DISPONÍVEIS:
-- RETIFICACAO_NOME
-- HORMONIZACAO
-- PREVENCAO_IST
-- DESPEDIDA
-- BOAS_VINDAS
-- OUTROS
-- NAO_ENTENDIDO  (use se a mensagem for vaga ou não se encaixar em nenhuma das categorias acima)
-
-Regras importantes:
-
-• RETIFICACAO_NOME: menções a retificação/troca de nome, certidão, RG, registro civil, cartório, Defensoria Pública, alteração de gênero em documentos.
-• HORMONIZACAO: menções a hormonização (HRT), hormônios, acompanhamento médico, ambulatório trans, endocrinologista, consultas relacionadas à hormonização.
-• PREVENCAO_IST: menções a prevenção a IST, testagem, PEP, PrEP, preservativos, saúde sexual, acompanhamento sexual seguro.
-• DESPEDIDA: apenas encerramento (“obrigado”, “valeu”, “até mais”, “tchau”, “só isso”). Se houver despedida + pedido, ignore a despedida e classifique pelo pedido.
-• BOAS_VINDAS: apenas saudação (“oi”, “olá”, “boa tarde”, “e aí”). Se houver saudação + pergunta, ignore a saudação e classifique pela pergunta.
-• NAO_ENTENDIDO: quando a intenção da mensagem não ficar claro.
-• OUTROS: quando a mensagem for sobre temas que tanganciem o escopo principal, como dúvidas sobre outros assuntos não abordados nessas intenções.
-
-FORMATO DE SAÍDA (OBRIGATÓRIO):
-Responda exatamente em JSON, sem crases e sem texto extra:
-{"intent":"<UMA_DAS_INTENCOES_EM_MAIUSCULAS>"}
-""".strip()
+class BatchIntentResponse(BaseModel):
+    resultados: List[BatchIntentItem]  # Na mesma ordem de `messages`
+    total: int
+    unicas: int  # Mensagens distintas após normalização
+    chamadas_llm: int
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 client = OpenAI(api_key=OPENAI_API_KEY)
+client_async = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Pipeline de chat compartilhado com o bot do Telegram: base de conhecimento,
+# classificador de intenção, caches e gravação das mensagens (ver chat_engine.py)
+engine = ChatEngine(supabase, SUPABASE_BUCKET, client, client_async)
+# Respostas do /chat por Idempotency-Key (repetições não chamam a OpenAI de novo)
+idempotencia = IdempotencyCache(caches=engine.caches)
+metrics.gauge("idempotencia", idempotencia.stats)
 
 # Debug: verifica se as variáveis foram carregadas
 print("\n" + "="*80)
@@ -119,420 +151,336 @@ print(f"✅ SUPABASE_BUCKET: {SUPABASE_BUCKET}" if SUPABASE_BUCKET else "❌ SUP
 print("="*80 + "\n")
 
 @app.post("/classify_intent", response_model=IntentResponse)
-def classify_intent(message: Message):
+async def classify_intent(message: Message):
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": PROMPT_INTENT_CLASSIFICATION},
-                {"role": "user", "content": f"Mensagem do usuário:{message.content}"},
-            ],
-            temperature=0.3
-        )
-
-        raw_text = resp.choices[0].message.content
-        raw_text = raw_text.strip().strip("`").strip()
-        data = json.loads(raw_text)
-
-        intent = str(data.get("intent", "")).strip().upper()
-        if intent not in ALLOWED_INTENTS:
-            intent = "NAO_ENTENDIDO"
-
-        return {"intent": intent}
+        resultado = await engine.intent_classifier.classificar_async(message.content)
+        metrics.incr(f"intent_etapa.{resultado.etapa}")
+        return {"intent": resultado.intent, "etapa": resultado.etapa, "confianca": resultado.confianca}
 
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Falha ao classificar a intenção: {e}")
 
+@app.post("/classify_intent/batch", response_model=BatchIntentResponse)
+async def classify_intent_batch(request: BatchIntentRequest):
+    """
+    Classifica uma lista de mensagens. Repetidas são classificadas uma vez;
+    regras, modelo local e cache respondem primeiro, e o restante vai ao LLM
+    em paralelo. Falhas são reportadas por item em `erro`.
+    """
+    resultados = await engine.intent_classifier.classificar_lote_async(request.messages)
+
+    itens = []
+    vistos = set()
+    chamadas_llm = 0
+    for resultado in resultados:
+        falhou = isinstance(resultado, Exception)
+        # Mensagens repetidas compartilham o mesmo objeto de resultado
+        if id(resultado) not in vistos:
+            vistos.add(id(resultado))
+            metrics.incr("intent_lote_erros" if falhou else f"intent_etapa.{resultado.etapa}")
+            chamadas_llm += falhou or resultado.etapa == "llm"
+        if falhou:
+            itens.append({"erro": str(resultado)})
+        else:
+            itens.append({"intent": resultado.intent, "etapa": resultado.etapa, "confianca": resultado.confianca})
+
+    return {
+        "resultados": itens,
+        "total": len(itens),
+        "unicas": len(vistos),
+        "chamadas_llm": chamadas_llm,
+    }
+
 @app.get("/concatenate_artigos")
-def concatenate_artigos():
+def concatenate_artigos(refresh: bool = False):
     """
-    Busca todos os documentos .md do bucket knowledge-base
-    e concatena o conteúdo de todos eles.
+    Retorna todos os documentos .md do bucket knowledge-base concatenados,
+    a partir do cache da base de conhecimento.
+    Use `refresh=true` para forçar a releitura do bucket.
     """
     try:
-        # Lista todos os arquivos do bucket
-        files = supabase.storage.from_(SUPABASE_BUCKET).list()
-        
-        contexto = ""
-        artigos_encontrados = []
-        
-        # Filtra e processa apenas arquivos .md
-        for file in files:
-            file_name = file.get('name', '')
-            
-            # Verifica se o arquivo termina com .md (case insensitive)
-            if file_name.lower().endswith('.md'):
-                artigos_encontrados.append(file_name)
-                
-                # Faz o download do conteúdo do arquivo
-                try:
-                    response = supabase.storage.from_(SUPABASE_BUCKET).download(file_name)
-                    
-                    # Decodifica o conteúdo (assumindo que são arquivos de texto)
-                    conteudo = response.decode('utf-8')
-                    
-                    # Adiciona ao contexto com separador
-                    contexto += f"\n\n{'='*50}\n"
-                    contexto += f"CONTEÚDO DO ARQUIVO: {file_name}\n"
-                    contexto += f"{'='*50}\n\n"
-                    contexto += conteudo
-                    
-                except Exception as e:
-                    print(f"Erro ao processar arquivo {file_name}: {e}")
-                    contexto += f"\n\n[ERRO ao processar {file_name}: {e}]\n\n"
-        
+        kb_cache = engine.kb_cache
+        snapshot = kb_cache.refresh(force=True) if refresh else kb_cache.get_snapshot()
+        if snapshot is None:
+            raise HTTPException(status_code=500, detail="Não foi possível carregar a base de conhecimento")
+
+        artigos_encontrados = list(snapshot.tempos_ms)
+        contexto = snapshot.contexto
+        for file_name, erro in snapshot.erros.items():
+            contexto += f"\n\n[ERRO ao processar {file_name}: {erro}]\n\n"
+
         # Print no console para verificação
         print("\n" + "="*80)
         print(f"TOTAL DE ARTIGOS ENCONTRADOS: {len(artigos_encontrados)}")
         print(f"ARQUIVOS: {artigos_encontrados}")
+        print(f"VERSÃO DA BASE: {snapshot.versao} (verificada em {kb_cache.verificado_em})")
+        print(f"TEMPO DE CARGA: {snapshot.duracao_carga_ms:.0f} ms")
         print("="*80)
         print("\nCONTEXTO CONCATENADO:")
         print(contexto)
         print("\n" + "="*80)
-        
+
         return {
             "success": True,
             "total_artigos": len(artigos_encontrados),
             "arquivos": artigos_encontrados,
-            "contexto": contexto
+            "contexto": contexto,
+            "versao": snapshot.versao,
+            "construido_em": snapshot.construido_em.isoformat(),
+            "atualizado_em": kb_cache.verificado_em.isoformat() if kb_cache.verificado_em else None,
+            "duracao_carga_ms": round(snapshot.duracao_carga_ms, 1),
+            "tempos_ms": {nome: round(ms, 1) for nome, ms in snapshot.tempos_ms.items()},
+            "erros": snapshot.erros
         }
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao buscar artigos: {str(e)}")
 
 def get_contexto_artigos():
     """
-    Função auxiliar para buscar e concatenar todos os arquivos .md.
-    Retorna o contexto como string.
-    """
-    try:
-        files = supabase.storage.from_(SUPABASE_BUCKET).list()
-        contexto = ""
-        
-        for file in files:
-            file_name = file.get('name', '')
-            
-            if file_name.lower().endswith('.md'):
-                try:
-                    response = supabase.storage.from_(SUPABASE_BUCKET).download(file_name)
-                    conteudo = response.decode('utf-8')
-                    contexto += f"\n\n{'='*50}\n"
-                    contexto += f"CONTEÚDO DO ARQUIVO: {file_name}\n"
-                    contexto += f"{'='*50}\n\n"
-                    contexto += conteudo
-                except Exception as e:
-                    print(f"Erro ao processar arquivo {file_name}: {e}")
-        
-        return contexto
-    except Exception as e:
-        print(f"Erro ao buscar contexto: {e}")
-        return ""
-
-def get_or_create_chat(user_id: Optional[int], session_id: Optional[str]):
-    """
-    Busca ou cria um chat ativo para o usuário ou sessão.
-    Retorna o ID do chat.
+    Função auxiliar que retorna o contexto concatenado de todos os arquivos .md.
+    O conteúdo vem do cache da base de conhecimento, que só é
+    recarregado do bucket quando a versão muda.
     """
-    try:
-        # Se não tiver nem user_id nem session_id, cria um temporário
-        if not user_id and not session_id:
-            session_id = f"temp_{datetime.now().timestamp()}"
-        
-        # Busca um chat ativo existente
-        if user_id:
-            # Verifica se o usuário existe na tabela users
-            user_check = supabase.table('users').select('id').eq('id', user_id).execute()
-            
-            # Se o usuário não existir, usa session_id ao invés
-            if not user_check.data:
-                print(f"⚠️ User ID {user_id} não encontrado, usando session_id")
-                session_id = f"user_{user_id}_temp"
-                user_id = None
-                result = supabase.table('chats').select('id').eq('session_id', session_id).eq('is_active', True).order('created_at', desc=True).limit(1).execute()
-            else:
-                result = supabase.table('chats').select('id').eq('user_id', user_id).eq('is_active', True).order('created_at', desc=True).limit(1).execute()
-        elif session_id:
-            result = supabase.table('chats').select('id').eq('session_id', session_id).eq('is_active', True).order('created_at', desc=True).limit(1).execute()
-        else:
-            result = None
-        
-        # Se encontrou um chat ativo, retorna o ID
-        if result and result.data:
-            return result.data[0]['id']
-        
-        # Caso contrário, cria um novo chat
-        new_chat = {
-            'user_id': user_id,  # Pode ser None
-            'session_id': session_id,
-            'title': 'Nova conversa',
-            'is_active': True,
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
-        }
-        
-        result = supabase.table('chats').insert(new_chat).execute()
-        return result.data[0]['id']
-        
-    except Exception as e:
-        print(f"Erro ao buscar/criar chat: {e}")
-        raise HTTPException(status_code=500, detail=f"Erro ao gerenciar chat: {str(e)}")
+    return engine.kb_cache.get_contexto()
 
-def get_chat_history(chat_id: int, limit: int = 30):
-    """
-    Busca as últimas mensagens de um chat.
-    Retorna lista de mensagens no formato [{"role": "user/assistant", "content": "..."}]
-    """
+async def preparar_chat(request: ChatRequest) -> ChatPreparado:
+    """Prepara o turno no motor de chat (compartilhado por /chat e /chat/stream)."""
     try:
-        result = supabase.table('chat_messages').select('role, content').eq('chat_id', chat_id).order('created_at', desc=False).limit(limit).execute()
-        
-        if not result.data:
-            return []
-        
-        # Converte para o formato esperado pela OpenAI
-        messages = []
-        for msg in result.data:
-            messages.append({
-                "role": msg['role'],
-                "content": msg['content']
-            })
-        
-        return messages
-        
-    except Exception as e:
-        print(f"Erro ao buscar histórico: {e}")
-        return []
+        return await engine.preparar(
+            request.message, user_id=request.user_id, session_id=request.session_id, intent=request.intent
+        )
+    except BaseIndisponivel as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def imprimir_debug_chat(preparo: ChatPreparado, pergunta: str, resposta: str, usage):
+    print("\n" + "="*80)
+    print(f"💬 CHAT ID: {preparo.chat_id}")
+    if preparo.user_name:
+        pronoun_display = f" ({preparo.user_pronoun})" if preparo.user_pronoun else ""
+        print(f"👤 NOME DO USUÁRIO: {preparo.user_name}{pronoun_display}")
+    else:
+        print(f"👤 NOME DO USUÁRIO: Anônimo")
+    resumo_display = ", com resumo" if preparo.compactado.resumo else ""
+    print(f"� HISTÓRICO USADO: {len(preparo.compactado.recentes)} de {len(preparo.historico)} mensagens{resumo_display} ({preparo.compactado.tokens} tokens)")
+    print(f"📚 CONTEXTO: modo {preparo.modo_contexto} (intenção {preparo.intent}), {preparo.trechos_contexto} trechos, {preparo.tokens_contexto} tokens")
+    if usage:
+        print(f"🔢 TOKENS: prompt={usage.prompt_tokens} (em cache: {tokens_em_cache(usage)}), resposta={usage.completion_tokens}")
+    print(f"❓ PERGUNTA DO USUÁRIO: {pergunta}")
+    print(f"🤖 RESPOSTA: {resposta}")
+    print("="*80 + "\n")
+
+async def responder_chat(request: ChatRequest) -> dict:
+    """Um turno completo do /chat: prepara, chama a OpenAI e salva."""
+    preparo = await preparar_chat(request)
+
+    # 8. Primeiro turno: pergunta frequente já respondida? Senão, chama a API do OpenAI
+    resposta = await engine.resposta_frequente(preparo)
+    usage = None
+    if resposta is None:
+        response = await engine.completar(preparo)
+        resposta = response.choices[0].message.content
+        usage = response.usage
+        engine.registrar_metricas(preparo, usage)
+        await engine.guardar_resposta_frequente(preparo, resposta, usage)
 
-def save_message(chat_id: int, role: str, content: str):
-    """
-    Salva uma mensagem no banco de dados.
-    """
-    try:
-        message = {
-            'chat_id': chat_id,
-            'role': role,
-            'content': content,
-            'created_at': datetime.now().isoformat()
-        }
-        
-        supabase.table('chat_messages').insert(message).execute()
-        
-        # Atualiza o timestamp do chat
-        supabase.table('chats').update({'updated_at': datetime.now().isoformat()}).eq('id', chat_id).execute()
-        
-    except Exception as e:
-        print(f"Erro ao salvar mensagem: {e}")
-        # Não lança exceção para não quebrar o fluxo
+    # 9. Salva a mensagem do usuário e a resposta no banco
+    await engine.salvar_turno(preparo, resposta)
 
-def get_user_info(user_id: int) -> Optional[dict]:
-    """
-    Busca as informações do usuário (nome, nome social e pronome) da tabela users.
-    Retorna um dict com 'name', 'social_name' e 'pronoun', ou None se não encontrado.
-    """
-    try:
-        result = supabase.table('users').select('name, social_name, pronoun').eq('id', user_id).single().execute()
-        if result.data:
-            return {
-                'name': result.data.get('name'),
-                'social_name': result.data.get('social_name'),
-                'pronoun': result.data.get('pronoun')
-            }
-        return None
-    except Exception as e:
-        print(f"Erro ao buscar informações do usuário: {e}")
-        return None
+    # Print para debug
+    imprimir_debug_chat(preparo, request.message, resposta, usage)
 
-def get_preferred_name_and_pronoun(user_id: Optional[int]) -> Optional[dict]:
-    """
-    Retorna o nome preferido e pronome do usuário.
-    Prioriza nome social sobre nome.
-    Retorna: {'name': str, 'pronoun': str} ou None
-    """
-    if not user_id:
-        return None
-    
-    user_info = get_user_info(user_id)
-    if not user_info:
-        return None
-    
-    # Prioriza o nome social, se disponível
-    preferred_name = user_info.get('social_name') or user_info.get('name')
-    pronoun = user_info.get('pronoun')
-    
-    if not preferred_name:
-        return None
-    
     return {
-        'name': preferred_name,
-        'pronoun': pronoun if pronoun else None
+        "response": resposta,
+        "contexto_utilizado": True,
+        "chat_id": preparo.chat_id,
+        "historico_usado": len(preparo.historico) > 0,
+        "intent": preparo.intent
     }
 
 @app.post("/chat", response_model=ChatResponse)
-def chat_with_context(request: ChatRequest):
+async def chat_with_context(
+    request: ChatRequest, response: Response, idempotency_key: Optional[str] = Header(None)
+):
     """
     Endpoint para conversar com o ChatGPT usando o contexto dos artigos e histórico de conversas.
     
     O contexto dos artigos é automaticamente adicionado.
     O histórico das últimas 30 mensagens é recuperado do banco de dados.
     Se o usuário estiver autenticado (user_id), busca o nome social ou nome da tabela users.
+
+    Com o header `Idempotency-Key` (ou o campo `idempotency_key`), repetições
+    da mesma requisição recebem a mesma resposta, sem nova chamada à OpenAI
+    nem nova gravação; a resposta repetida vem com `Idempotent-Replayed: true`.
     """
-    try:
-        # 1. Busca ou cria um chat para o usuário/sessão
-        chat_id = get_or_create_chat(request.user_id, request.session_id)
-        
-        # 2. Busca o histórico de mensagens (últimas 30)
-        historico = get_chat_history(chat_id, limit=30)
-        historico_usado = len(historico) > 0
-        
-        # 3. Busca o nome e pronome do usuário (se estiver autenticado)
-        user_info = get_preferred_name_and_pronoun(request.user_id)
-        user_name = user_info.get('name') if user_info else None
-        user_pronoun = user_info.get('pronoun') if user_info else None
-        
-        # 4. Busca o contexto dos artigos
-        contexto = get_contexto_artigos()
-        
-        if not contexto:
-            raise HTTPException(status_code=500, detail="Não foi possível carregar o contexto dos artigos")
-        
-        # 5. Monta o prompt do sistema com divisões claras
-        # Adiciona seção do nome e pronome se disponível
-        nome_section = ""
-        if user_name:
-            pronoun_text = f"\n🗣️ PRONOME PREFERIDO: {user_pronoun}" if user_pronoun else ""
-            nome_section = f"""
-════════════════════════════════════════════════════════════════════════════════
-👤 INFORMAÇÕES DO(A) INTERLOCUTOR(A)
-════════════════════════════════════════════════════════════════════════════════
-
-📛 NOME: {user_name}{pronoun_text}
-
-INSTRUÇÕES DE USO:
-- Use o nome de forma respeitosa e acolhedora durante a conversa
-- Personalize suas respostas chamando a pessoa pelo nome quando apropriado
-- {"Use o pronome '" + user_pronoun + "' nas conjugações e referências" if user_pronoun else "Use linguagem neutra quando não souber o pronome"}
-- Exemplos de linguagem inclusiva: "bem-vinde", "queride" (quando aplicável)
-
-════════════════════════════════════════════════════════════════════════════════
-"""
-        
-        prompt_sistema = f"""{nome_section}
-════════════════════════════════════════════════════════════════════════════════
-📚 SEÇÃO 1: BASE DE CONHECIMENTO (Artigos de Referência)
-════════════════════════════════════════════════════════════════════════════════
-
-{contexto}
-
-════════════════════════════════════════════════════════════════════════════════
-🎯 INSTRUÇÕES PARA O ASSISTENTE
-════════════════════════════════════════════════════════════════════════════════
-
-Você é um assistente especializado em orientar pessoas trans sobre:
-- Retificação de nome e gênero
-- Terapia hormonal (hormonização)
-- Prevenção e tratamento de ISTs
-
-IMPORTANTE:
-- Use APENAS as informações da BASE DE CONHECIMENTO acima
-- Se houver HISTÓRICO DE CONVERSAS abaixo, mantenha coerência com elas
-- Responda de forma sucinta, acolhedora e respeitosa
-- Use emojis quando apropriado, mas de forma moderada
-- Não use termos muito técnicos e evite reforçar esteriótipos
-- Se não souber algo que não está na base de conhecimento, seja honesto
-- Use linguagem neutra e inclusiva sempre
-
-════════════════════════════════════════════════════════════════════════════════
-"""
-        
-        # 6. Monta a lista de mensagens
-        messages = [{"role": "system", "content": prompt_sistema}]
-        
-        # 7. Adiciona o histórico com marcação clara
-        if historico:
-            historico_formatado = "\n════════════════════════════════════════════════════════════════════════════════\n"
-            historico_formatado += f"💬 SEÇÃO 2: HISTÓRICO DA CONVERSA ({len(historico)} mensagens anteriores)\n"
-            historico_formatado += "════════════════════════════════════════════════════════════════════════════════\n\n"
-            
-            for i, msg in enumerate(historico, 1):
-                role_label = "USUÁRIO" if msg['role'] == 'user' else "ASSISTENTE"
-                historico_formatado += f"[Mensagem {i} - {role_label}]:\n{msg['content']}\n\n"
-            
-            historico_formatado += "════════════════════════════════════════════════════════════════════════════════\n"
-            
-            # Adiciona como mensagem do sistema para contexto
-            messages.append({"role": "system", "content": historico_formatado})
-        
-        # 7. Adiciona separador e a pergunta atual
-        mensagem_atual = f"""
-════════════════════════════════════════════════════════════════════════════════
-❓ SEÇÃO 3: PERGUNTA ATUAL DO USUÁRIO
-════════════════════════════════════════════════════════════════════════════════
+    chave = idempotency_key or request.idempotency_key
+    if chave and len(chave) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key com mais de {IDEMPOTENCY_KEY_MAX_LENGTH} caracteres")
+    if chave and request.user_id is None and not request.session_id:
+        # Sem usuário nem sessão, clientes diferentes dividiriam o mesmo espaço de chaves
+        raise HTTPException(status_code=400, detail="Idempotency-Key exige user_id ou session_id")
 
-{request.message}
+    try:
+        if not chave:
+            return await responder_chat(request)
 
-════════════════════════════════════════════════════════════════════════════════
-"""
-        
-        messages.append({"role": "user", "content": mensagem_atual})
-        
-        # 8. Chama a API do OpenAI
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1000
+        corpo = request.model_dump(exclude={"idempotency_key"})
+        resultado, repetida = await idempotencia.executar(
+            (request.user_id, request.session_id, chave), impressao(corpo), lambda: responder_chat(request)
         )
-        
-        resposta = response.choices[0].message.content
-        
-        # 7. Salva a mensagem do usuário e a resposta no banco
-        save_message(chat_id, "user", request.message)
-        save_message(chat_id, "assistant", resposta)
-        
-        # Print para debug
-        print("\n" + "="*80)
-        print(f"💬 CHAT ID: {chat_id}")
-        if user_name:
-            pronoun_display = f" ({user_pronoun})" if user_pronoun else ""
-            print(f"👤 NOME DO USUÁRIO: {user_name}{pronoun_display}")
-        else:
-            print(f"👤 NOME DO USUÁRIO: Anônimo")
-        print(f"� HISTÓRICO USADO: {len(historico)} mensagens")
-        print(f"❓ PERGUNTA DO USUÁRIO: {request.message}")
-        print(f"🤖 RESPOSTA: {resposta}")
-        print("="*80 + "\n")
-        
-        return {
-            "response": resposta,
-            "contexto_utilizado": True,
-            "chat_id": chat_id,
-            "historico_usado": historico_usado
-        }
-        
+        if repetida:
+            response.headers["Idempotent-Replayed"] = "true"
+        return resultado
+
+    except ChaveReutilizada as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao processar chat: {str(e)}")
+
+def evento_sse(evento: str, dados: dict) -> str:
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Versão do /chat que envia a resposta em partes, via Server-Sent Events.
+
+    Eventos: `delta` ({"content": "..."}) a cada trecho gerado, `done` ao
+    final (chat_id, historico_usado, intent e usage) e `error` se a geração
+    falhar. A resposta é salva quando o stream termina; se a conexão cair no
+    meio, o que já foi gerado é salvo mesmo assim.
+    """
+    try:
+        preparo = await preparar_chat(request)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao processar chat: {str(e)}")
 
+    async def eventos():
+        partes = []
+        usage = None
+        salvo = False
+        inicio = time.perf_counter()
+        try:
+            frequente = await engine.resposta_frequente(preparo)
+            if frequente is not None:
+                metrics.observe("chat_stream_ttft_ms", (time.perf_counter() - inicio) * 1000)
+                partes.append(frequente)
+                yield evento_sse("delta", {"content": frequente})
+            else:
+                stream = await engine.completar_stream(preparo)
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    if not partes:
+                        metrics.observe("chat_stream_ttft_ms", (time.perf_counter() - inicio) * 1000)
+                    partes.append(chunk.choices[0].delta.content)
+                    yield evento_sse("delta", {"content": partes[-1]})
+
+            resposta = "".join(partes)
+            if frequente is None:
+                engine.registrar_metricas(preparo, usage)
+                await engine.guardar_resposta_frequente(preparo, resposta, usage)
+            await engine.salvar_turno(preparo, resposta)
+            salvo = True
+            imprimir_debug_chat(preparo, request.message, resposta, usage)
+
+            yield evento_sse("done", {
+                "chat_id": preparo.chat_id,
+                "historico_usado": len(preparo.historico) > 0,
+                "intent": preparo.intent,
+                "faq_cache": frequente is not None,
+                "usage": {
+                    "prompt_tokens": usage.prompt_tokens,
+                    "cached_tokens": tokens_em_cache(usage),
+                    "completion_tokens": usage.completion_tokens,
+                    "total_tokens": usage.total_tokens,
+                } if usage else None,
+            })
+        except Exception as e:
+            print(f"Erro no stream do chat {preparo.chat_id}: {e}")
+            yield evento_sse("error", {"detail": f"Erro ao processar chat: {str(e)}"})
+        finally:
+            # Stream interrompido (erro ou cliente desconectou): salva o que foi
+            # gerado. Sem await aqui, pois a tarefa atual pode ter sido cancelada.
+            if not salvo and partes:
+                metrics.incr("chat_stream_interrompido")
+                engine.disparar_em_segundo_plano(engine.salvar_turno(preparo, "".join(partes)))
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Métricas do processo: tokens por requisição, modo de contexto etc.
+    """
+    return metrics.snapshot()
+
+@app.post("/users/{user_id}/profile/invalidate")
+async def invalidate_user_profile(user_id: int):
+    """
+    Descarta o perfil do usuário em cache. Deve ser chamado após editar
+    nome, nome social ou pronome (ou após criar o usuário), para que a
+    mudança valha já na próxima mensagem.
+    """
+    await engine.invalidar_perfil(user_id)
+    return {"success": True, "user_id": user_id}
+
 @app.get("/chat/history/{chat_id}")
-def get_chat_history_endpoint(chat_id: int, limit: int = 50):
+async def get_chat_history_endpoint(
+    chat_id: int, limit: int = 50, before: Optional[str] = None, after: Optional[str] = None
+):
     """
-    Busca o histórico de mensagens de um chat específico.
+    Busca o histórico de mensagens de um chat específico, paginado por cursor.
+
+    Sem cursor, retorna as `limit` mensagens mais recentes. Para carregar as
+    anteriores, passe `before=<cursor_anterior>`; para buscar as que chegaram
+    depois, `after=<cursor_posterior>`. As mensagens vêm em ordem cronológica.
     """
+    if limit < 1 or limit > 200:
+        raise HTTPException(status_code=400, detail="limit deve estar entre 1 e 200")
     try:
-        messages = get_chat_history(chat_id, limit)
-        return {
-            "chat_id": chat_id,
-            "total_messages": len(messages),
-            "messages": messages
-        }
+        await engine.message_writer.aguardar(chat_id)
+        # Uma mensagem a mais indica se ainda há página na direção pedida
+        pagina = await engine.buscar_pagina_historico(chat_id, limit + 1, before=before, after=after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao buscar histórico: {str(e)}")
 
+    tem_mais = len(pagina) > limit
+    if tem_mais:
+        # A mensagem extra é a mais distante do cursor
+        pagina = pagina[:limit] if after else pagina[1:]
+    if after:
+        tem_anteriores, tem_posteriores = True, tem_mais
+    else:
+        tem_anteriores, tem_posteriores = tem_mais, bool(before)
+
+    return {
+        "chat_id": chat_id,
+        "total_messages": len(pagina),
+        "messages": pagina,
+        "cursor_anterior": codificar_cursor(pagina[0]) if pagina and tem_anteriores else None,
+        "cursor_posterior": codificar_cursor(pagina[-1]) if pagina else after,
+        "tem_anteriores": tem_anteriores,
+        "tem_posteriores": tem_posteriores,
+    }
+
 @app.get("/chats/user/{user_id}")
-def get_user_chats(user_id: int):
+async def get_user_chats(user_id: int):
     """
     Lista todos os chats de um usuário.
     """
     try:
-        result = supabase.table('chats').select('id, title, created_at, updated_at, is_active').eq('user_id', user_id).order('updated_at', desc=True).execute()
+        result = await supabase_async.table('chats').select('id, title, created_at, updated_at, is_active').eq('user_id', user_id).order('updated_at', desc=True).execute()
         
         return {
             "user_id": user_id,
@@ -543,30 +491,25 @@ def get_user_chats(user_id: int):
         raise HTTPException(status_code=500, detail=f"Erro ao buscar chats: {str(e)}")
 
 @app.delete("/chat/{chat_id}")
-def delete_chat(chat_id: int):
+async def delete_chat(chat_id: int):
     """
     Desativa um chat (soft delete).
     """
     try:
-        supabase.table('chats').update({'is_active': False}).eq('id', chat_id).execute()
+        await engine.desativar_chat(chat_id)
         return {"success": True, "message": f"Chat {chat_id} desativado com sucesso"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao desativar chat: {str(e)}")
 
 @app.post("/chat/{chat_id}/new")
-def start_new_chat(user_id: Optional[int] = None, session_id: Optional[str] = None):
+async def start_new_chat(user_id: Optional[int] = None, session_id: Optional[str] = None):
     """
     Inicia um novo chat para o usuário (desativa o atual e cria um novo).
     """
     try:
-        # Desativa chats antigos
-        if user_id:
-            supabase.table('chats').update({'is_active': False}).eq('user_id', user_id).eq('is_active', True).execute()
-        elif session_id:
-            supabase.table('chats').update({'is_active': False}).eq('session_id', session_id).eq('is_active', True).execute()
-        
-        # Cria novo chat
-        chat_id = get_or_create_chat(user_id, session_id)
+        # Troca o chat no cache sob o mesmo lock usado pelo /chat, para que uma
+        # mensagem simultânea não volte a guardar o chat desativado
+        chat_id = await engine.novo_chat(user_id, session_id)
         
         return {
             "success": True,
@@ -575,3 +518,17 @@ def start_new_chat(user_id: Optional[int] = None, session_id: Optional[str] = No
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao criar novo chat: {str(e)}")
+
+@app.post("/telegram/webhook")
+async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
+    """
+    Recebe os updates do Telegram (modo webhook). O update é colocado na fila
+    do bot e processado em segundo plano; a resposta ao Telegram é imediata.
+    """
+    if telegram_app is None:
+        raise HTTPException(status_code=404, detail="Bot do Telegram não configurado neste processo")
+    if TELEGRAM_WEBHOOK_SECRET and x_telegram_bot_api_secret_token != TELEGRAM_WEBHOOK_SECRET:
+        raise HTTPException(status_code=403, detail="Token secreto do webhook inválido")
+    update = Update.de_json(await request.json(), telegram_app.bot)
+    await telegram_app.update_queue.put(update)
+    return {"ok": True}
@@ -0,0 +1,91 @@
+"""
+Métricas em memória do processo (contadores, distribuições e gauges).
+
+Exportadas em JSON pelo endpoint GET /metrics da API.
+"""
+
+import threading
+from collections import deque
+from typing import Callable, Dict
+
+# Quantidade de amostras recentes usadas para calcular p50/p95
+JANELA_AMOSTRAS = 1024
+
+
+class _Distribuicao:
+    __slots__ = ("count", "soma", "minimo", "maximo", "amostras")
+
+    def __init__(self):
+        self.count = 0
+        self.soma = 0.0
+        self.minimo = None
+        self.maximo = None
+        self.amostras = deque(maxlen=JANELA_AMOSTRAS)
+
+    def observar(self, valor: float):
+        self.count += 1
+        self.soma += valor
+        self.minimo = valor if self.minimo is None else min(self.minimo, valor)
+        self.maximo = valor if self.maximo is None else max(self.maximo, valor)
+        self.amostras.append(valor)
+
+    def resumo(self) -> dict:
+        ordenadas = sorted(self.amostras)
+
+        def percentil(p: float):
+            if not ordenadas:
+                return None
+            return ordenadas[min(len(ordenadas) - 1, int(p * len(ordenadas)))]
+
+        return {
+            "count": self.count,
+            "sum": round(self.soma, 3),
+            "avg": round(self.soma / self.count, 3) if self.count else None,
+            "min": self.minimo,
+            "max": self.maximo,
+            "p50": percentil(0.50),
+            "p95": percentil(0.95),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores: Dict[str, float] = {}
+        self._distribuicoes: Dict[str, _Distribuicao] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def incr(self, nome: str, valor: float = 1):
+        with self._lock:
+            self._contadores[nome] = self._contadores.get(nome, 0) + valor
+
+    def observe(self, nome: str, valor: float):
+        with self._lock:
+            distribuicao = self._distribuicoes.get(nome)
+            if distribuicao is None:
+                distribuicao = self._distribuicoes[nome] = _Distribuicao()
+            distribuicao.observar(valor)
+
+    def gauge(self, nome: str, leitura: Callable[[], float]):
+        """Registra uma função lida no momento da exportação."""
+        with self._lock:
+            self._gauges[nome] = leitura
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            contadores = dict(self._contadores)
+            distribuicoes = {nome: d.resumo() for nome, d in self._distribuicoes.items()}
+            gauges = dict(self._gauges)
+
+        valores_gauges = {}
+        for nome, leitura in gauges.items():
+            try:
+                valores_gauges[nome] = leitura()
+            except Exception as e:
+                valores_gauges[nome] = f"erro: {e}"
+
+        return {"counters": contadores, "distributions": distribuicoes, "gauges": valores_gauges}
+
+
+# Instância única compartilhada pelos módulos do processo
+metrics = Metrics()
@@ -0,0 +1,212 @@
+"""
+Gravação das mensagens fora do caminho da requisição (write-behind).
+
+As mensagens de cada turno entram em uma fila limitada; um worker asyncio
+agrupa o que estiver na fila, grava tudo em `chat_messages` com um único
+insert e atualiza `chats.updated_at` de todos os chats do lote com um único
+update. Falhas são repetidas com backoff, e a fila é esvaziada no shutdown.
+Um lote que falha em todas as tentativas é descartado: as mensagens contam
+em `{nome_metrica}_falhas` e `ao_descartar` recebe os chats afetados, para
+que caches com essas mensagens sejam invalidados.
+
+Funciona com o cliente síncrono do Supabase (as chamadas rodam em uma
+thread) e com o assíncrono.
+"""
+
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_QUEUE_MAX = int(os.getenv("MESSAGE_QUEUE_MAX", "1000"))
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "100"))
+# Quanto o worker espera por mais mensagens antes de gravar um lote incompleto
+MESSAGE_BATCH_WAIT_MS = float(os.getenv("MESSAGE_BATCH_WAIT_MS", "50"))
+MESSAGE_WRITE_RETRIES = int(os.getenv("MESSAGE_WRITE_RETRIES", "3"))
+
+_PARAR = object()
+
+
+def montar_linhas(chat_id: int, mensagens: Iterable[Tuple[str, str]]) -> List[dict]:
+    """Linhas de `chat_messages` para (role, content), na ordem dada."""
+    agora = datetime.now()
+    # Timestamps estritamente crescentes: o histórico é ordenado por created_at
+    return [
+        {
+            'chat_id': chat_id,
+            'role': role,
+            'content': content,
+            'created_at': (agora + timedelta(microseconds=i)).isoformat()
+        }
+        for i, (role, content) in enumerate(mensagens)
+    ]
+
+
+async def executar(query):
+    """Executa uma query do Supabase, seja do cliente síncrono ou do assíncrono."""
+    if asyncio.iscoroutinefunction(query.execute):
+        return await query.execute()
+    return await asyncio.to_thread(query.execute)
+
+
+class MessageWriter:
+    def __init__(
+        self,
+        supabase,
+        max_fila: int = MESSAGE_QUEUE_MAX,
+        tamanho_lote: int = MESSAGE_BATCH_SIZE,
+        espera_ms: float = MESSAGE_BATCH_WAIT_MS,
+        tentativas: int = MESSAGE_WRITE_RETRIES,
+        nome_metrica: str = "persistencia",
+        ao_gravar: Optional[Callable[[List[int]], Awaitable[None]]] = None,
+        ao_descartar: Optional[Callable[[List[int]], Awaitable[None]]] = None,
+    ):
+        self.supabase = supabase
+        self.max_fila = max_fila
+        self.tamanho_lote = tamanho_lote
+        self.espera = espera_ms / 1000
+        self.tentativas = tentativas
+        self.nome_metrica = nome_metrica
+        # Chamado com os ids dos chats de cada lote gravado
+        self.ao_gravar = ao_gravar
+        # Chamado com os ids dos chats de cada lote descartado após as tentativas
+        self.ao_descartar = ao_descartar
+        self._fila: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Mensagens ainda não gravadas por chat (para `aguardar`)
+        self._pendentes: Dict[int, int] = defaultdict(int)
+        self._gravado: Optional[asyncio.Condition] = None
+        metrics.gauge(f"{nome_metrica}_fila", self.profundidade)
+
+    def profundidade(self) -> int:
+        return self._fila.qsize() if self._fila else 0
+
+    async def iniciar(self):
+        self._fila = asyncio.Queue(maxsize=self.max_fila)
+        self._gravado = asyncio.Condition()
+        self._worker = asyncio.create_task(self._executar())
+
+    async def parar(self):
+        """Grava tudo o que ainda está na fila e encerra o worker."""
+        if not self._worker:
+            return
+        await self._fila.put(_PARAR)
+        await self._worker
+        self._worker = None
+
+    async def enfileirar(self, chat_id: int, mensagens: Iterable[Tuple[str, str]]):
+        """
+        Agenda a gravação de (role, content) de um chat, na ordem dada.
+        Aguarda se a fila estiver cheia.
+        """
+        await self.enfileirar_linhas(montar_linhas(chat_id, mensagens))
+
+    async def enfileirar_linhas(self, linhas: List[dict]):
+        """Como `enfileirar`, com linhas já montadas por `montar_linhas`."""
+        if not linhas:
+            return
+        if self._worker is None:
+            # Sem worker (ex.: fora do ciclo de vida da aplicação): grava direto
+            await self._gravar(linhas)
+            return
+        for linha in linhas:
+            self._pendentes[linha['chat_id']] += 1
+        await self._fila.put(linhas)
+
+    async def aguardar(self, chat_id: int, timeout: float = 5.0):
+        """
+        Espera as mensagens pendentes do chat serem gravadas, para que a
+        leitura seguinte do histórico as inclua.
+        """
+        if not self._pendentes.get(chat_id) or self._gravado is None:
+            return
+        try:
+            async with self._gravado:
+                await asyncio.wait_for(
+                    self._gravado.wait_for(lambda: not self._pendentes.get(chat_id)), timeout
+                )
+        except asyncio.TimeoutError:
+            logger.warning(f"Mensagens do chat {chat_id} ainda não gravadas após {timeout}s")
+
+    async def _executar(self):
+        parar = False
+        while not parar:
+            item = await self._fila.get()
+            lote: List[dict] = []
+            if item is _PARAR:
+                parar = True
+            else:
+                lote.extend(item)
+
+            # Junta o que chegar em seguida, até o tamanho do lote ou o tempo de espera
+            prazo = asyncio.get_running_loop().time() + self.espera
+            while not parar and len(lote) < self.tamanho_lote:
+                restante = prazo - asyncio.get_running_loop().time()
+                try:
+                    item = self._fila.get_nowait() if restante <= 0 else await asyncio.wait_for(self._fila.get(), restante)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is _PARAR:
+                    parar = True
+                else:
+                    lote.extend(item)
+
+            # No shutdown, esvazia o restante da fila
+            while parar and not self._fila.empty():
+                item = self._fila.get_nowait()
+                if item is not _PARAR:
+                    lote.extend(item)
+
+            if lote:
+                await self._gravar(lote)
+                await self._liberar(lote)
+
+    async def _gravar(self, linhas: List[dict]):
+        chats = sorted({linha['chat_id'] for linha in linhas})
+        for tentativa in range(1, self.tentativas + 1):
+            try:
+                await executar(self.supabase.table('chat_messages').insert(linhas))
+                break
+            except Exception as e:
+                if tentativa == self.tentativas:
+                    logger.error(f"Erro ao salvar {len(linhas)} mensagens (chats {chats}): {e}")
+                    metrics.incr(f"{self.nome_metrica}_falhas", len(linhas))
+                    await self._avisar(self.ao_descartar, chats, "descarte")
+                    return
+                logger.warning(f"Erro ao salvar mensagens (tentativa {tentativa}): {e}")
+                await asyncio.sleep(0.2 * 2 ** (tentativa - 1))
+
+        metrics.incr(f"{self.nome_metrica}_mensagens", len(linhas))
+        metrics.incr(f"{self.nome_metrica}_lotes")
+        await self._avisar(self.ao_gravar, chats, "gravação")
+
+        # Um único update para todos os chats do lote
+        try:
+            await executar(
+                self.supabase.table('chats').update({'updated_at': datetime.now().isoformat()}).in_('id', chats)
+            )
+        except Exception as e:
+            logger.error(f"Erro ao atualizar updated_at dos chats {chats}: {e}")
+
+    async def _avisar(self, callback, chats: List[int], evento: str):
+        if not callback:
+            return
+        try:
+            await callback(chats)
+        except Exception as e:
+            logger.error(f"Erro ao avisar {evento} dos chats {chats}: {e}")
+
+    async def _liberar(self, linhas: List[dict]):
+        async with self._gravado:
+            for linha in linhas:
+                chat_id = linha['chat_id']
+                self._pendentes[chat_id] -= 1
+                if self._pendentes[chat_id] <= 0:
+                    del self._pendentes[chat_id]
+            self._gravado.notify_all()
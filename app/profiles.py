@@ -0,0 +1,75 @@
+"""
+Cache dos perfis da tabela `users` (nome, nome social e pronome).
+
+Uma única consulta serve à verificação de existência do usuário e à
+personalização do prompt. IDs inexistentes também ficam em cache (cache
+negativo, com TTL menor). Edições de perfil devem chamar `invalidar`
+(exposto na API em POST /users/{user_id}/profile/invalidate), o que vale
+para todos os processos quando o cache é compartilhado (shared_cache.py).
+"""
+
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, Optional
+
+from shared_cache import SharedCaches
+
+USER_PROFILE_TTL_SECONDS = float(os.getenv("USER_PROFILE_TTL_SECONDS", "300"))
+USER_PROFILE_NEGATIVE_TTL_SECONDS = float(os.getenv("USER_PROFILE_NEGATIVE_TTL_SECONDS", "60"))
+USER_PROFILE_MAX_ITEMS = int(os.getenv("USER_PROFILE_MAX_ITEMS", "10000"))
+
+# Marca de "usuário não existe" no cache
+_INEXISTENTE = {}
+
+
+class UserProfileCache:
+    def __init__(
+        self,
+        ttl: float = USER_PROFILE_TTL_SECONDS,
+        ttl_negativo: float = USER_PROFILE_NEGATIVE_TTL_SECONDS,
+        max_itens: int = USER_PROFILE_MAX_ITEMS,
+        caches: Optional[SharedCaches] = None,
+    ):
+        self._cache = (caches or SharedCaches()).criar("user_profiles", max_itens, ttl)
+        self.ttl_negativo = ttl_negativo
+        # Consultas em andamento: chamadas simultâneas para o mesmo id esperam a mesma
+        self._em_andamento: Dict[int, asyncio.Future] = {}
+
+    async def obter(self, user_id: int, buscar: Callable[[int], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        """
+        Retorna o perfil do usuário, ou None se ele não existir.
+        Erros de `buscar` são propagados e não ficam em cache.
+        """
+        perfil = await self._cache.obter(user_id)
+        if perfil is not None:
+            return perfil or None
+
+        futuro = self._em_andamento.get(user_id)
+        if futuro is not None:
+            return await asyncio.shield(futuro)
+
+        futuro = self._em_andamento[user_id] = asyncio.get_running_loop().create_future()
+        try:
+            perfil = await buscar(user_id)
+        except Exception as e:
+            futuro.set_exception(e)
+            # Evita "exception was never retrieved" quando ninguém mais espera
+            futuro.exception()
+            raise
+        else:
+            if perfil is None:
+                await self._cache.guardar(user_id, _INEXISTENTE, ttl=self.ttl_negativo)
+            else:
+                await self._cache.guardar(user_id, perfil)
+            futuro.set_result(perfil)
+            return perfil
+        finally:
+            if not futuro.done():  # consulta cancelada
+                futuro.cancel()
+            self._em_andamento.pop(user_id, None)
+
+    async def invalidar(self, user_id: int):
+        await self._cache.remover(user_id)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
@@ -0,0 +1,237 @@
+"""
+Montagem do prompt do chat (API e Telegram).
+
+A parte estática (instruções + base de conhecimento) é pré-compilada por
+intenção para cada versão da base: perguntas sobre um tema recebem só os
+artigos daquele tema, e o texto do prompt é idêntico entre requisições.
+
+As mensagens seguem sempre a ordem: parte estática, dados do(a)
+interlocutor(a) e do canal, histórico e pergunta. Assim, requisições de
+usuários diferentes compartilham o mesmo prefixo, e o cache de prompt
+automático da OpenAI (prefixos a partir de 1024 tokens) cobre a maior parte
+da entrada. `registrar_uso` mede quantos tokens vieram desse cache.
+"""
+
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from intents import INTENCOES_COM_ARTIGOS, INTENCOES_SEM_ARTIGOS, intencoes_do_artigo
+from knowledge_base import KnowledgeBaseSnapshot, concatenar_artigos
+from metrics import metrics
+from tokens import contar_tokens
+
+# Desligue para sempre enviar a base completa (ou os trechos do retrieval)
+KB_INTENT_SCOPED_PROMPTS = os.getenv("KB_INTENT_SCOPED_PROMPTS", "true").lower() in ("1", "true", "yes")
+
+CONTEXTO_SEM_ARTIGOS = (
+    "(Nenhum artigo é necessário para saudações e despedidas. Se a pessoa fizer uma "
+    "pergunta, convide-a a perguntar sobre retificação de nome, hormonização ou prevenção de ISTs.)"
+)
+
+
+def secao_nome(user_name: Optional[str], user_pronoun: Optional[str]) -> str:
+    """Seção com o nome e o pronome do(a) interlocutor(a), ou "" se anônimo."""
+    if not user_name:
+        return ""
+    pronoun_text = f"\n🗣️ PRONOME PREFERIDO: {user_pronoun}" if user_pronoun else ""
+    return f"""
+════════════════════════════════════════════════════════════════════════════════
+👤 INFORMAÇÕES DO(A) INTERLOCUTOR(A)
+════════════════════════════════════════════════════════════════════════════════
+
+📛 NOME: {user_name}{pronoun_text}
+
+INSTRUÇÕES DE USO:
+- Use o nome de forma respeitosa e acolhedora durante a conversa
+- Personalize suas respostas chamando a pessoa pelo nome quando apropriado
+- {"Use o pronome '" + user_pronoun + "' nas conjugações e referências" if user_pronoun else "Use linguagem neutra quando não souber o pronome"}
+- Exemplos de linguagem inclusiva: "bem-vinde", "queride" (quando aplicável)
+
+════════════════════════════════════════════════════════════════════════════════
+"""
+
+
+def montar_prompt_sistema(contexto: str) -> str:
+    """
+    Instruções do assistente + base de conhecimento. Não deve depender do
+    usuário nem do turno: é o prefixo compartilhado entre requisições.
+    """
+    return f"""
+════════════════════════════════════════════════════════════════════════════════
+🎯 INSTRUÇÕES PARA O ASSISTENTE
+════════════════════════════════════════════════════════════════════════════════
+
+Você é um assistente especializado em orientar pessoas trans sobre:
+- Retificação de nome e gênero
+- Terapia hormonal (hormonização)
+- Prevenção e tratamento de ISTs
+
+IMPORTANTE:
+- Use APENAS as informações da BASE DE CONHECIMENTO abaixo
+- Se houver HISTÓRICO DE CONVERSAS, mantenha coerência com elas
+- Responda de forma sucinta, acolhedora e respeitosa
+- Use emojis quando apropriado, mas de forma moderada
+- Não use termos muito técnicos e evite reforçar esteriótipos
+- Se não souber algo que não está na base de conhecimento, seja honesto
+- Use linguagem neutra e inclusiva sempre
+
+════════════════════════════════════════════════════════════════════════════════
+📚 SEÇÃO 1: BASE DE CONHECIMENTO (Artigos de Referência)
+════════════════════════════════════════════════════════════════════════════════
+
+{contexto}
+
+════════════════════════════════════════════════════════════════════════════════
+"""
+
+
+def secao_canal(instrucoes: Sequence[str]) -> str:
+    """Instruções específicas do canal (ex.: tamanho das respostas no Telegram)."""
+    if not instrucoes:
+        return ""
+    linhas = "\n".join(f"- {instrucao}" for instrucao in instrucoes)
+    return f"""
+════════════════════════════════════════════════════════════════════════════════
+📱 INSTRUÇÕES DO CANAL
+════════════════════════════════════════════════════════════════════════════════
+
+{linhas}
+
+════════════════════════════════════════════════════════════════════════════════
+"""
+
+
+def secao_historico(mensagens: Sequence[dict], resumo: Optional[str] = None) -> str:
+    """Histórico da conversa (resumo das antigas + recentes na íntegra), ou "" se vazio."""
+    if not mensagens and not resumo:
+        return ""
+    historico_formatado = "\n════════════════════════════════════════════════════════════════════════════════\n"
+    historico_formatado += f"💬 SEÇÃO 2: HISTÓRICO DA CONVERSA ({len(mensagens)} mensagens anteriores)\n"
+    historico_formatado += "════════════════════════════════════════════════════════════════════════════════\n\n"
+
+    if resumo:
+        historico_formatado += f"[Resumo da conversa até aqui]:\n{resumo}\n\n"
+
+    for i, msg in enumerate(mensagens, 1):
+        role_label = "USUÁRIO" if msg['role'] == 'user' else "ASSISTENTE"
+        historico_formatado += f"[Mensagem {i} - {role_label}]:\n{msg['content']}\n\n"
+
+    historico_formatado += "════════════════════════════════════════════════════════════════════════════════\n"
+    return historico_formatado
+
+
+def secao_pergunta(pergunta: str) -> str:
+    return f"""
+════════════════════════════════════════════════════════════════════════════════
+❓ SEÇÃO 3: PERGUNTA ATUAL DO USUÁRIO
+════════════════════════════════════════════════════════════════════════════════
+
+{pergunta}
+
+════════════════════════════════════════════════════════════════════════════════
+"""
+
+
+def montar_mensagens(
+    prompt_base: str,
+    pergunta: str,
+    historico: Sequence[dict] = (),
+    resumo: Optional[str] = None,
+    user_name: Optional[str] = None,
+    user_pronoun: Optional[str] = None,
+    instrucoes_canal: Sequence[str] = (),
+) -> List[dict]:
+    """
+    Mensagens enviadas à OpenAI, da parte mais estável para a mais variável:
+    `prompt_base` (de `montar_prompt_sistema`), interlocutor(a) e canal,
+    histórico e pergunta atual.
+    """
+    messages = [{"role": "system", "content": prompt_base}]
+
+    pessoal = secao_nome(user_name, user_pronoun) + secao_canal(instrucoes_canal)
+    if pessoal:
+        messages.append({"role": "system", "content": pessoal})
+
+    historico_formatado = secao_historico(historico, resumo)
+    if historico_formatado:
+        messages.append({"role": "system", "content": historico_formatado})
+
+    messages.append({"role": "user", "content": secao_pergunta(pergunta)})
+    return messages
+
+
+def tokens_em_cache(usage) -> int:
+    """Tokens do prompt servidos pelo cache de prompt da OpenAI (0 se não informado)."""
+    detalhes = getattr(usage, "prompt_tokens_details", None)
+    return getattr(detalhes, "cached_tokens", None) or 0
+
+
+def registrar_uso(usage, prefixo: str = "chat"):
+    """
+    Métricas de tokens de uma chamada. A taxa de acerto do cache de prompt
+    é `{prefixo}_prompt_tokens_cache_total / {prefixo}_prompt_tokens_total`.
+    """
+    if not usage:
+        return
+    em_cache = tokens_em_cache(usage)
+    metrics.observe(f"{prefixo}_prompt_tokens", usage.prompt_tokens)
+    metrics.observe(f"{prefixo}_completion_tokens", usage.completion_tokens)
+    metrics.observe(f"{prefixo}_prompt_tokens_cache", em_cache)
+    metrics.incr(f"{prefixo}_prompt_tokens_total", usage.prompt_tokens)
+    metrics.incr(f"{prefixo}_prompt_tokens_cache_total", em_cache)
+    if usage.prompt_tokens:
+        metrics.observe(f"{prefixo}_prompt_cache_taxa", em_cache / usage.prompt_tokens)
+
+
+@dataclass(frozen=True)
+class PromptCompilado:
+    intent: str
+    prompt: str
+    tokens: int
+    arquivos: Tuple[str, ...]
+
+
+def compilar_prompts(snapshot: KnowledgeBaseSnapshot) -> Dict[str, PromptCompilado]:
+    """Um prompt por intenção, com apenas os artigos daquela intenção."""
+    por_intencao = {intent: [] for intent in INTENCOES_COM_ARTIGOS}
+    for nome, conteudo in snapshot.artigos:
+        for intent in intencoes_do_artigo(nome, conteudo):
+            por_intencao[intent].append((nome, conteudo))
+
+    compilados = {}
+    for intent, artigos in por_intencao.items():
+        if not artigos:
+            continue  # sem artigos marcados: a intenção usa o prompt completo
+        prompt = montar_prompt_sistema(concatenar_artigos(artigos))
+        compilados[intent] = PromptCompilado(intent, prompt, contar_tokens(prompt), tuple(n for n, _ in artigos))
+
+    for intent in INTENCOES_SEM_ARTIGOS:
+        prompt = montar_prompt_sistema(CONTEXTO_SEM_ARTIGOS)
+        compilados[intent] = PromptCompilado(intent, prompt, contar_tokens(prompt), ())
+
+    return compilados
+
+
+class IntentPrompts:
+    """Prompts por intenção da versão atual da base, recompilados quando ela muda."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versao: Optional[str] = None
+        self._prompts: Dict[str, PromptCompilado] = {}
+
+    def obter(self, snapshot: KnowledgeBaseSnapshot, intent: Optional[str]) -> Optional[PromptCompilado]:
+        """
+        Retorna o prompt pré-compilado da intenção, ou None quando a
+        requisição deve usar o prompt completo (OUTROS, NAO_ENTENDIDO ou
+        intenção sem artigos marcados).
+        """
+        if not intent:
+            return None
+        with self._lock:
+            if self._versao != snapshot.versao:
+                self._prompts = compilar_prompts(snapshot)
+                self._versao = snapshot.versao
+            return self._prompts.get(intent)
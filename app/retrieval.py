@@ -0,0 +1,294 @@
+"""
+Recuperação de trechos relevantes da base de conhecimento.
+
+Os artigos são divididos em seções pelos títulos markdown e indexados com
+BM25 sobre termos normalizados em português (ver textnorm). Para cada
+pergunta, apenas os trechos mais relevantes que cabem no orçamento de tokens
+vão para o prompt. O índice é reconstruído somente quando a versão da base
+muda.
+
+KB_RETRIEVAL_MODE=semantic usa o índice vetorial de semantic_index no lugar
+do BM25 e KB_RETRIEVAL_MODE=full volta ao comportamento antigo (base inteira
+no prompt). No modo semantic o BM25 também é montado: se a API de embeddings
+falhar, a busca usa o BM25 da mesma versão em vez de derrubar o turno.
+"""
+
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, replace
+from typing import Any, Dict, List, Optional, Tuple
+
+from knowledge_base import KnowledgeBaseSnapshot, formatar_artigo
+from metrics import metrics
+from textnorm import termos
+from tokens import contar_tokens
+
+logger = logging.getLogger(__name__)
+
+KB_RETRIEVAL_MODE = os.getenv("KB_RETRIEVAL_MODE", "bm25")  # "bm25", "semantic" ou "full"
+KB_RETRIEVAL_TOP_K = int(os.getenv("KB_RETRIEVAL_TOP_K", "6"))
+KB_CONTEXT_TOKEN_BUDGET = int(os.getenv("KB_CONTEXT_TOKEN_BUDGET", "3000"))
+KB_CHUNK_MAX_TOKENS = int(os.getenv("KB_CHUNK_MAX_TOKENS", "500"))
+# Pausa antes de tentar de novo os embeddings de uma versão que falhou
+KB_EMBEDDING_RETRY_SECONDS = float(os.getenv("KB_EMBEDDING_RETRY_SECONDS", "60"))
+
+_RE_TITULO = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+
+
+@dataclass(frozen=True)
+class Chunk:
+    """Seção de um artigo, identificada pelo caminho de títulos."""
+    id: int
+    arquivo: str
+    titulo: str
+    texto: str
+    tokens: int
+
+
+@dataclass(frozen=True)
+class ContextoSelecionado:
+    """Contexto que vai para o prompt e de onde ele veio."""
+    contexto: str
+    modo: str
+    tokens: int
+    chunks: Tuple[Chunk, ...] = ()
+
+
+def _dividir_paragrafos(texto: str, max_tokens: int) -> List[str]:
+    partes, atual = [], []
+    tokens_atual = 0
+    for paragrafo in re.split(r"\n\s*\n", texto):
+        if not paragrafo.strip():
+            continue
+        tokens = contar_tokens(paragrafo)
+        if atual and tokens_atual + tokens > max_tokens:
+            partes.append("\n\n".join(atual))
+            atual, tokens_atual = [], 0
+        atual.append(paragrafo)
+        tokens_atual += tokens
+    if atual:
+        partes.append("\n\n".join(atual))
+    return partes
+
+
+def dividir_em_secoes(arquivo: str, conteudo: str, max_tokens: int = KB_CHUNK_MAX_TOKENS) -> List[Tuple[str, str]]:
+    """
+    Divide um artigo markdown em seções (titulo, texto) pelos títulos.
+    O título de cada seção é o caminho completo (ex.: "Retificação › Documentos").
+    Seções maiores que `max_tokens` são quebradas por parágrafo.
+    """
+    secoes = []
+    caminho: List[Tuple[int, str]] = []
+    linhas: List[str] = []
+    em_codigo = False
+
+    def fechar():
+        corpo = "\n".join(linhas).strip()
+        if not corpo:
+            return
+        titulo = " › ".join(t for _, t in caminho) or arquivo
+        for parte in _dividir_paragrafos(corpo, max_tokens):
+            secoes.append((titulo, f"{'#' * max(1, len(caminho))} {titulo}\n\n{parte}"))
+
+    for linha in conteudo.splitlines():
+        if linha.lstrip().startswith("```"):
+            em_codigo = not em_codigo
+        match = None if em_codigo else _RE_TITULO.match(linha)
+        if match:
+            fechar()
+            linhas = []
+            nivel = len(match.group(1))
+            caminho = [(n, t) for n, t in caminho if n < nivel] + [(nivel, match.group(2))]
+        else:
+            linhas.append(linha)
+    fechar()
+    return secoes
+
+
+class BM25Index:
+    def __init__(self, chunks: List[Chunk], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self._tamanhos: List[int] = []
+
+        for indice, chunk in enumerate(chunks):
+            # O título entra duas vezes: uma no texto e outra como reforço
+            frequencias = Counter(termos(chunk.texto) + termos(chunk.titulo))
+            self._tamanhos.append(sum(frequencias.values()))
+            for termo, tf in frequencias.items():
+                self._postings[termo].append((indice, tf))
+
+        total = len(chunks)
+        self._media = (sum(self._tamanhos) / total) if total else 0.0
+        self._idf = {
+            termo: math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for termo, docs in self._postings.items()
+        }
+
+    def buscar(self, consulta: str, k: int) -> List[Tuple[float, Chunk]]:
+        pontuacoes: Dict[int, float] = defaultdict(float)
+        for termo in set(termos(consulta)):
+            idf = self._idf.get(termo)
+            if idf is None:
+                continue
+            for indice, tf in self._postings[termo]:
+                norma = 1 - self.b + self.b * self._tamanhos[indice] / (self._media or 1)
+                pontuacoes[indice] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norma)
+
+        melhores = sorted(pontuacoes.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(pontuacao, self.chunks[indice]) for indice, pontuacao in melhores]
+
+
+def construir_chunks(snapshot: KnowledgeBaseSnapshot, max_tokens: int = KB_CHUNK_MAX_TOKENS) -> List[Chunk]:
+    chunks = []
+    for arquivo, conteudo in snapshot.artigos:
+        for titulo, texto in dividir_em_secoes(arquivo, conteudo, max_tokens):
+            chunks.append(Chunk(len(chunks), arquivo, titulo, texto, contar_tokens(texto)))
+    return chunks
+
+
+def formatar_chunks(chunks: List[Chunk]) -> str:
+    """Agrupa os trechos por arquivo, na ordem original da base."""
+    por_arquivo: Dict[str, List[Chunk]] = {}
+    for chunk in sorted(chunks, key=lambda c: c.id):
+        por_arquivo.setdefault(chunk.arquivo, []).append(chunk)
+    return "".join(
+        formatar_artigo(arquivo, "\n\n".join(c.texto for c in trechos))
+        for arquivo, trechos in por_arquivo.items()
+    )
+
+
+@dataclass(frozen=True)
+class IndiceDaBase:
+    """
+    Índices de uma versão da base. Cada busca usa um único objeto destes, e
+    a troca de versão é uma atribuição, então vetores de uma versão nunca
+    são lidos com os trechos de outra.
+    """
+    versao: str
+    chunks: Tuple[Chunk, ...]
+    # None no modo full (não há trechos)
+    bm25: Optional[BM25Index]
+    # Matriz de embeddings alinhada a `chunks` (modo semantic; None se os
+    # embeddings falharam e a busca está usando o BM25)
+    vetores: Any
+    tokens_base: int
+
+
+class Retriever:
+    """Mantém o índice (BM25 ou vetorial) da versão atual da base e seleciona o contexto."""
+
+    def __init__(
+        self,
+        modo: str = KB_RETRIEVAL_MODE,
+        top_k: int = KB_RETRIEVAL_TOP_K,
+        orcamento_tokens: int = KB_CONTEXT_TOKEN_BUDGET,
+        max_tokens_chunk: int = KB_CHUNK_MAX_TOKENS,
+        embedder=None,
+        espera_embeddings: float = KB_EMBEDDING_RETRY_SECONDS,
+    ):
+        self.modo = modo
+        self.top_k = top_k
+        self.orcamento_tokens = orcamento_tokens
+        self.max_tokens_chunk = max_tokens_chunk
+        self._lock = threading.Lock()
+        self.espera_embeddings = espera_embeddings
+        # Último índice completo; só é trocado quando uma versão nova fica pronta
+        self._indice: Optional[IndiceDaBase] = None
+        # Versão nova cujos embeddings falharam (só BM25) e quando tentar de novo
+        self._provisorio: Optional[IndiceDaBase] = None
+        self._tentar_embeddings_em = 0.0
+        self._semantico = None
+
+        if modo == "semantic":
+            # numpy só é necessário no modo semântico
+            from semantic_index import SemanticIndex
+            self._semantico = SemanticIndex(embedder)
+
+    def _preparar(self, snapshot: KnowledgeBaseSnapshot) -> IndiceDaBase:
+        with self._lock:
+            if self._indice is not None and self._indice.versao == snapshot.versao:
+                return self._indice
+            provisorio = self._provisorio
+            if (
+                provisorio is not None
+                and provisorio.versao == snapshot.versao
+                and time.monotonic() < self._tentar_embeddings_em
+            ):
+                return provisorio
+
+            # No modo full a base vai inteira: não divide nem indexa
+            full = self.modo == "full"
+            chunks = [] if full else construir_chunks(snapshot, self.max_tokens_chunk)
+            bm25 = None if full else BM25Index(chunks)
+            indice = IndiceDaBase(
+                snapshot.versao, tuple(chunks), bm25, None, contar_tokens(snapshot.contexto)
+            )
+            if self._semantico is not None:
+                try:
+                    vetores = self._semantico.sincronizar([c.texto for c in chunks])
+                except Exception as e:
+                    # Mantém o último índice completo; esta versão usa o BM25
+                    # até a próxima tentativa
+                    logger.error(f"Erro ao calcular os embeddings da base (versão {snapshot.versao}): {e}")
+                    metrics.incr("kb_embeddings_falhas")
+                    self._provisorio = indice
+                    self._tentar_embeddings_em = time.monotonic() + self.espera_embeddings
+                    return indice
+                indice = replace(indice, vetores=vetores)
+            self._indice, self._provisorio = indice, None
+            return indice
+
+    def _buscar(self, indice: IndiceDaBase, consulta: str) -> List[Chunk]:
+        if self._semantico is not None and indice.vetores is not None:
+            try:
+                return [
+                    indice.chunks[i]
+                    for _, i in self._semantico.buscar(consulta, self.top_k, matriz=indice.vetores)
+                ]
+            except Exception as e:
+                logger.error(f"Erro na busca semântica, usando BM25: {e}")
+                metrics.incr("kb_embeddings_falhas_busca")
+        return [chunk for _, chunk in indice.bm25.buscar(consulta, self.top_k)]
+
+    def selecionar(
+        self,
+        snapshot: KnowledgeBaseSnapshot,
+        pergunta: str,
+        historico: Optional[List[dict]] = None,
+    ) -> ContextoSelecionado:
+        """
+        Retorna os trechos mais relevantes para a pergunta dentro do orçamento
+        de tokens. A última pergunta do histórico também entra na consulta,
+        para perguntas de continuação ("e quanto custa?").
+        Se nada casar com a consulta, usa a base completa.
+        """
+        indice = self._preparar(snapshot)
+        completo = ContextoSelecionado(snapshot.contexto, "full", indice.tokens_base)
+        if self.modo == "full":
+            return completo
+
+        consulta = pergunta
+        anteriores = [m['content'] for m in (historico or []) if m['role'] == 'user']
+        if anteriores:
+            consulta = f"{pergunta}\n{anteriores[-1]}"
+
+        escolhidos, total = [], 0
+        for chunk in self._buscar(indice, consulta):
+            if total + chunk.tokens > self.orcamento_tokens:
+                continue
+            escolhidos.append(chunk)
+            total += chunk.tokens
+
+        if not escolhidos:
+            return completo
+
+        contexto = formatar_chunks(escolhidos)
+        return ContextoSelecionado(contexto, self.modo, contar_tokens(contexto), tuple(escolhidos))
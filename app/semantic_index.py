@@ -0,0 +1,213 @@
+"""
+Índice vetorial (denso) dos trechos da base de conhecimento.
+
+Os embeddings ficam em um arquivo .npy em disco e são abertos com
+`np.load(..., mmap_mode="r")`, de modo que vários workers do uvicorn
+compartilham as mesmas páginas de memória. A busca é um produto escalar
+vetorizado sobre vetores normalizados (similaridade de cosseno).
+
+A função de embedding é plugável: `HashingEmbedder` é determinística e roda
+offline (desenvolvimento e testes); `OpenAIEmbedder` usa a API de embeddings.
+Ao sincronizar, só os trechos cujo hash de conteúdo mudou são recalculados.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from textnorm import normalizar, termos
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem lock entre processos
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+KB_VECTOR_DIR = os.getenv("KB_VECTOR_DIR", str(Path(__file__).parent.parent / ".kb_vectors"))
+KB_EMBEDDER = os.getenv("KB_EMBEDDER", "openai")  # "openai" ou "hashing"
+KB_EMBEDDING_MODEL = os.getenv("KB_EMBEDDING_MODEL", "text-embedding-3-small")
+KB_SEMANTIC_MIN_SCORE = float(os.getenv("KB_SEMANTIC_MIN_SCORE", "0.2"))
+
+_ARQUIVO_VETORES = "embeddings.npy"
+_ARQUIVO_META = "chunks.json"
+
+
+class HashingEmbedder:
+    """
+    Embedding determinístico por feature hashing de radicais e trigramas
+    de caracteres. Não entende sinônimos, mas não depende de rede.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.nome = f"hashing-{dim}"
+
+    def _features(self, texto: str) -> List[str]:
+        features = [f"t:{t}" for t in termos(texto)]
+        for palavra in re.findall(r"[a-z0-9]+", normalizar(texto)):
+            marcada = f"#{palavra}#"
+            features.extend(f"c:{marcada[i:i + 3]}" for i in range(len(marcada) - 2))
+        return features
+
+    def __call__(self, textos: Sequence[str]) -> np.ndarray:
+        matriz = np.zeros((len(textos), self.dim), dtype=np.float32)
+        for linha, texto in enumerate(textos):
+            for feature in self._features(texto):
+                h = zlib.crc32(feature.encode("utf-8"))
+                matriz[linha, h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        return matriz
+
+
+class OpenAIEmbedder:
+    """Embeddings da OpenAI, em lotes."""
+
+    def __init__(self, client, model: str = KB_EMBEDDING_MODEL, lote: int = 128):
+        self.client = client
+        self.model = model
+        self.lote = lote
+        self.nome = f"openai-{model}"
+
+    def __call__(self, textos: Sequence[str]) -> np.ndarray:
+        vetores = []
+        for inicio in range(0, len(textos), self.lote):
+            resposta = self.client.embeddings.create(model=self.model, input=list(textos[inicio:inicio + self.lote]))
+            vetores.extend(item.embedding for item in resposta.data)
+        return np.asarray(vetores, dtype=np.float32)
+
+
+def criar_embedder(nome: str = KB_EMBEDDER, client=None) -> Callable[[Sequence[str]], np.ndarray]:
+    if nome == "hashing":
+        return HashingEmbedder()
+    if nome == "openai":
+        return OpenAIEmbedder(client)
+    raise ValueError(f"Embedder desconhecido: {nome}")
+
+
+def _normalizar_linhas(matriz: np.ndarray) -> np.ndarray:
+    normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+    normas[normas == 0] = 1.0
+    return (matriz / normas).astype(np.float32)
+
+
+def hash_conteudo(texto: str) -> str:
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+
+class SemanticIndex:
+    """
+    Matriz de embeddings (memmap) alinhada à lista de hashes dos trechos.
+    """
+
+    def __init__(self, embedder, diretorio: str = KB_VECTOR_DIR):
+        self.embedder = embedder
+        self.diretorio = Path(diretorio)
+        self._lock = threading.Lock()
+        self._hashes: List[str] = []
+        self._matriz: Optional[np.ndarray] = None
+
+    @contextmanager
+    def _lock_arquivo(self):
+        """Evita que dois workers recalculem e gravem o índice ao mesmo tempo."""
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+        with open(self.diretorio / ".lock", "w") as arquivo:
+            if fcntl:
+                fcntl.flock(arquivo, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(arquivo, fcntl.LOCK_UN)
+
+    def _carregar_do_disco(self) -> Tuple[List[str], Optional[np.ndarray]]:
+        try:
+            meta = json.loads((self.diretorio / _ARQUIVO_META).read_text(encoding="utf-8"))
+            if meta.get("embedder") != self.embedder.nome:
+                return [], None
+            matriz = np.load(self.diretorio / _ARQUIVO_VETORES, mmap_mode="r")
+            if matriz.shape[0] != len(meta["hashes"]):
+                return [], None
+            return meta["hashes"], matriz
+        except (FileNotFoundError, ValueError, KeyError):
+            return [], None
+
+    def sincronizar(self, textos: Sequence[str]) -> Optional[np.ndarray]:
+        """
+        Garante que o índice em disco corresponde a `textos`, na mesma ordem.
+        Reaproveita os vetores de trechos cujo hash não mudou. Retorna a
+        matriz alinhada a `textos` (None se não houver trechos).
+        """
+        hashes = [hash_conteudo(t) for t in textos]
+        with self._lock:
+            if hashes == self._hashes and self._matriz is not None:
+                return self._matriz
+
+            with self._lock_arquivo():
+                hashes_disco, matriz_disco = self._carregar_do_disco()
+                if hashes_disco == hashes and matriz_disco is not None:
+                    self._hashes, self._matriz = hashes, matriz_disco
+                    return self._matriz
+
+                if not hashes:
+                    self._hashes, self._matriz = [], None
+                    return None
+
+                existentes = {h: i for i, h in enumerate(hashes_disco)}
+                faltando = [i for i, h in enumerate(hashes) if h not in existentes]
+                novos = _normalizar_linhas(self.embedder([textos[i] for i in faltando])) if faltando else None
+
+                dim = novos.shape[1] if novos is not None else matriz_disco.shape[1]
+                matriz = np.zeros((len(hashes), dim), dtype=np.float32)
+                for i, h in enumerate(hashes):
+                    if h in existentes:
+                        matriz[i] = matriz_disco[existentes[h]]
+                if faltando:
+                    matriz[faltando] = novos
+
+                # Grava em arquivos temporários e troca de forma atômica
+                tmp_vetores = self.diretorio / f"{_ARQUIVO_VETORES}.{os.getpid()}.tmp"
+                with open(tmp_vetores, "wb") as arquivo:
+                    np.save(arquivo, matriz)
+                tmp_meta = self.diretorio / f"{_ARQUIVO_META}.{os.getpid()}.tmp"
+                tmp_meta.write_text(json.dumps({"embedder": self.embedder.nome, "hashes": hashes}), encoding="utf-8")
+                os.replace(tmp_vetores, self.diretorio / _ARQUIVO_VETORES)
+                os.replace(tmp_meta, self.diretorio / _ARQUIVO_META)
+
+                logger.info(
+                    "Índice vetorial atualizado: %d trechos, %d embeddings recalculados",
+                    len(hashes), len(faltando)
+                )
+                self._hashes = hashes
+                self._matriz = np.load(self.diretorio / _ARQUIVO_VETORES, mmap_mode="r")
+                return self._matriz
+
+    def buscar(
+        self,
+        consulta: str,
+        k: int,
+        min_score: float = KB_SEMANTIC_MIN_SCORE,
+        matriz: Optional[np.ndarray] = None,
+    ) -> List[Tuple[float, int]]:
+        """
+        Retorna (similaridade, posição do trecho) dos k mais similares. Passe
+        a `matriz` retornada por `sincronizar` para buscar sempre na mesma
+        versão dos trechos, mesmo que o índice seja atualizado no meio.
+        """
+        matriz = self._matriz if matriz is None else matriz
+        if matriz is None or matriz.shape[0] == 0:
+            return []
+        vetor = _normalizar_linhas(self.embedder([consulta]))[0]
+        similaridades = matriz @ vetor
+        k = min(k, similaridades.shape[0])
+        melhores = np.argpartition(-similaridades, k - 1)[:k]
+        melhores = melhores[np.argsort(-similaridades[melhores])]
+        return [(float(similaridades[i]), int(i)) for i in melhores if similaridades[i] >= min_score]
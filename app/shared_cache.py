@@ -0,0 +1,402 @@
+"""
+Caches compartilhados entre processos (workers da API e bot do Telegram).
+
+Com CACHE_BACKEND=redis, os caches de chats ativos, perfis, resumos e
+intenções guardam os valores também em um servidor com protocolo Redis,
+sob chaves `{CACHE_KEY_PREFIX}:{namespace}:{chave}` e com o mesmo TTL do
+cache. Um processo que não tem o valor em memória o busca lá antes de ir
+ao banco ou à OpenAI, então o cache aquecido por um worker serve a todos.
+
+Cada processo mantém uma cópia local (near-cache, o próprio TTLCache) com
+TTL de no máximo CACHE_NEAR_TTL_SECONDS, e as leituras quentes não saem da
+memória. Quem grava ou remove um valor publica a chave no canal
+`{CACHE_KEY_PREFIX}:invalidacoes`, e os outros processos descartam a cópia
+local. Se uma invalidação se perder, a cópia dura no máximo o TTL local.
+
+Sem CACHE_BACKEND (padrão `local`), `SharedCaches.criar` devolve um
+TTLCache comum e nada sai do processo. `LocalBackend` implementa o mesmo
+protocolo em memória, para testes e desenvolvimento sem Redis.
+
+Falhas do servidor não interrompem as requisições: o cache se comporta
+como se a chave não existisse e a falha é contada em `stats`.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# local (padrão, só memória do processo), redis ou memoria (stand-in, um processo só)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local").lower()
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_KEY_PREFIX = os.getenv("CACHE_KEY_PREFIX", "chatbot")
+CACHE_NEAR_TTL_SECONDS = float(os.getenv("CACHE_NEAR_TTL_SECONDS", "30"))
+
+_AUSENTE = object()
+
+
+def chave_json(chave: Hashable) -> str:
+    """Forma textual e estável de uma chave (tuplas viram listas)."""
+    return json.dumps(chave, ensure_ascii=False, separators=(",", ":"))
+
+
+def como_chave(valor: Any) -> Hashable:
+    """Desfaz `chave_json` depois do json.loads (listas voltam a ser tuplas)."""
+    if isinstance(valor, list):
+        return tuple(como_chave(v) for v in valor)
+    return valor
+
+
+_DELETE_SE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+
+class RedisBackend:
+    """Servidor com protocolo Redis (GET, SET PX [NX], DEL, EVAL, PUBLISH, SUBSCRIBE)."""
+
+    def __init__(self, url: str = CACHE_REDIS_URL):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND=redis requer o pacote redis (pip install redis)") from e
+        self.url = url
+        self._redis = redis.from_url(url)
+
+    async def get(self, chave: str) -> Optional[bytes]:
+        return await self._redis.get(chave)
+
+    async def set(self, chave: str, valor: str, ttl: float):
+        await self._redis.set(chave, valor, px=max(1, int(ttl * 1000)))
+
+    async def delete(self, chave: str):
+        await self._redis.delete(chave)
+
+    async def set_nx(self, chave: str, valor: str, ttl: float) -> bool:
+        return bool(await self._redis.set(chave, valor, px=max(1, int(ttl * 1000)), nx=True))
+
+    async def delete_se(self, chave: str, valor: str):
+        """Remove a chave só se ela ainda guardar `valor` (atômico, via script)."""
+        await self._redis.eval(_DELETE_SE, 1, chave, valor)
+
+    async def publish(self, canal: str, mensagem: str):
+        await self._redis.publish(canal, mensagem)
+
+    async def assinar(self, canal: str, callback: Callable[[Union[str, bytes]], None], pronto: asyncio.Event):
+        """
+        Entrega as mensagens do canal a `callback` até ser cancelado; marca
+        `pronto` quando a assinatura está ativa e reconecta após falhas.
+        """
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(canal)
+                pronto.set()
+                async for mensagem in pubsub.listen():
+                    if mensagem["type"] == "message":
+                        callback(mensagem["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Assinatura de {canal} interrompida: {e}; reconectando")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def fechar(self):
+        await self._redis.aclose()
+
+
+class LocalBackend:
+    """
+    Stand-in em memória do RedisBackend. Caches de vários `SharedCaches`
+    que usam a mesma instância se comportam como processos diferentes
+    ligados ao mesmo servidor.
+    """
+
+    def __init__(self, relogio: Callable[[], float] = time.monotonic):
+        self._relogio = relogio
+        self._dados: Dict[str, tuple] = {}
+        self._assinantes: Dict[str, List[asyncio.Queue]] = defaultdict(list)
+
+    async def get(self, chave: str) -> Optional[str]:
+        item = self._dados.get(chave)
+        if item is None:
+            return None
+        if item[1] <= self._relogio():
+            del self._dados[chave]
+            return None
+        return item[0]
+
+    async def set(self, chave: str, valor: str, ttl: float):
+        self._dados[chave] = (valor, self._relogio() + ttl)
+
+    async def delete(self, chave: str):
+        self._dados.pop(chave, None)
+
+    async def set_nx(self, chave: str, valor: str, ttl: float) -> bool:
+        if await self.get(chave) is not None:
+            return False
+        await self.set(chave, valor, ttl)
+        return True
+
+    async def delete_se(self, chave: str, valor: str):
+        if await self.get(chave) == valor:
+            await self.delete(chave)
+
+    async def publish(self, canal: str, mensagem: str):
+        for fila in self._assinantes[canal]:
+            fila.put_nowait(mensagem)
+
+    async def assinar(self, canal: str, callback: Callable[[Union[str, bytes]], None], pronto: asyncio.Event):
+        fila: asyncio.Queue = asyncio.Queue()
+        self._assinantes[canal].append(fila)
+        pronto.set()
+        try:
+            while True:
+                callback(await fila.get())
+        finally:
+            self._assinantes[canal].remove(fila)
+
+    async def fechar(self):
+        pass
+
+
+def criar_backend(nome: str = CACHE_BACKEND):
+    """Backend configurado em CACHE_BACKEND, ou None (caches só locais)."""
+    if nome == "redis":
+        return RedisBackend()
+    if nome == "memoria":
+        return LocalBackend()
+    if nome != "local":
+        logger.warning(f"CACHE_BACKEND desconhecido: {nome}; usando caches locais")
+    return None
+
+
+class SharedCache(TTLCache):
+    """
+    TTLCache local (near-cache) na frente do backend compartilhado. Os
+    métodos síncronos herdados só mexem na cópia local; `obter`, `guardar`
+    e `remover` também consultam, gravam e invalidam no backend.
+    """
+
+    def __init__(
+        self,
+        caches: "SharedCaches",
+        namespace: str,
+        max_itens: int,
+        ttl: float,
+        para_json: Optional[Callable[[Any], Any]] = None,
+        de_json: Optional[Callable[[Any], Any]] = None,
+    ):
+        super().__init__(max_itens, min(ttl, caches.ttl_local))
+        self.caches = caches
+        self.namespace = namespace
+        self.ttl_remoto = ttl
+        self._para_json = para_json or (lambda valor: valor)
+        self._de_json = de_json or (lambda valor: valor)
+        # Muda a cada invalidação; uma leitura remota que cruzou com uma
+        # invalidação não é guardada na cópia local
+        self._geracao = 0
+        self.acertos_remotos = 0
+        self.faltas_remotas = 0
+        self.erros_remotos = 0
+
+    def _chave_remota(self, chave: Hashable) -> str:
+        return f"{self.caches.prefixo}:{self.namespace}:{chave_json(chave)}"
+
+    async def obter(self, chave: Hashable, padrao: Any = None) -> Any:
+        valor = self.get(chave, _AUSENTE)
+        if valor is not _AUSENTE:
+            return valor
+        geracao = self._geracao
+        try:
+            bruto = await self.caches.backend.get(self._chave_remota(chave))
+        except Exception as e:
+            self.erros_remotos += 1
+            logger.warning(f"Erro ao ler {self.namespace} do cache compartilhado: {e}")
+            return padrao
+        if bruto is None:
+            self.faltas_remotas += 1
+            return padrao
+        self.acertos_remotos += 1
+        valor = self._de_json(json.loads(bruto))
+        if geracao == self._geracao:
+            self.set(chave, valor)
+        return valor
+
+    async def guardar(self, chave: Hashable, valor: Any, ttl: Optional[float] = None):
+        ttl = self.ttl_remoto if ttl is None else ttl
+        self.set(chave, valor, min(ttl, self.ttl))
+        try:
+            await self.caches.backend.set(
+                self._chave_remota(chave), json.dumps(self._para_json(valor), ensure_ascii=False), ttl
+            )
+            await self.caches.publicar(self.namespace, chave)
+        except Exception as e:
+            self.erros_remotos += 1
+            logger.warning(f"Erro ao gravar {self.namespace} no cache compartilhado: {e}")
+
+    async def remover(self, chave: Hashable, padrao: Any = None) -> Any:
+        self._geracao += 1
+        valor = self.pop(chave, padrao)
+        try:
+            await self.caches.backend.delete(self._chave_remota(chave))
+            await self.caches.publicar(self.namespace, chave)
+        except Exception as e:
+            self.erros_remotos += 1
+            logger.warning(f"Erro ao remover {self.namespace} do cache compartilhado: {e}")
+        return valor
+
+    async def reservar(self, chave: Hashable, valor: Any, ttl: Optional[float] = None) -> bool:
+        """
+        Reserva a chave no backend (SET NX), sem cópia local. Se o backend
+        falhar, retorna True: sem a trava, o pior caso é calcular em dobro.
+        """
+        ttl = self.ttl_remoto if ttl is None else ttl
+        try:
+            return await self.caches.backend.set_nx(
+                self._chave_remota(chave), json.dumps(self._para_json(valor), ensure_ascii=False), ttl
+            )
+        except Exception as e:
+            self.erros_remotos += 1
+            logger.warning(f"Erro ao reservar {self.namespace} no cache compartilhado: {e}")
+            return True
+
+    async def liberar(self, chave: Hashable, valor: Any):
+        try:
+            await self.caches.backend.delete_se(
+                self._chave_remota(chave), json.dumps(self._para_json(valor), ensure_ascii=False)
+            )
+        except Exception as e:
+            self.erros_remotos += 1
+            logger.warning(f"Erro ao liberar {self.namespace} no cache compartilhado: {e}")
+
+    async def consultar(self, chave: Hashable, padrao: Any = None) -> Any:
+        """Lê direto do backend, sem usar nem preencher a cópia local."""
+        try:
+            bruto = await self.caches.backend.get(self._chave_remota(chave))
+        except Exception as e:
+            self.erros_remotos += 1
+            logger.warning(f"Erro ao ler {self.namespace} do cache compartilhado: {e}")
+            return padrao
+        return padrao if bruto is None else self._de_json(json.loads(bruto))
+
+    def invalidar_local(self, chave: Hashable):
+        """Descarta a cópia local (invalidação vinda de outro processo)."""
+        self._geracao += 1
+        self.pop(chave)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["remoto"] = {
+            "acertos": self.acertos_remotos,
+            "faltas": self.faltas_remotas,
+            "erros": self.erros_remotos,
+        }
+        return stats
+
+
+class SharedCaches:
+    """Cria os caches de um processo e distribui as invalidações recebidas."""
+
+    def __init__(self, backend=None, prefixo: str = CACHE_KEY_PREFIX, ttl_local: float = CACHE_NEAR_TTL_SECONDS):
+        self.backend = backend
+        self.prefixo = prefixo
+        self.ttl_local = ttl_local
+        # Identifica este processo, para ignorar as próprias invalidações
+        self.origem = uuid.uuid4().hex
+        self._ouvintes: Dict[str, List[Callable[[Hashable], None]]] = defaultdict(list)
+        self._assinatura: Optional[asyncio.Task] = None
+        self.invalidacoes_enviadas = 0
+        self.invalidacoes_recebidas = 0
+
+    @property
+    def canal(self) -> str:
+        return f"{self.prefixo}:invalidacoes"
+
+    def criar(
+        self,
+        namespace: str,
+        max_itens: int,
+        ttl: float,
+        para_json: Optional[Callable[[Any], Any]] = None,
+        de_json: Optional[Callable[[Any], Any]] = None,
+    ) -> TTLCache:
+        """
+        Cache do `namespace`. Sem backend, um TTLCache comum. `para_json` e
+        `de_json` convertem valores que não são JSON (ex.: dataclasses).
+        """
+        if self.backend is None:
+            return TTLCache(max_itens, ttl)
+        cache = SharedCache(self, namespace, max_itens, ttl, para_json, de_json)
+        self.ao_invalidar(namespace, cache.invalidar_local)
+        return cache
+
+    def ao_invalidar(self, namespace: str, callback: Callable[[Hashable], None]):
+        """Chama `callback(chave)` quando outro processo invalidar uma chave do namespace."""
+        self._ouvintes[namespace].append(callback)
+
+    async def invalidar(self, namespace: str, chave: Hashable):
+        """
+        Avisa os outros processos, sem guardar nada no backend (para dados
+        que cada processo mantém só em memória, como as janelas do histórico).
+        """
+        if self.backend is None:
+            return
+        try:
+            await self.publicar(namespace, chave)
+        except Exception as e:
+            logger.warning(f"Erro ao publicar invalidação de {namespace}: {e}")
+
+    async def publicar(self, namespace: str, chave: Hashable):
+        mensagem = json.dumps({"o": self.origem, "n": namespace, "c": chave_json(chave)}, ensure_ascii=False)
+        await self.backend.publish(self.canal, mensagem)
+        self.invalidacoes_enviadas += 1
+
+    def _receber(self, mensagem: Union[str, bytes]):
+        try:
+            dados = json.loads(mensagem)
+            if dados["o"] == self.origem:
+                return
+            chave = como_chave(json.loads(dados["c"]))
+        except Exception as e:
+            logger.warning(f"Invalidação inválida no canal {self.canal}: {e}")
+            return
+        self.invalidacoes_recebidas += 1
+        for callback in self._ouvintes.get(dados["n"], ()):
+            callback(chave)
+
+    async def iniciar(self):
+        """Assina o canal de invalidações (precisa do event loop)."""
+        if self.backend is None or self._assinatura is not None:
+            return
+        pronto = asyncio.Event()
+        self._assinatura = asyncio.create_task(self.backend.assinar(self.canal, self._receber, pronto))
+        try:
+            await asyncio.wait_for(pronto.wait(), 5)
+        except asyncio.TimeoutError:
+            # Segue sem esperar; até a assinatura ficar ativa, cópias locais
+            # desatualizadas duram no máximo CACHE_NEAR_TTL_SECONDS
+            logger.warning(f"Assinatura de {self.canal} ainda não ativa; seguindo sem ela")
+
+    async def parar(self):
+        if self._assinatura is not None:
+            self._assinatura.cancel()
+            await asyncio.gather(self._assinatura, return_exceptions=True)
+            self._assinatura = None
+        if self.backend is not None:
+            await self.backend.fechar()
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__ if self.backend is not None else "local",
+            "invalidacoes_enviadas": self.invalidacoes_enviadas,
+            "invalidacoes_recebidas": self.invalidacoes_recebidas,
+        }
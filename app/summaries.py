@@ -0,0 +1,213 @@
+"""
+Compactação do histórico por orçamento de tokens, com resumo acumulado.
+
+As mensagens mais recentes entram no prompt na íntegra enquanto couberem em
+HISTORY_TOKEN_BUDGET (contados com o tokenizer local, ver tokens.py). As
+mais antigas são representadas por um resumo por chat, guardado na tabela
+`chat_summaries` junto com o created_at da última mensagem que ele cobre.
+
+O resumo não é gerado durante o turno: depois da resposta, se já houver
+HISTORY_SUMMARY_MIN_MESSAGES mensagens fora do orçamento e ainda não
+resumidas, um novo resumo é gerado em segundo plano a partir do anterior
+mais essas mensagens. Até lá, essas poucas mensagens ficam de fora do prompt.
+"""
+
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from metrics import metrics
+from persistence import executar
+from shared_cache import SharedCaches
+from tokens import contar_tokens
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+HISTORY_SUMMARY_MIN_MESSAGES = int(os.getenv("HISTORY_SUMMARY_MIN_MESSAGES", "4"))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "400"))
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gpt-4o-mini")
+HISTORY_SUMMARY_CACHE_TTL_SECONDS = float(os.getenv("HISTORY_SUMMARY_CACHE_TTL_SECONDS", "3600"))
+HISTORY_SUMMARY_CACHE_MAX_ITEMS = int(os.getenv("HISTORY_SUMMARY_CACHE_MAX_ITEMS", "10000"))
+
+# Custo aproximado da marcação de cada mensagem no prompt ("[Mensagem i - ...]")
+_TOKENS_POR_MENSAGEM = 8
+
+PROMPT_RESUMO = """
+Você resume conversas de um chatbot acolhedor voltado para pessoas trans, que orienta sobre retificação de nome, hormonização e prevenção a ISTs.
+
+Atualize o resumo da conversa com as novas mensagens. Mantenha:
+- a situação e as necessidades que a pessoa contou (cidade, etapa do processo, documentos, dúvidas);
+- as orientações e encaminhamentos já dados pelo assistente;
+- perguntas que ficaram em aberto.
+
+Não invente informações. Escreva em português, em tópicos curtos, com no máximo 200 palavras.
+Responda apenas com o resumo atualizado.
+""".strip()
+
+# Marca de "chat sem resumo" no cache
+_SEM_RESUMO = object()
+
+
+@dataclass(frozen=True)
+class Resumo:
+    texto: str
+    # created_at da última mensagem coberta pelo resumo
+    ate: str
+
+
+@dataclass
+class HistoricoCompactado:
+    # Mensagens mais recentes, na íntegra, em ordem cronológica
+    recentes: List[dict]
+    resumo: Optional[Resumo]
+    # Mensagens fora do orçamento que o resumo ainda não cobre
+    pendentes: List[dict] = field(default_factory=list)
+    tokens: int = 0
+
+    @property
+    def desatualizado(self) -> bool:
+        return len(self.pendentes) >= HISTORY_SUMMARY_MIN_MESSAGES
+
+
+def tokens_mensagem(mensagem: dict) -> int:
+    return contar_tokens(mensagem['content']) + _TOKENS_POR_MENSAGEM
+
+
+def compactar(historico: List[dict], resumo: Optional[Resumo], orcamento: int = HISTORY_TOKEN_BUDGET) -> HistoricoCompactado:
+    """
+    Mantém as mensagens mais recentes que cabem em `orcamento` tokens (o
+    resumo, se houver, conta no orçamento). A última mensagem sempre entra.
+    """
+    tokens = contar_tokens(resumo.texto) if resumo else 0
+    inicio = len(historico)
+    while inicio > 0:
+        custo = tokens_mensagem(historico[inicio - 1])
+        if tokens + custo > orcamento and inicio < len(historico):
+            break
+        tokens += custo
+        inicio -= 1
+
+    antigas = historico[:inicio]
+    # created_at é ISO sem fuso (TIMESTAMP), então a comparação de texto segue a ordem cronológica
+    pendentes = [
+        m for m in antigas
+        if resumo is None or not m.get('created_at') or m['created_at'] > resumo.ate
+    ]
+    return HistoricoCompactado(recentes=historico[inicio:], resumo=resumo, pendentes=pendentes, tokens=tokens)
+
+
+def _para_json(resumo) -> Optional[list]:
+    return None if resumo is _SEM_RESUMO else [resumo.texto, resumo.ate]
+
+
+def _de_json(dados: Optional[list]):
+    return _SEM_RESUMO if dados is None else Resumo(*dados)
+
+
+def _transcricao(mensagens: List[dict]) -> str:
+    linhas = []
+    for msg in mensagens:
+        role_label = "USUÁRIO" if msg['role'] == 'user' else "ASSISTENTE"
+        linhas.append(f"{role_label}: {msg['content']}")
+    return "\n\n".join(linhas)
+
+
+class ChatSummaries:
+    """Resumos por chat: cache em memória na frente da tabela `chat_summaries`."""
+
+    def __init__(
+        self,
+        supabase,
+        client,
+        modelo: str = HISTORY_SUMMARY_MODEL,
+        max_tokens: int = HISTORY_SUMMARY_MAX_TOKENS,
+        ttl: float = HISTORY_SUMMARY_CACHE_TTL_SECONDS,
+        max_itens: int = HISTORY_SUMMARY_CACHE_MAX_ITEMS,
+        caches: Optional[SharedCaches] = None,
+    ):
+        self.supabase = supabase
+        self.client = client
+        self.modelo = modelo
+        self.max_tokens = max_tokens
+        self._cache = (caches or SharedCaches()).criar(
+            "resumos", max_itens, ttl, para_json=_para_json, de_json=_de_json
+        )
+        # Chats com resumo sendo gerado (um por vez por chat)
+        self._gerando: Dict[int, asyncio.Task] = {}
+
+    async def obter(self, chat_id: int) -> Optional[Resumo]:
+        """Resumo atual do chat, ou None. Falhas de leitura contam como "sem resumo"."""
+        resumo = await self._cache.obter(chat_id)
+        if resumo is not None:
+            return None if resumo is _SEM_RESUMO else resumo
+        try:
+            result = await executar(
+                self.supabase.table('chat_summaries').select('resumo, ate').eq('chat_id', chat_id).limit(1)
+            )
+        except Exception as e:
+            logger.error(f"Erro ao buscar resumo do chat {chat_id}: {e}")
+            return None
+        resumo = Resumo(result.data[0]['resumo'], result.data[0]['ate']) if result.data else None
+        await self._cache.guardar(chat_id, resumo or _SEM_RESUMO)
+        return resumo
+
+    async def atualizar(self, chat_id: int, compactado: HistoricoCompactado):
+        """
+        Gera e grava um novo resumo se o atual estiver desatualizado.
+        Feito para rodar em segundo plano, depois da resposta.
+        """
+        if not compactado.desatualizado or chat_id in self._gerando:
+            return
+        self._gerando[chat_id] = asyncio.current_task()
+        try:
+            await self._gerar(chat_id, compactado.resumo, compactado.pendentes)
+        except Exception as e:
+            metrics.incr("resumo_historico_falhas")
+            logger.error(f"Erro ao gerar resumo do chat {chat_id}: {e}")
+        finally:
+            self._gerando.pop(chat_id, None)
+
+    async def _gerar(self, chat_id: int, anterior: Optional[Resumo], pendentes: List[dict]):
+        ate = pendentes[-1].get('created_at')
+        if not ate:
+            return  # sem created_at não há como marcar até onde o resumo vai
+
+        conteudo = f"RESUMO ATUAL:\n{anterior.texto if anterior else '(nenhum)'}\n\nNOVAS MENSAGENS:\n{_transcricao(pendentes)}"
+        resp = await self.client.chat.completions.create(
+            model=self.modelo,
+            messages=[
+                {"role": "system", "content": PROMPT_RESUMO},
+                {"role": "user", "content": conteudo},
+            ],
+            temperature=0.2,
+            max_tokens=self.max_tokens,
+        )
+        texto = (resp.choices[0].message.content or "").strip()
+        if not texto:
+            return
+
+        atual = await self._cache.obter(chat_id)
+        if isinstance(atual, Resumo) and atual.ate >= ate:
+            return  # já existe resumo até aqui ou além
+        resumo = Resumo(texto, ate)
+        await executar(
+            self.supabase.table('chat_summaries').upsert(
+                {'chat_id': chat_id, 'resumo': texto, 'ate': ate, 'updated_at': datetime.now().isoformat()},
+                on_conflict='chat_id',
+            )
+        )
+        await self._cache.guardar(chat_id, resumo)
+        metrics.incr("resumo_historico_gerado")
+        metrics.observe("resumo_historico_mensagens", len(pendentes))
+
+    async def invalidar(self, chat_id: int):
+        await self._cache.remover(chat_id)
+
+    def stats(self) -> dict:
+        stats = self._cache.stats()
+        stats["gerando"] = len(self._gerando)
+        return stats
@@ -1,10 +1,18 @@
 """
 Bot do Telegram para integração com o sistema de AI
 Permite que usuários conversem diretamente com a IA através do Telegram
+
+O pipeline de cada mensagem é o mesmo da API (chat_engine.py). O bot roda
+de duas formas:
+- webhook, dentro do processo da API (TELEGRAM_WEBHOOK_URL no .env; ver
+  main.py), compartilhando caches, conexões e métricas com ela;
+- long-polling, em um processo próprio: `python app/telegram_bot.py`.
 """
 
 import os
 import logging
+import time
+from functools import wraps
 from pathlib import Path
 from typing import Optional
 from dotenv import load_dotenv
@@ -16,145 +24,59 @@ from telegram.ext import (
     filters,
     ContextTypes,
 )
-from openai import OpenAI
-from supabase import create_client, Client
-from datetime import datetime
-
-# Configuração de logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+from openai import OpenAI, AsyncOpenAI
+from supabase import create_client, acreate_client
+
 logger = logging.getLogger(__name__)
 
 # Carrega variáveis de ambiente
 env_path = Path(__file__).parent.parent / '.env'
 load_dotenv(dotenv_path=env_path, override=True)
 
+# Lê a configuração do ambiente ao ser importado, então vem depois do load_dotenv
+from chat_engine import BaseIndisponivel, ChatEngine, ChatPreparado
+from chat_sessions import BloqueiosPorChave
+from metrics import metrics
+from telegram_envio import LimitadorEnvio
+from telegram_sessions import TelegramSessions, criar_armazenamento
+from telegram_stream import RespostaProgressiva
+
 # Configurações
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
-
-# Clientes
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Updates processados ao mesmo tempo (de usuários diferentes)
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "64"))
 
 # Configurações do sistema
 LINK_APLICACAO = "http://localhost:5173"  # Link da aplicação web
 MENSAGENS_ANTES_LINK = 5  # Número de mensagens antes de enviar o link
+# Instruções que só valem no Telegram (vão depois da parte estática do prompt)
+INSTRUCOES_TELEGRAM = ["Suas respostas devem ser diretas e objetivas (máximo 4 parágrafos)"]
 
-# Armazena os chat_ids e contadores em memória (pode ser substituído por banco de dados)
-user_sessions = {}
-message_counters = {}  # Contador de mensagens por usuário
-link_sent = {}  # Controla se o link já foi enviado para o usuário
-
-def get_contexto_artigos():
-    """
-    Busca e concatena todos os arquivos .md do bucket Supabase.
-    Retorna o contexto como string.
-    """
-    try:
-        files = supabase.storage.from_(SUPABASE_BUCKET).list()
-        contexto = ""
-
-        for file in files:
-            file_name = file.get('name', '')
-
-            if file_name.lower().endswith('.md'):
-                try:
-                    response = supabase.storage.from_(SUPABASE_BUCKET).download(file_name)
-                    conteudo = response.decode('utf-8')
-                    contexto += f"\n\n{'='*50}\n"
-                    contexto += f"CONTEÚDO DO ARQUIVO: {file_name}\n"
-                    contexto += f"{'='*50}\n\n"
-                    contexto += conteudo
-                except Exception as e:
-                    logger.error(f"Erro ao processar arquivo {file_name}: {e}")
-
-        return contexto
-    except Exception as e:
-        logger.error(f"Erro ao buscar contexto: {e}")
-        return ""
-
-def get_or_create_chat(telegram_user_id: int):
-    """
-    Busca ou cria um chat ativo para o usuário do Telegram.
-    Retorna o ID do chat.
-    """
-    try:
-        # Usa o Telegram user_id como session_id
-        session_id = f"telegram_{telegram_user_id}"
-
-        # Busca um chat ativo existente
-        result = supabase.table('chats').select('id').eq('session_id', session_id).eq('is_active', True).order('created_at', desc=True).limit(1).execute()
-
-        # Se encontrou um chat ativo, retorna o ID
-        if result and result.data:
-            return result.data[0]['id']
-
-        # Caso contrário, cria um novo chat
-        new_chat = {
-            'user_id': None,  # Usuários do Telegram não têm user_id no sistema
-            'session_id': session_id,
-            'title': f'Telegram Chat - User {telegram_user_id}',
-            'is_active': True,
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
-        }
+# Mensagens de um mesmo usuário são atendidas uma de cada vez, na ordem de chegada
+usuarios_em_atendimento = BloqueiosPorChave()
 
-        result = supabase.table('chats').insert(new_chat).execute()
-        return result.data[0]['id']
+def session_id_telegram(telegram_user_id: int) -> str:
+    """Usuários do Telegram não têm user_id no sistema; o chat é da sessão."""
+    return f"telegram_{telegram_user_id}"
 
-    except Exception as e:
-        logger.error(f"Erro ao buscar/criar chat: {e}")
-        raise
-
-def get_chat_history(chat_id: int, limit: int = 30):
+def em_ordem_por_usuario(handler):
     """
-    Busca as últimas mensagens de um chat.
-    Retorna lista de mensagens no formato [{"role": "user/assistant", "content": "..."}]
+    Os updates são processados em paralelo (concurrent_updates); este
+    decorador mantém a ordem entre os updates de um mesmo usuário.
+    O lock é a primeira coisa aguardada pelo handler, então a ordem de
+    espera é a ordem em que o Telegram entregou os updates.
     """
-    try:
-        result = supabase.table('chat_messages').select('role, content').eq('chat_id', chat_id).order('created_at', desc=False).limit(limit).execute()
-
-        if not result.data:
-            return []
-
-        messages = []
-        for msg in result.data:
-            messages.append({
-                "role": msg['role'],
-                "content": msg['content']
-            })
-
-        return messages
-
-    except Exception as e:
-        logger.error(f"Erro ao buscar histórico: {e}")
-        return []
-
-def save_message(chat_id: int, role: str, content: str):
-    """
-    Salva uma mensagem no banco de dados.
-    """
-    try:
-        message = {
-            'chat_id': chat_id,
-            'role': role,
-            'content': content,
-            'created_at': datetime.now().isoformat()
-        }
-
-        supabase.table('chat_messages').insert(message).execute()
-
-        # Atualiza o timestamp do chat
-        supabase.table('chats').update({'updated_at': datetime.now().isoformat()}).eq('id', chat_id).execute()
-
-    except Exception as e:
-        logger.error(f"Erro ao salvar mensagem: {e}")
+    @wraps(handler)
+    async def em_ordem(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        inicio = time.perf_counter()
+        async with usuarios_em_atendimento.bloqueio(update.effective_user.id):
+            metrics.observe("telegram_espera_usuario_ms", (time.perf_counter() - inicio) * 1000)
+            return await handler(update, context)
+    return em_ordem
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler para o comando /start"""
@@ -202,22 +124,18 @@ Basta enviar sua pergunta que eu respondo! 💜
 """
     await update.message.reply_text(help_message)
 
+@em_ordem_por_usuario
 async def new_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler para o comando /novo - inicia uma nova conversa"""
     telegram_user_id = update.effective_user.id
-    session_id = f"telegram_{telegram_user_id}"
+    engine: ChatEngine = context.bot_data["engine"]
 
     try:
-        # Desativa o chat atual
-        supabase.table('chats').update({'is_active': False}).eq('session_id', session_id).eq('is_active', True).execute()
+        # Desativa o chat atual; o novo é criado na próxima mensagem
+        await engine.novo_chat(None, session_id_telegram(telegram_user_id), criar=False)
 
-        # Remove da sessão em memória e reseta contadores
-        if telegram_user_id in user_sessions:
-            del user_sessions[telegram_user_id]
-        if telegram_user_id in message_counters:
-            del message_counters[telegram_user_id]
-        if telegram_user_id in link_sent:
-            del link_sent[telegram_user_id]
+        # Reseta contadores
+        context.bot_data["sessoes"].reiniciar(telegram_user_id)
 
         await update.message.reply_text("✨ Nova conversa iniciada! Como posso te ajudar?")
         logger.info(f"Usuário {telegram_user_id} iniciou nova conversa")
@@ -226,115 +144,88 @@ async def new_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Erro ao iniciar nova conversa: {e}")
         await update.message.reply_text("Desculpe, ocorreu um erro ao iniciar nova conversa. Tente novamente.")
 
+async def responder_em_stream(engine: ChatEngine, preparo: ChatPreparado, resposta_progressiva: RespostaProgressiva):
+    """Gera a resposta em stream, exibe conforme chega e salva o turno."""
+    await resposta_progressiva.iniciar()
+    partes = []
+    usage = None
+    salvo = False
+    try:
+        stream = await engine.completar_stream(preparo)
+        async for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            partes.append(chunk.choices[0].delta.content)
+            await resposta_progressiva.acrescentar(partes[-1])
+
+        resposta = "".join(partes)
+        if not resposta.strip():
+            raise RuntimeError("resposta vazia da OpenAI")
+        engine.registrar_metricas(preparo, usage, canal="telegram")
+
+        # 9. Exibe a resposta completa
+        await resposta_progressiva.finalizar()
+        await engine.guardar_resposta_frequente(preparo, resposta, usage)
+
+        # 10. Salva a mensagem do usuário e a resposta no banco
+        await engine.salvar_turno(preparo, resposta)
+        salvo = True
+    finally:
+        # Geração ou envio interrompidos: salva o que foi gerado
+        if not salvo and partes:
+            metrics.incr("telegram_stream_interrompido")
+            engine.disparar_em_segundo_plano(engine.salvar_turno(preparo, "".join(partes)))
+
+@em_ordem_por_usuario
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler para mensagens de texto"""
     telegram_user_id = update.effective_user.id
     user_message = update.message.text
+    inicio = time.perf_counter()
 
     logger.info(f"Mensagem recebida de {telegram_user_id}: {user_message}")
 
     # Envia indicação de "digitando..."
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
 
-    try:
-        # 1. Busca ou cria um chat para o usuário
-        chat_id = get_or_create_chat(telegram_user_id)
-        user_sessions[telegram_user_id] = chat_id
-
-        # 2. Busca o histórico de mensagens
-        historico = get_chat_history(chat_id, limit=30)
+    engine: ChatEngine = context.bot_data["engine"]
+    resposta_progressiva: Optional[RespostaProgressiva] = None
 
-        # 3. Busca o contexto dos artigos
-        contexto = get_contexto_artigos()
-
-        if not contexto:
+    try:
+        # 1-7. Chat, histórico, base, intenção e prompt (mesmo pipeline da API)
+        try:
+            preparo = await engine.preparar(
+                user_message,
+                session_id=session_id_telegram(telegram_user_id),
+                instrucoes_canal=INSTRUCOES_TELEGRAM,
+                titulo_chat=f'Telegram Chat - User {telegram_user_id}',
+            )
+        except BaseIndisponivel:
             await update.message.reply_text("Desculpe, estou com problemas para acessar minha base de conhecimento. Tente novamente mais tarde.")
             return
 
-        # 4. Monta o prompt do sistema
-        prompt_sistema = f"""
-════════════════════════════════════════════════════════════════════════════════
-📚 SEÇÃO 1: BASE DE CONHECIMENTO (Artigos de Referência)
-════════════════════════════════════════════════════════════════════════════════
-
-{contexto}
-
-════════════════════════════════════════════════════════════════════════════════
-🎯 INSTRUÇÕES PARA O ASSISTENTE
-════════════════════════════════════════════════════════════════════════════════
-
-Você é um assistente especializado em orientar pessoas trans sobre:
-- Retificação de nome e gênero
-- Terapia hormonal (hormonização)
-- Prevenção e tratamento de ISTs
-
-IMPORTANTE:
-- Use APENAS as informações da BASE DE CONHECIMENTO acima
-- Se houver HISTÓRICO DE CONVERSAS abaixo, mantenha coerência com elas
-- Responda de forma sucinta, acolhedora e respeitosa
-- Use emojis e linguagem inclusiva quando apropriado
-- Se não souber algo que não está na base de conhecimento, seja honesto
-- Suas respostas devem ser diretas e objetivas (máximo 4 parágrafos)
-
-════════════════════════════════════════════════════════════════════════════════
-"""
-
-        # 5. Monta a lista de mensagens
-        messages = [{"role": "system", "content": prompt_sistema}]
-
-        # 6. Adiciona o histórico
-        if historico:
-            historico_formatado = "\n════════════════════════════════════════════════════════════════════════════════\n"
-            historico_formatado += f"💬 SEÇÃO 2: HISTÓRICO DA CONVERSA ({len(historico)} mensagens anteriores)\n"
-            historico_formatado += "════════════════════════════════════════════════════════════════════════════════\n\n"
-
-            for i, msg in enumerate(historico, 1):
-                role_label = "USUÁRIO" if msg['role'] == 'user' else "ASSISTENTE"
-                historico_formatado += f"[Mensagem {i} - {role_label}]:\n{msg['content']}\n\n"
-
-            historico_formatado += "════════════════════════════════════════════════════════════════════════════════\n"
-
-            messages.append({"role": "system", "content": historico_formatado})
-
-        # 7. Adiciona a pergunta atual
-        mensagem_atual = f"""
-════════════════════════════════════════════════════════════════════════════════
-❓ SEÇÃO 3: PERGUNTA ATUAL DO USUÁRIO
-════════════════════════════════════════════════════════════════════════════════
-
-{user_message}
-
-════════════════════════════════════════════════════════════════════════════════
-"""
-
-        messages.append({"role": "user", "content": mensagem_atual})
-
-        # 8. Chama a API do OpenAI
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1000
-        )
-
-        resposta = response.choices[0].message.content
-
-        # 9. Salva a mensagem do usuário e a resposta no banco
-        save_message(chat_id, "user", user_message)
-        save_message(chat_id, "assistant", resposta)
-
-        # 10. Envia a resposta
-        await update.message.reply_text(resposta)
+        # 8. Pergunta frequente de primeiro turno já respondida: envia direto.
+        #    Senão, chama a API do OpenAI em modo stream, editando uma mensagem
+        #    provisória conforme os trechos chegam
+        resposta_progressiva = RespostaProgressiva(update.message, inicio=inicio)
+        frequente = await engine.resposta_frequente(preparo)
+        if frequente is not None:
+            await resposta_progressiva.finalizar(frequente)
+            await engine.salvar_turno(preparo, frequente)
+        else:
+            await responder_em_stream(engine, preparo, resposta_progressiva)
 
         # 11. Incrementa o contador de mensagens do usuário
-        if telegram_user_id not in message_counters:
-            message_counters[telegram_user_id] = 0
-        message_counters[telegram_user_id] += 1
+        sessoes: TelegramSessions = context.bot_data["sessoes"]
+        sessao = await sessoes.registrar_mensagem(telegram_user_id)
 
         # 12. Verifica se deve enviar o link da aplicação
         should_send_link = (
-            message_counters[telegram_user_id] >= MENSAGENS_ANTES_LINK and
-            telegram_user_id not in link_sent
+            sessao is not None and
+            sessao.mensagens >= MENSAGENS_ANTES_LINK and
+            not sessao.link_enviado
         )
 
         if should_send_link:
@@ -351,24 +242,81 @@ Se preferir, temos uma aplicação web completa onde você pode:
 Mas fique à vontade para continuar conversando aqui no Telegram também! 💜
 """
             await update.message.reply_text(link_message)
-            link_sent[telegram_user_id] = True
-            logger.info(f"Link da aplicação enviado para usuário {telegram_user_id} após {message_counters[telegram_user_id]} mensagens")
-
-        logger.info(f"Resposta enviada para {telegram_user_id}")
+            sessoes.marcar_link_enviado(telegram_user_id, sessao)
+            logger.info(f"Link da aplicação enviado para usuário {telegram_user_id} após {sessao.mensagens} mensagens")
+
+        logger.info(
+            f"Resposta enviada para {telegram_user_id} "
+            f"(chat {preparo.chat_id}, intenção {preparo.intent}, contexto: {preparo.modo_contexto}, "
+            f"{preparo.trechos_contexto} trechos, {preparo.tokens_contexto} tokens, "
+            f"primeiro texto em {resposta_progressiva.ttft_ms:.0f} ms, {resposta_progressiva.edicoes} edições)"
+        )
 
     except Exception as e:
         logger.error(f"Erro ao processar mensagem: {e}")
-        await update.message.reply_text(
-            "Desculpe, ocorreu um erro ao processar sua mensagem. Tente novamente."
-        )
+        aviso = "Desculpe, ocorreu um erro ao processar sua mensagem. Tente novamente."
+        if resposta_progressiva:
+            await resposta_progressiva.falhar(aviso)
+        else:
+            await update.message.reply_text(aviso)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler para erros"""
     logger.error(f"Erro: {context.error}")
 
+def criar_aplicacao(
+    engine: ChatEngine, token: str, webhook: bool = False, post_init=None, post_shutdown=None
+) -> Application:
+    """
+    Monta a aplicação do bot sobre um motor de chat. Com `webhook`, a
+    aplicação não faz long-polling: os updates são entregues pela rota
+    /telegram/webhook da API.
+    """
+    # Updates de usuários diferentes em paralelo; do mesmo usuário, em ordem
+    builder = Application.builder().token(token).concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+    # Envios com limite global e por chat, na ordem de cada chat (telegram_envio.py)
+    limitador = LimitadorEnvio()
+    builder = builder.rate_limiter(limitador)
+    if webhook:
+        builder = builder.updater(None)
+    if post_init:
+        builder = builder.post_init(post_init)
+    if post_shutdown:
+        builder = builder.post_shutdown(post_shutdown)
+    application = builder.build()
+    application.bot_data["engine"] = engine
+    # Contadores e link por usuário; persistidos se TELEGRAM_SESSIONS_BACKEND for supabase ou sqlite
+    sessoes = TelegramSessions(criar_armazenamento(supabase=engine.supabase_async or engine.supabase))
+    application.bot_data["sessoes"] = sessoes
+    metrics.gauge("telegram_usuarios_em_atendimento", lambda: len(usuarios_em_atendimento))
+    metrics.gauge("telegram_sessoes", sessoes.stats)
+    metrics.gauge("telegram_envio", limitador.stats)
+
+    # Registra os handlers
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("ajuda", help_command))
+    application.add_handler(CommandHandler("novo", new_chat_command))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+
+    # Registra o handler de erros
+    application.add_error_handler(error_handler)
+
+    return application
+
+async def parar_sessoes(application: Application):
+    """Grava as sessões alteradas que ainda não foram gravadas (shutdown)."""
+    await application.bot_data["sessoes"].parar()
+
 def main():
     """Função principal para iniciar o bot"""
 
+    # Configuração de logging (só no processo próprio; importado pela API,
+    # o módulo não mexe no logging dela)
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
     # Verifica se o token foi configurado
     if not TELEGRAM_BOT_TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN não configurado no .env")
@@ -376,17 +324,25 @@ def main():
 
     logger.info("Iniciando bot do Telegram...")
 
-    # Cria a aplicação
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Processo próprio (long-polling): motor de chat e clientes só do bot
+    engine = ChatEngine(
+        create_client(SUPABASE_URL, SUPABASE_KEY),
+        SUPABASE_BUCKET,
+        OpenAI(api_key=OPENAI_API_KEY),
+        AsyncOpenAI(api_key=OPENAI_API_KEY),
+        nome_metrica_persistencia="telegram_persistencia",
+    )
 
-    # Registra os handlers
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("ajuda", help_command))
-    application.add_handler(CommandHandler("novo", new_chat_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    async def post_init(application: Application):
+        await engine.iniciar(await acreate_client(SUPABASE_URL, SUPABASE_KEY))
 
-    # Registra o error handler
-    application.add_error_handler(error_handler)
+    async def post_shutdown(application: Application):
+        # Grava as sessões e as mensagens que ainda estão na fila
+        await parar_sessoes(application)
+        await engine.parar()
+
+    # Cria a aplicação
+    application = criar_aplicacao(engine, TELEGRAM_BOT_TOKEN, post_init=post_init, post_shutdown=post_shutdown)
 
     # Inicia o bot
     logger.info("Bot iniciado com sucesso! Aguardando mensagens...")
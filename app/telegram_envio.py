@@ -0,0 +1,169 @@
+"""
+Fila de saída do bot do Telegram, com limite de envio global e por chat.
+
+Todas as chamadas do bot à API do Telegram (respostas, edições, link da
+aplicação, "digitando...") passam pelo `LimitadorEnvio`, ligado à
+aplicação com `Application.builder().rate_limiter(...)`. Cada chamada
+espera um token do balde do chat e um do balde global (~30 mensagens/s no
+total, ~1/s por chat privado, 20/min por grupo) antes de ir para a API.
+
+Chamadas de um mesmo chat saem na ordem em que foram feitas. Se o Telegram
+responder com RetryAfter, todos os envios pausam pelo tempo pedido e a
+chamada é repetida (até TELEGRAM_RATE_MAX_RETRIES vezes). Chamadas feitas
+com `rate_limit_args=SEM_REPETICAO` (ex.: edições intermediárias de uma
+resposta em andamento) não são repetidas: o RetryAfter volta para quem chamou.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from cache import TTLCache
+from chat_sessions import BloqueiosPorChave
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_RATE_GLOBAL_PER_SECOND = float(os.getenv("TELEGRAM_RATE_GLOBAL_PER_SECOND", "30"))
+TELEGRAM_RATE_CHAT_PER_SECOND = float(os.getenv("TELEGRAM_RATE_CHAT_PER_SECOND", "1"))
+TELEGRAM_RATE_CHAT_BURST = int(os.getenv("TELEGRAM_RATE_CHAT_BURST", "3"))
+TELEGRAM_RATE_GROUP_PER_MINUTE = float(os.getenv("TELEGRAM_RATE_GROUP_PER_MINUTE", "20"))
+TELEGRAM_RATE_MAX_RETRIES = int(os.getenv("TELEGRAM_RATE_MAX_RETRIES", "3"))
+
+# rate_limit_args de chamadas que não devem ser repetidas após RetryAfter
+SEM_REPETICAO = {"tentar_novamente": False}
+
+# Um balde parado há mais que isso já está cheio; pode sair da memória
+_BALDES_TTL_SECONDS = 120
+_BALDES_MAX_ITEMS = 20000
+
+
+class BaldeDeTokens:
+    """
+    Balde de tokens: `taxa` tokens por segundo, acumulando até `capacidade`.
+    Quem espera é atendido na ordem de chegada.
+    """
+
+    def __init__(self, taxa: float, capacidade: float, relogio: Callable[[], float] = time.monotonic):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self._relogio = relogio
+        self._tokens = capacidade
+        self._atualizado_em = relogio()
+        self._lock = asyncio.Lock()
+
+    def _reabastecer(self):
+        agora = self._relogio()
+        self._tokens = min(self.capacidade, self._tokens + (agora - self._atualizado_em) * self.taxa)
+        self._atualizado_em = agora
+
+    async def adquirir(self):
+        async with self._lock:
+            self._reabastecer()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.taxa)
+                self._reabastecer()
+            self._tokens -= 1
+
+
+def _segundos(retry_after: Union[int, float, timedelta]) -> float:
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class LimitadorEnvio(BaseRateLimiter[Dict[str, Any]]):
+    def __init__(
+        self,
+        por_segundo: float = TELEGRAM_RATE_GLOBAL_PER_SECOND,
+        por_segundo_chat: float = TELEGRAM_RATE_CHAT_PER_SECOND,
+        rajada_chat: int = TELEGRAM_RATE_CHAT_BURST,
+        por_minuto_grupo: float = TELEGRAM_RATE_GROUP_PER_MINUTE,
+        tentativas: int = TELEGRAM_RATE_MAX_RETRIES,
+    ):
+        self.por_segundo_chat = por_segundo_chat
+        self.rajada_chat = rajada_chat
+        self.por_minuto_grupo = por_minuto_grupo
+        self.tentativas = tentativas
+        # Sem rajada no global: envios espaçados, nunca mais que `por_segundo` em um segundo
+        self._global = BaldeDeTokens(por_segundo, 1)
+        self._baldes = TTLCache(_BALDES_MAX_ITEMS, _BALDES_TTL_SECONDS)
+        self._chats = BloqueiosPorChave()
+        # Pausa pedida pelo Telegram (RetryAfter), em time.monotonic()
+        self._pausado_ate = 0.0
+        # Chamadas esperando vez ou em andamento
+        self.na_fila = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _balde(self, chat_id) -> BaldeDeTokens:
+        balde = self._baldes.get(chat_id)
+        if balde is None:
+            # Grupos e canais têm id negativo (ou @username) e limite por minuto
+            grupo = isinstance(chat_id, str) or chat_id < 0
+            if grupo:
+                balde = BaldeDeTokens(self.por_minuto_grupo / 60, self.por_minuto_grupo)
+            else:
+                balde = BaldeDeTokens(self.por_segundo_chat, self.rajada_chat)
+            self._baldes.set(chat_id, balde)
+        return balde
+
+    async def _aguardar_pausa(self):
+        while (restante := self._pausado_ate - time.monotonic()) > 0:
+            await asyncio.sleep(restante)
+
+    async def _enviar(self, callback, args, kwargs, balde: Optional[BaldeDeTokens], inicio: float, tentativas: int):
+        for tentativa in range(tentativas + 1):
+            await self._aguardar_pausa()
+            if balde is not None:
+                await balde.adquirir()
+            await self._global.adquirir()
+            if tentativa == 0:
+                metrics.observe("telegram_envio_espera_ms", (time.perf_counter() - inicio) * 1000)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                espera = _segundos(e.retry_after)
+                metrics.incr("telegram_envio_retry_after")
+                self._pausado_ate = max(self._pausado_ate, time.monotonic() + espera)
+                if tentativa == tentativas:
+                    raise
+                logger.warning(f"Telegram pediu para esperar {espera}s (tentativa {tentativa + 1})")
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], None]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], None]:
+        inicio = time.perf_counter()
+        chat_id = data.get("chat_id")
+        tentativas = self.tentativas if (rate_limit_args or {}).get("tentar_novamente", True) else 0
+        self.na_fila += 1
+        try:
+            if chat_id is None:
+                return await self._enviar(callback, args, kwargs, None, inicio, tentativas)
+            # Um envio por vez por chat, na ordem de chegada
+            async with self._chats.bloqueio(chat_id):
+                return await self._enviar(callback, args, kwargs, self._balde(chat_id), inicio, tentativas)
+        finally:
+            self.na_fila -= 1
+
+    def stats(self) -> dict:
+        return {
+            "na_fila": self.na_fila,
+            "chats_na_fila": len(self._chats),
+            "baldes": len(self._baldes),
+            "pausado_s": round(max(0.0, self._pausado_ate - time.monotonic()), 3),
+        }
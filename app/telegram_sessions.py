@@ -0,0 +1,282 @@
+"""
+Estado das sessões do Telegram: mensagens enviadas e se o link da
+aplicação já foi mostrado.
+
+Os registros ficam em memória com limite de usuários (LRU) e expiração
+(TTL). Opcionalmente, são persistidos no Supabase (tabela
+`telegram_sessions`) ou em um arquivo SQLite local, para que o link não
+seja reenviado depois de um restart. As alterações não são gravadas na
+hora: ficam marcadas como pendentes e são gravadas juntas, com um único
+upsert, a cada TELEGRAM_SESSIONS_FLUSH_MS (e no shutdown).
+
+Um usuário que saiu da memória é recarregado do armazenamento na próxima
+mensagem; cargas simultâneas do mesmo usuário esperam a primeira.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from cache import TTLCache
+from chat_sessions import BloqueiosPorChave
+from metrics import metrics
+from persistence import executar
+
+logger = logging.getLogger(__name__)
+
+# memoria (padrão, sem persistência), supabase ou sqlite
+TELEGRAM_SESSIONS_BACKEND = os.getenv("TELEGRAM_SESSIONS_BACKEND", "memoria").lower()
+TELEGRAM_SESSIONS_SQLITE_PATH = os.getenv(
+    "TELEGRAM_SESSIONS_SQLITE_PATH", str(Path(__file__).parent.parent / "telegram_sessions.db")
+)
+TELEGRAM_SESSIONS_TTL_SECONDS = float(os.getenv("TELEGRAM_SESSIONS_TTL_SECONDS", "86400"))
+TELEGRAM_SESSIONS_MAX_ITEMS = int(os.getenv("TELEGRAM_SESSIONS_MAX_ITEMS", "50000"))
+TELEGRAM_SESSIONS_FLUSH_MS = float(os.getenv("TELEGRAM_SESSIONS_FLUSH_MS", "2000"))
+# Após falhas seguidas, o intervalo dobra a cada tentativa até este limite
+TELEGRAM_SESSIONS_RETRY_MAX_MS = float(os.getenv("TELEGRAM_SESSIONS_RETRY_MAX_MS", "60000"))
+
+
+class SessaoTelegram:
+    __slots__ = ("mensagens", "link_enviado")
+
+    def __init__(self, mensagens: int = 0, link_enviado: bool = False):
+        self.mensagens = mensagens
+        self.link_enviado = link_enviado
+
+
+def _linha(telegram_user_id: int, sessao: SessaoTelegram, agora: str) -> dict:
+    return {
+        'telegram_user_id': telegram_user_id,
+        'mensagens': sessao.mensagens,
+        'link_enviado': sessao.link_enviado,
+        'updated_at': agora,
+    }
+
+
+class ArmazenamentoSupabase:
+    """Tabela `telegram_sessions` do Supabase (cliente síncrono ou assíncrono)."""
+
+    def __init__(self, supabase):
+        self.supabase = supabase
+
+    async def carregar(self, telegram_user_id: int) -> Optional[SessaoTelegram]:
+        result = await executar(
+            self.supabase.table('telegram_sessions')
+            .select('mensagens, link_enviado')
+            .eq('telegram_user_id', telegram_user_id)
+            .limit(1)
+        )
+        if not result.data:
+            return None
+        return SessaoTelegram(result.data[0]['mensagens'], result.data[0]['link_enviado'])
+
+    async def gravar(self, linhas: List[dict]):
+        await executar(self.supabase.table('telegram_sessions').upsert(linhas, on_conflict='telegram_user_id'))
+
+
+class ArmazenamentoSQLite:
+    """Arquivo SQLite local; as chamadas rodam em uma thread."""
+
+    def __init__(self, caminho: str = TELEGRAM_SESSIONS_SQLITE_PATH):
+        self.caminho = caminho
+        self._lock = threading.Lock()
+        self._conexao: Optional[sqlite3.Connection] = None
+
+    def _conectar(self) -> sqlite3.Connection:
+        if self._conexao is None:
+            self._conexao = sqlite3.connect(self.caminho, check_same_thread=False)
+            self._conexao.execute(
+                "CREATE TABLE IF NOT EXISTS telegram_sessions ("
+                "telegram_user_id INTEGER PRIMARY KEY, mensagens INTEGER NOT NULL, "
+                "link_enviado INTEGER NOT NULL, updated_at TEXT)"
+            )
+            self._conexao.commit()
+        return self._conexao
+
+    def _carregar(self, telegram_user_id: int) -> Optional[SessaoTelegram]:
+        with self._lock:
+            linha = self._conectar().execute(
+                "SELECT mensagens, link_enviado FROM telegram_sessions WHERE telegram_user_id = ?",
+                (telegram_user_id,),
+            ).fetchone()
+        return SessaoTelegram(linha[0], bool(linha[1])) if linha else None
+
+    def _gravar(self, linhas: List[dict]):
+        with self._lock:
+            conexao = self._conectar()
+            with conexao:
+                conexao.executemany(
+                    "INSERT INTO telegram_sessions (telegram_user_id, mensagens, link_enviado, updated_at) "
+                    "VALUES (:telegram_user_id, :mensagens, :link_enviado, :updated_at) "
+                    "ON CONFLICT(telegram_user_id) DO UPDATE SET mensagens = excluded.mensagens, "
+                    "link_enviado = excluded.link_enviado, updated_at = excluded.updated_at",
+                    linhas,
+                )
+
+    async def carregar(self, telegram_user_id: int) -> Optional[SessaoTelegram]:
+        return await asyncio.to_thread(self._carregar, telegram_user_id)
+
+    async def gravar(self, linhas: List[dict]):
+        await asyncio.to_thread(self._gravar, linhas)
+
+    def fechar(self):
+        with self._lock:
+            if self._conexao is not None:
+                self._conexao.close()
+                self._conexao = None
+
+
+def criar_armazenamento(backend: str = TELEGRAM_SESSIONS_BACKEND, supabase=None):
+    """Armazenamento configurado em TELEGRAM_SESSIONS_BACKEND, ou None (só memória)."""
+    if backend == "supabase":
+        return ArmazenamentoSupabase(supabase)
+    if backend == "sqlite":
+        return ArmazenamentoSQLite()
+    if backend != "memoria":
+        logger.warning(f"TELEGRAM_SESSIONS_BACKEND desconhecido: {backend}; usando só memória")
+    return None
+
+
+class TelegramSessions:
+    def __init__(
+        self,
+        armazenamento=None,
+        ttl: float = TELEGRAM_SESSIONS_TTL_SECONDS,
+        max_itens: int = TELEGRAM_SESSIONS_MAX_ITEMS,
+        espera_ms: float = TELEGRAM_SESSIONS_FLUSH_MS,
+    ):
+        self.armazenamento = armazenamento
+        self.espera = espera_ms / 1000
+        self._cache = TTLCache(max_itens, ttl)
+        self._carregando = BloqueiosPorChave()
+        # Alterados e ainda não gravados; os em gravação ficam em `_gravando`
+        # até o upsert terminar, para não serem recarregados desatualizados
+        self._pendentes: Dict[int, SessaoTelegram] = {}
+        self._gravando: Dict[int, SessaoTelegram] = {}
+        # Gravação agendada (esperando TELEGRAM_SESSIONS_FLUSH_MS)
+        self._gravacao: Optional[asyncio.Task] = None
+        # Um lote por vez, para que gravações do mesmo usuário não se invertam
+        self._gravar_lock = asyncio.Lock()
+        # Falhas de gravação seguidas (aumentam o intervalo até a próxima tentativa)
+        self._falhas_seguidas = 0
+        # Shutdown: antecipa a gravação agendada em vez de cancelá-la
+        self._parando = asyncio.Event()
+
+    async def _obter(self, telegram_user_id: int) -> SessaoTelegram:
+        sessao = self._cache.get(telegram_user_id)
+        if sessao is not None:
+            return sessao
+        async with self._carregando.bloqueio(telegram_user_id):
+            sessao = (
+                self._cache.peek(telegram_user_id)
+                or self._pendentes.get(telegram_user_id)
+                or self._gravando.get(telegram_user_id)
+            )
+            if sessao is None and self.armazenamento is not None:
+                sessao = await self.armazenamento.carregar(telegram_user_id)
+                # Um /novo durante a carga vale mais que o registro lido
+                sessao = self._cache.peek(telegram_user_id) or sessao
+            sessao = sessao or SessaoTelegram()
+            self._cache.set(telegram_user_id, sessao)
+            return sessao
+
+    async def registrar_mensagem(self, telegram_user_id: int) -> Optional[SessaoTelegram]:
+        """
+        Conta uma mensagem respondida e retorna a sessão do usuário. Retorna
+        None se a sessão não pôde ser carregada (na dúvida, não mostra o link).
+        """
+        try:
+            sessao = await self._obter(telegram_user_id)
+        except Exception as e:
+            metrics.incr("telegram_sessoes_falhas_leitura")
+            logger.error(f"Erro ao carregar sessão do Telegram {telegram_user_id}: {e}")
+            return None
+        sessao.mensagens += 1
+        self._alterada(telegram_user_id, sessao)
+        return sessao
+
+    def marcar_link_enviado(self, telegram_user_id: int, sessao: SessaoTelegram):
+        sessao.link_enviado = True
+        self._alterada(telegram_user_id, sessao)
+
+    def reiniciar(self, telegram_user_id: int):
+        """Zera a sessão (comando /novo)."""
+        sessao = SessaoTelegram()
+        self._cache.set(telegram_user_id, sessao)
+        self._alterada(telegram_user_id, sessao)
+
+    def _alterada(self, telegram_user_id: int, sessao: SessaoTelegram):
+        if self.armazenamento is None:
+            return
+        self._pendentes[telegram_user_id] = sessao
+        self._agendar()
+
+    def _agendar(self):
+        if self._gravacao is not None or self._parando.is_set():
+            return
+        espera = min(self.espera * 2 ** self._falhas_seguidas, TELEGRAM_SESSIONS_RETRY_MAX_MS / 1000)
+        self._gravacao = asyncio.create_task(self._gravar_depois(espera))
+
+    async def _gravar_depois(self, espera: float):
+        try:
+            await asyncio.wait_for(self._parando.wait(), espera)
+        except asyncio.TimeoutError:
+            pass
+        self._gravacao = None
+        await self.gravar()
+
+    async def gravar(self):
+        """Grava de uma vez todas as sessões alteradas."""
+        async with self._gravar_lock:
+            await self._gravar_lote()
+
+    async def _gravar_lote(self):
+        if not self._pendentes:
+            return
+        lote, self._pendentes = self._pendentes, {}
+        self._gravando.update(lote)
+        agora = datetime.now().isoformat()
+        try:
+            await self.armazenamento.gravar([_linha(uid, sessao, agora) for uid, sessao in lote.items()])
+            metrics.incr("telegram_sessoes_gravadas", len(lote))
+            self._falhas_seguidas = 0
+        except asyncio.CancelledError:
+            self._devolver(lote)
+            raise
+        except Exception as e:
+            metrics.incr("telegram_sessoes_falhas_gravacao", len(lote))
+            logger.error(f"Erro ao gravar {len(lote)} sessões do Telegram: {e}")
+            self._devolver(lote)
+            self._falhas_seguidas += 1
+            self._agendar()
+        finally:
+            for uid, sessao in lote.items():
+                if self._gravando.get(uid) is sessao:
+                    del self._gravando[uid]
+
+    def _devolver(self, lote: Dict[int, SessaoTelegram]):
+        """Volta o lote para a fila, sem sobrescrever alterações mais novas."""
+        for uid, sessao in lote.items():
+            self._pendentes.setdefault(uid, sessao)
+
+    async def parar(self):
+        """Grava o que estiver pendente (shutdown)."""
+        # A gravação agendada roda na hora, sem esperar o intervalo
+        self._parando.set()
+        if self._gravacao is not None:
+            await asyncio.gather(self._gravacao, return_exceptions=True)
+        if self.armazenamento is not None:
+            # Espera a gravação em andamento, se houver, e grava o restante
+            await self.gravar()
+            if hasattr(self.armazenamento, "fechar"):
+                self.armazenamento.fechar()
+
+    def stats(self) -> dict:
+        stats = self._cache.stats()
+        stats["pendentes"] = len(self._pendentes)
+        return stats
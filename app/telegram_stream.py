@@ -0,0 +1,139 @@
+"""
+Resposta do bot do Telegram exibida enquanto é gerada.
+
+O bot envia uma mensagem provisória e a edita conforme chegam os trechos
+da OpenAI. As edições são agrupadas: no máximo uma a cada
+TELEGRAM_STREAM_EDIT_INTERVAL_MS, e o texto acumulado nesse intervalo vai
+de uma vez, para ficar abaixo do limite de edições do Telegram. Respostas
+maiores que 4096 caracteres continuam em novas mensagens.
+"""
+
+import asyncio
+import os
+import time
+from datetime import timedelta
+from typing import List, Optional
+
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
+
+from metrics import metrics
+from telegram_envio import SEM_REPETICAO
+
+TELEGRAM_STREAM_EDIT_INTERVAL_MS = float(os.getenv("TELEGRAM_STREAM_EDIT_INTERVAL_MS", "1000"))
+MENSAGEM_PROVISORIA = "✍️ ..."
+
+
+def dividir_texto(texto: str, limite: int = MessageLimit.MAX_TEXT_LENGTH) -> List[str]:
+    """Divide o texto em partes de até `limite` caracteres, de preferência em quebras de linha."""
+    partes = []
+    while len(texto) > limite:
+        corte = texto.rfind("\n", 0, limite + 1)
+        if corte < limite // 2:
+            corte = texto.rfind(" ", 0, limite + 1)
+        if corte < limite // 2:
+            corte = limite
+        partes.append(texto[:corte].rstrip())
+        texto = texto[corte:].lstrip()
+    partes.append(texto)
+    return partes
+
+
+def _segundos(retry_after) -> float:
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class RespostaProgressiva:
+    """
+    Mensagens de uma resposta em andamento. Use `iniciar`, depois
+    `acrescentar` a cada trecho e `finalizar` com o texto completo.
+    """
+
+    def __init__(
+        self,
+        mensagem_original,
+        inicio: Optional[float] = None,
+        intervalo_ms: float = TELEGRAM_STREAM_EDIT_INTERVAL_MS,
+        limite: int = MessageLimit.MAX_TEXT_LENGTH,
+    ):
+        self.mensagem_original = mensagem_original
+        # Referência para o tempo até o primeiro texto (chegada da mensagem)
+        self.inicio = time.perf_counter() if inicio is None else inicio
+        self.intervalo = intervalo_ms / 1000
+        self.limite = limite
+        self.texto = ""
+        self.ttft_ms: Optional[float] = None
+        self.edicoes = 0
+        self._mensagens = []
+        self._exibido: List[str] = []
+        self._proxima_edicao = 0.0
+
+    async def iniciar(self):
+        self._mensagens.append(await self.mensagem_original.reply_text(MENSAGEM_PROVISORIA))
+        self._exibido.append(MENSAGEM_PROVISORIA)
+
+    async def acrescentar(self, trecho: str):
+        self.texto += trecho
+        if self.texto.strip() and time.monotonic() >= self._proxima_edicao:
+            await self._atualizar(final=False)
+
+    async def finalizar(self, texto: Optional[str] = None):
+        """Exibe o texto completo (repetindo a edição se o Telegram pedir para esperar)."""
+        if texto is not None:
+            self.texto = texto
+        await self._atualizar(final=True)
+
+    async def falhar(self, aviso: str):
+        """Mostra um aviso de erro no lugar da mensagem provisória (ou depois do texto parcial)."""
+        if self._mensagens and not self.texto.strip():
+            await self._mensagens[0].edit_text(aviso)
+        else:
+            await self.mensagem_original.reply_text(aviso)
+
+    async def _atualizar(self, final: bool):
+        self._proxima_edicao = time.monotonic() + self.intervalo
+        for i, parte in enumerate(dividir_texto(self.texto, self.limite)):
+            if not parte:
+                continue
+            if i < len(self._exibido) and self._exibido[i] == parte:
+                continue
+            try:
+                await self._exibir(i, parte, final)
+            except RetryAfter as e:
+                if not final:
+                    # Pula esta edição; o texto acumulado vai na próxima
+                    self._proxima_edicao = time.monotonic() + _segundos(e.retry_after)
+                    metrics.incr("telegram_stream_retry_after")
+                    return
+                await asyncio.sleep(_segundos(e.retry_after))
+                await self._exibir(i, parte, final)
+
+        if self.ttft_ms is None and self.texto.strip():
+            self.ttft_ms = (time.perf_counter() - self.inicio) * 1000
+            metrics.observe("telegram_stream_ttft_ms", self.ttft_ms)
+
+    async def _exibir(self, i: int, parte: str, final: bool):
+        if i < len(self._mensagens):
+            try:
+                await self._editar(self._mensagens[i], parte, final)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+            self._exibido[i] = parte
+            self.edicoes += 1
+            metrics.incr("telegram_stream_edicoes")
+        else:
+            self._mensagens.append(await self.mensagem_original.reply_text(parte))
+            self._exibido.append(parte)
+
+    @staticmethod
+    async def _editar(mensagem, texto: str, final: bool):
+        bot = mensagem.get_bot()
+        if final or getattr(bot, "rate_limiter", None) is None:
+            await mensagem.edit_text(texto)
+            return
+        # Edição intermediária: com RetryAfter, a fila de envio não a repete
+        # (o texto acumulado vai na próxima edição)
+        await bot.edit_message_text(
+            texto, chat_id=mensagem.chat_id, message_id=mensagem.message_id, rate_limit_args=SEM_REPETICAO
+        )
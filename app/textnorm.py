@@ -0,0 +1,100 @@
+"""
+Normalização de texto em português usada pela busca na base de conhecimento.
+
+Remove acentos, aplica casefold, descarta stopwords e reduz as palavras a um
+radical com um stemmer leve (remoção de plural, feminino, diminutivo e dos
+sufixos derivacionais e verbais mais comuns).
+"""
+
+import re
+import unicodedata
+from functools import lru_cache
+from typing import List, Tuple
+
+_RE_PALAVRA = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset("""
+a ao aos aquela aquelas aquele aqueles aquilo as ate com como da das de dela delas dele deles
+depois do dos e ela elas ele eles em entre era eram essa essas esse esses esta estas este estes
+eu foi for foram ha isso isto ja lhe lhes mais mas me mesmo meu meus minha minhas muito na nao
+nas nem no nos nossa nossas nosso nossos num numa o os ou para pela pelas pelo pelos por qual
+quando que quem se sem ser seu seus so sua suas tambem te tem tu tua tuas um uma umas uns voce
+voces vos sao sobre pra pro estou esta estao tenho ter fazer faco posso pode queria quero gostaria
+saber oi ola onde
+""".split())
+
+# Sufixos removidos em ordem, do mais longo para o mais curto dentro de cada grupo.
+# (sufixo, tamanho mínimo do radical restante, substituição)
+_PLURAL = [
+    ("oes", 3, "ao"), ("aes", 3, "ao"), ("ais", 2, "al"), ("eis", 2, "el"), ("ois", 2, "ol"),
+    ("is", 2, "il"), ("ns", 1, "m"), ("res", 3, "r"), ("ses", 3, "s"), ("zes", 3, "z"), ("s", 2, ""),
+]
+_FEMININO = [
+    ("ona", 3, "ao"), ("ora", 3, "or"), ("ina", 3, "ino"), ("esa", 3, "es"), ("osa", 3, "oso"),
+    ("iva", 3, "ivo"), ("ada", 2, "ado"), ("ida", 3, "ido"), ("a", 3, "o"),
+]
+_DIMINUTIVO_AUMENTATIVO = [
+    ("zinho", 3, ""), ("zinha", 3, ""), ("inho", 3, ""), ("inha", 3, ""),
+]
+_DERIVACIONAL = [
+    ("amentos", 4, ""), ("imentos", 4, ""), ("izacao", 3, ""), ("amento", 4, ""), ("imento", 4, ""),
+    ("acoes", 3, ""), ("icoes", 3, ""), ("mente", 4, ""), ("idade", 4, ""), ("acao", 3, ""),
+    ("icao", 3, ""), ("ismo", 3, ""), ("ista", 3, ""), ("avel", 3, ""), ("ivel", 3, ""),
+    ("ante", 3, ""), ("ente", 4, ""), ("ador", 3, ""), ("edor", 3, ""), ("idor", 3, ""),
+    ("ico", 3, ""), ("ica", 3, ""), ("oso", 3, ""), ("ivo", 3, ""), ("al", 4, ""),
+]
+_VERBAL = [
+    ("ariamos", 2, ""), ("eriamos", 2, ""), ("iriamos", 3, ""), ("assemos", 2, ""), ("essemos", 2, ""),
+    ("aremos", 2, ""), ("eremos", 2, ""), ("iremos", 3, ""), ("ando", 2, ""), ("endo", 3, ""),
+    ("indo", 3, ""), ("ado", 2, ""), ("ido", 3, ""), ("ar", 2, ""), ("er", 2, ""), ("ir", 3, ""),
+    ("am", 3, ""), ("em", 3, ""), ("ou", 3, ""), ("ei", 3, ""),
+]
+_VOGAL_FINAL = [("io", 4, ""), ("o", 3, ""), ("a", 3, ""), ("e", 3, "")]
+
+# Siglas e termos do domínio que não devem passar pelo stemmer
+_PRESERVAR = {"trans": "trans", "ists": "ist", "ist": "ist", "prep": "prep", "pep": "pep", "hiv": "hiv", "sus": "sus"}
+
+
+def remover_acentos(texto: str) -> str:
+    decomposto = unicodedata.normalize("NFKD", texto)
+    return "".join(c for c in decomposto if not unicodedata.combining(c))
+
+
+def normalizar(texto: str) -> str:
+    """Casefold e remoção de acentos."""
+    return remover_acentos(texto.casefold())
+
+
+def _remover_sufixo(palavra: str, regras) -> Tuple[str, bool]:
+    for sufixo, minimo, substituto in regras:
+        if palavra.endswith(sufixo) and len(palavra) - len(sufixo) >= minimo:
+            return palavra[: -len(sufixo)] + substituto, True
+    return palavra, False
+
+
+@lru_cache(maxsize=50_000)
+def stem(palavra: str) -> str:
+    """Stemmer leve para português (espera palavra já normalizada)."""
+    if palavra in _PRESERVAR:
+        return _PRESERVAR[palavra]
+    if len(palavra) < 4:
+        return palavra
+    palavra, _ = _remover_sufixo(palavra, _PLURAL)
+    palavra, _ = _remover_sufixo(palavra, _FEMININO)
+    palavra, _ = _remover_sufixo(palavra, _DIMINUTIVO_AUMENTATIVO)
+    palavra, removeu = _remover_sufixo(palavra, _DERIVACIONAL)
+    if not removeu:
+        palavra, removeu = _remover_sufixo(palavra, _VERBAL)
+    if not removeu:
+        palavra, _ = _remover_sufixo(palavra, _VOGAL_FINAL)
+    return palavra
+
+
+def tokenizar(texto: str) -> List[str]:
+    """Palavras normalizadas, sem acentos, sem stopwords."""
+    return [p for p in _RE_PALAVRA.findall(normalizar(texto)) if p not in STOPWORDS]
+
+
+def termos(texto: str) -> List[str]:
+    """Radicais das palavras relevantes do texto, na ordem em que aparecem."""
+    return [stem(p) for p in tokenizar(texto)]
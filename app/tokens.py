@@ -0,0 +1,33 @@
+"""
+Contagem local de tokens para orçamento de prompt.
+
+Usa o tokenizer do tiktoken (o200k_base, o mesmo do gpt-4o-mini) quando ele
+está disponível; caso contrário, estima ~4 caracteres por token.
+"""
+
+import logging
+import os
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+
+
+@lru_cache(maxsize=1)
+def _encoder():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning(f"tiktoken indisponível ({e}); usando estimativa de tokens por caracteres")
+        return None
+
+
+def contar_tokens(texto: str) -> int:
+    if not texto:
+        return 0
+    encoder = _encoder()
+    if encoder is None:
+        return max(1, len(texto) // 4)
+    return len(encoder.encode(texto, disallowed_special=()))
@@ -0,0 +1,141 @@
+"""
+Benchmark da paginação do histórico de um chat.
+
+Cria em SQLite (em memória) a tabela `chat_messages` com o índice
+(chat_id, created_at, id) e mede, para chats de tamanhos crescentes:
+
+- "última página": as N mensagens mais recentes;
+- "rolar até o início": percorrer o chat inteiro de página em página,
+  do fim para o começo.
+
+Compara paginação por OFFSET com a paginação por chave (keyset) usada em
+`history.consulta_historico`:
+
+    created_at <= c AND (created_at < c OR id < i)
+    ORDER BY created_at DESC, id DESC LIMIT N
+
+Por keyset, cada página custa o mesmo em qualquer tamanho de chat; por
+OFFSET, cresce com a distância até o fim do chat.
+
+Uso:
+    python benchmarks/bench_history_pagination.py --tamanhos 1000 10000 50000 --pagina 30
+"""
+
+import argparse
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+CHAT_ID = 1
+
+
+def criar_banco(tamanho: int) -> sqlite3.Connection:
+    conexao = sqlite3.connect(":memory:")
+    conexao.execute(
+        "CREATE TABLE chat_messages (id INTEGER PRIMARY KEY, chat_id INTEGER, role TEXT, content TEXT, created_at TEXT)"
+    )
+    conexao.execute("CREATE INDEX idx_chat_messages_chat_created ON chat_messages (chat_id, created_at, id)")
+    inicio = datetime(2025, 1, 1)
+    linhas = []
+    for i in range(tamanho):
+        # Pares pergunta/resposta; algumas mensagens com o mesmo created_at para exercitar o desempate por id
+        criado = (inicio + timedelta(seconds=i - i % 7 // 6)).isoformat()
+        for chat_id in (CHAT_ID, CHAT_ID + 1):  # outro chat do mesmo tamanho na mesma tabela
+            linhas.append((chat_id, "user" if i % 2 == 0 else "assistant", f"mensagem {i} " * 10, criado))
+    conexao.executemany("INSERT INTO chat_messages (chat_id, role, content, created_at) VALUES (?, ?, ?, ?)", linhas)
+    conexao.execute("ANALYZE")
+    return conexao
+
+
+def ultima_pagina_offset(conexao, pagina: int):
+    # Ordem crescente com OFFSET: precisa contar e pular todo o resto do chat
+    total = conexao.execute("SELECT COUNT(*) FROM chat_messages WHERE chat_id = ?", (CHAT_ID,)).fetchone()[0]
+    return conexao.execute(
+        "SELECT id, role, content, created_at FROM chat_messages WHERE chat_id = ? "
+        "ORDER BY created_at, id LIMIT ? OFFSET ?",
+        (CHAT_ID, pagina, max(0, total - pagina)),
+    ).fetchall()
+
+
+def pagina_keyset(conexao, pagina: int, cursor=None):
+    if cursor is None:
+        linhas = conexao.execute(
+            "SELECT id, role, content, created_at FROM chat_messages WHERE chat_id = ? "
+            "ORDER BY created_at DESC, id DESC LIMIT ?",
+            (CHAT_ID, pagina),
+        ).fetchall()
+    else:
+        created_at, id_ = cursor
+        linhas = conexao.execute(
+            "SELECT id, role, content, created_at FROM chat_messages WHERE chat_id = ? "
+            "AND created_at <= ? AND (created_at < ? OR id < ?) "
+            "ORDER BY created_at DESC, id DESC LIMIT ?",
+            (CHAT_ID, created_at, created_at, id_, pagina),
+        ).fetchall()
+    return list(reversed(linhas))
+
+
+def rolar_offset(conexao, pagina: int, tamanho: int) -> list:
+    ids = []
+    for offset in range(0, tamanho, pagina):
+        linhas = conexao.execute(
+            "SELECT id FROM chat_messages WHERE chat_id = ? ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+            (CHAT_ID, pagina, offset),
+        ).fetchall()
+        ids.extend(linha[0] for linha in linhas)
+    return ids
+
+
+def rolar_keyset(conexao, pagina: int) -> list:
+    ids = []
+    cursor = None
+    while True:
+        linhas = pagina_keyset(conexao, pagina, cursor)
+        if not linhas:
+            return ids
+        ids.extend(linha[0] for linha in reversed(linhas))
+        cursor = (linhas[0][3], linhas[0][0])
+
+
+def medir(funcao, repeticoes: int) -> float:
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        funcao()
+    return (time.perf_counter() - inicio) / repeticoes * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tamanhos", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--pagina", type=int, default=30)
+    parser.add_argument("--repeticoes", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"Página de {args.pagina} mensagens, SQLite em memória\n")
+    print(
+        f"{'mensagens':>9} | {'última pág. OFFSET':>18} | {'última pág. keyset':>18} | "
+        f"{'rolar tudo OFFSET':>17} | {'rolar tudo keyset':>17}"
+    )
+    print("-" * 92)
+    for tamanho in args.tamanhos:
+        conexao = criar_banco(tamanho)
+
+        esperado = ultima_pagina_offset(conexao, args.pagina)
+        assert pagina_keyset(conexao, args.pagina) == esperado, "keyset e OFFSET divergem na última página"
+        ids_offset = rolar_offset(conexao, args.pagina, tamanho)
+        ids_keyset = rolar_keyset(conexao, args.pagina)
+        assert ids_offset == ids_keyset and len(ids_keyset) == tamanho, "keyset perdeu ou repetiu mensagens"
+
+        ms_offset = medir(lambda: ultima_pagina_offset(conexao, args.pagina), args.repeticoes)
+        ms_keyset = medir(lambda: pagina_keyset(conexao, args.pagina), args.repeticoes)
+        ms_rolar_offset = medir(lambda: rolar_offset(conexao, args.pagina, tamanho), 1)
+        ms_rolar_keyset = medir(lambda: rolar_keyset(conexao, args.pagina), 1)
+        print(
+            f"{tamanho:>9} | {ms_offset:>15.3f} ms | {ms_keyset:>15.3f} ms | "
+            f"{ms_rolar_offset:>14.1f} ms | {ms_rolar_keyset:>14.1f} ms"
+        )
+        conexao.close()
+
+
+if __name__ == "__main__":
+    main()
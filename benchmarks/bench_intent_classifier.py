@@ -0,0 +1,105 @@
+"""
+Benchmark offline do caminho rápido de classificação de intenção.
+
+Mede, sobre um conjunto rotulado (.jsonl com `text` e `intent`):
+- cobertura: fração de mensagens decididas localmente (sem LLM);
+- acurácia das decisões locais, por etapa;
+- latência das etapas locais em microssegundos.
+
+O modelo de n-gramas é avaliado com validação cruzada (k folds) sobre o
+próprio conjunto, a menos que um modelo já treinado seja passado em --modelo.
+
+Uso:
+    python benchmarks/bench_intent_classifier.py
+    python benchmarks/bench_intent_classifier.py --limiar 0.9 --folds 5
+"""
+
+import argparse
+import random
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from intent_classifier import (  # noqa: E402
+    INTENT_FAST_PATH_THRESHOLD, IntentClassifier, NgramIntentModel, carregar_exemplos,
+)
+
+FIXTURE_PADRAO = Path(__file__).parent / "fixtures" / "intents_labeled.jsonl"
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(p * len(ordenados)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", default=str(FIXTURE_PADRAO))
+    parser.add_argument("--limiar", type=float, default=INTENT_FAST_PATH_THRESHOLD)
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--modelo", help="modelo de n-gramas já treinado (pula a validação cruzada)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    exemplos = carregar_exemplos(args.fixture)
+    random.Random(args.seed).shuffle(exemplos)
+
+    if args.modelo:
+        modelo_fixo = NgramIntentModel.carregar(args.modelo)
+        particoes = [(exemplos, modelo_fixo)]
+    else:
+        particoes = []
+        for fold in range(args.folds):
+            teste = exemplos[fold::args.folds]
+            treino = [e for i, e in enumerate(exemplos) if i % args.folds != fold]
+            particoes.append((teste, NgramIntentModel.treinar(treino)))
+
+    decididos = Counter()
+    acertos = Counter()
+    erros = []
+    latencias_us = []
+    total = 0
+
+    for teste, modelo in particoes:
+        classificador = IntentClassifier(client=None, limiar=args.limiar, modelo=modelo, caminho_log=None)
+        for texto, esperado in teste:
+            total += 1
+            inicio = time.perf_counter()
+            resultado = classificador.classificar_local(texto)
+            latencias_us.append((time.perf_counter() - inicio) * 1e6)
+            if resultado is None:
+                continue
+            decididos[resultado.etapa] += 1
+            if resultado.intent == esperado:
+                acertos[resultado.etapa] += 1
+            else:
+                erros.append((texto, esperado, resultado.intent, resultado.etapa))
+
+    total_decididos = sum(decididos.values())
+    total_acertos = sum(acertos.values())
+
+    print(f"{total} mensagens rotuladas, limiar {args.limiar}\n")
+    print(f"{'etapa':>14} | {'decididas':>9} | {'acurácia':>8}")
+    print("-" * 38)
+    for etapa in ("regras", "modelo_local"):
+        n = decididos[etapa]
+        print(f"{etapa:>14} | {n:>9} | {(acertos[etapa] / n if n else 0):>8.1%}")
+    print("-" * 38)
+    print(f"{'local (total)':>14} | {total_decididos:>9} | {(total_acertos / total_decididos if total_decididos else 0):>8.1%}")
+    print(f"\nCobertura local: {total_decididos / total:.1%} (chamadas ao LLM evitadas)")
+    print(
+        f"Latência local: p50 {percentil(latencias_us, 0.5):.0f} µs, "
+        f"p99 {percentil(latencias_us, 0.99):.0f} µs, máx {max(latencias_us):.0f} µs"
+    )
+
+    if erros:
+        print("\nErros das etapas locais:")
+        for texto, esperado, obtido, etapa in erros:
+            print(f"  [{etapa}] {texto!r}: esperado {esperado}, obtido {obtido}")
+
+
+if __name__ == "__main__":
+    main()
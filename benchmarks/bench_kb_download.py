@@ -0,0 +1,118 @@
+"""
+Benchmark da carga a frio da base de conhecimento.
+
+Sobe um servidor HTTP local que imita os endpoints do Supabase Storage
+(listagem e download de objetos) com uma latência artificial por requisição
+e compara o download sequencial com o download paralelo de `baixar_artigos`.
+
+Uso:
+    python benchmarks/bench_kb_download.py --arquivos 40 --latencia-ms 80 --concorrencia 1 4 8 16
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from supabase import create_client  # noqa: E402
+from knowledge_base import baixar_artigos, concatenar_artigos, listar_artigos  # noqa: E402
+
+BUCKET = "knowledge-base"
+
+
+def gerar_artigos(quantidade: int, tamanho: int) -> dict:
+    corpo = "A retificação de nome pode ser feita diretamente no cartório. " * (tamanho // 64 + 1)
+    return {
+        f"artigo_{i:03d}.md": f"# Artigo {i}\n\n{corpo[:tamanho]}".encode("utf-8")
+        for i in range(quantidade)
+    }
+
+
+def criar_servidor(artigos: dict, latencia: float) -> ThreadingHTTPServer:
+    prefixo_lista = f"/storage/v1/object/list/{BUCKET}"
+    prefixo_objeto = f"/storage/v1/object/{BUCKET}/"
+
+    class FakeStorageHandler(BaseHTTPRequestHandler):
+        def _responder(self, status: int, corpo: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latencia)
+            if self.path.split("?")[0] != prefixo_lista:
+                return self._responder(404, b'{"message":"not found","error":"not_found","statusCode":"404"}', "application/json")
+            listagem = [
+                {"name": nome, "updated_at": "2025-01-01T00:00:00Z", "metadata": {"size": len(conteudo)}}
+                for nome, conteudo in sorted(artigos.items())
+            ]
+            self._responder(200, json.dumps(listagem).encode("utf-8"), "application/json")
+
+        def do_GET(self):
+            time.sleep(latencia)
+            caminho = self.path.split("?")[0]
+            nome = unquote(caminho[len(prefixo_objeto):]) if caminho.startswith(prefixo_objeto) else None
+            if nome not in artigos:
+                return self._responder(404, b'{"message":"not found","error":"not_found","statusCode":"404"}', "application/json")
+            self._responder(200, artigos[nome], "text/markdown")
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), FakeStorageHandler)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--arquivos", type=int, default=40)
+    parser.add_argument("--tamanho", type=int, default=8000, help="tamanho de cada artigo em bytes")
+    parser.add_argument("--latencia-ms", type=float, default=80.0)
+    parser.add_argument("--concorrencia", type=int, nargs="+", default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    artigos = gerar_artigos(args.arquivos, args.tamanho)
+    servidor = criar_servidor(artigos, args.latencia_ms / 1000)
+    host, porta = servidor.server_address
+
+    supabase = create_client(f"http://{host}:{porta}", "fake-service-role-key")
+    bucket = supabase.storage.from_(BUCKET)
+    nomes = [f["name"] for f in listar_artigos(bucket.list())]
+
+    print(f"{len(nomes)} arquivos, latência de {args.latencia_ms:.0f} ms por requisição\n")
+    print(f"{'concorrência':>12} | {'total (ms)':>10} | {'p50 arquivo':>11} | {'max arquivo':>11} | {'speedup':>7}")
+    print("-" * 64)
+
+    referencia = None
+    tempo_sequencial = None
+    for workers in args.concorrencia:
+        relatorio = baixar_artigos(bucket, nomes, max_workers=workers)
+        contexto = concatenar_artigos(relatorio.artigos)
+        if referencia is None:
+            referencia = contexto
+        assert contexto == referencia, "a saída concatenada mudou com a concorrência"
+        assert not relatorio.erros, relatorio.erros
+
+        tempos = sorted(relatorio.tempos_ms.values())
+        tempo_sequencial = tempo_sequencial or relatorio.duracao_ms
+        print(
+            f"{workers:>12} | {relatorio.duracao_ms:>10.0f} | {tempos[len(tempos) // 2]:>11.1f} | "
+            f"{tempos[-1]:>11.1f} | {tempo_sequencial / relatorio.duracao_ms:>6.1f}x"
+        )
+
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()